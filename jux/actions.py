@@ -1,6 +1,6 @@
 from enum import IntEnum
 from functools import reduce
-from typing import Any, Dict, List, NamedTuple, Tuple, Union
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple, Union
 
 import chex
 import jax
@@ -159,6 +159,19 @@ class UnitAction(NamedTuple):
             (self.repeat == __o.repeat) and \
             (self.n == __o.n)
 
+    def pack(self) -> "PackedUnitAction":
+        """Pack into two int32 words, see `PackedUnitAction`. It is vectorized over leaves of any shape."""
+        field = lambda x, bits: jnp.asarray(x).astype(jnp.int32) & ((1 << bits) - 1)
+        action_type = jnp.asarray(self.action_type).astype(jnp.int32) + 1  # DO_NOTHING is packed as 0
+        return PackedUnitAction(
+            lo=(field(self.amount, 15) << 15) | field(self.n, 15),
+            hi=(field(self.resource_type, 3) << 21) | (field(self.direction, 3) << 18) | (field(action_type, 3) << 15)
+            | field(self.repeat, 15),
+        )
+
+    def unpack(self) -> "UnitAction":
+        return self
+
     def is_valid(self, max_transfer_amount) -> bool:
         return (
             (0 <= self.action_type) & (self.action_type <= len(UnitActionType) - 1) & \
@@ -170,8 +183,43 @@ class UnitAction(NamedTuple):
         )
 
 
+class PackedUnitAction(NamedTuple):
+    """
+    `UnitAction` packed into two int32 words, so that a queue of actions is stored in two buffers instead of six, and
+    reading or writing an action is two gathers or scatters. Fields are laid out as
+    ```
+    lo = amount << 15 | n
+    hi = resource_type << 21 | direction << 18 | (action_type + 1) << 15 | repeat
+    ```
+    `n`, `amount` and `repeat` take 15 bits, and the others 3 bits, so packing is lossless for actions that pass
+    `UnitAction.is_valid()` and for `UnitAction.do_nothing()`, which packs to zeros. Out of range fields wrap around.
+    """
+    lo: jnp.int32 = jnp.int32(0)
+    hi: jnp.int32 = jnp.int32(0)
+
+    def pack(self) -> "PackedUnitAction":
+        return self
+
+    def unpack(self) -> UnitAction:
+        """Unpack into a `UnitAction`. It is vectorized over leaves of any shape."""
+        lo, hi = jnp.asarray(self.lo), jnp.asarray(self.hi)
+        field = lambda word, shift, bits, name: ((word >> shift) & ((1 << bits) - 1)).astype(
+            UnitAction.__annotations__[name])
+        return UnitAction(
+            action_type=field(hi, 15, 3, 'action_type') - 1,
+            direction=field(hi, 18, 3, 'direction'),
+            resource_type=field(hi, 21, 3, 'resource_type'),
+            amount=field(lo, 15, 15, 'amount'),
+            repeat=field(hi, 0, 15, 'repeat'),
+            n=field(lo, 0, 15, 'n'),
+        )
+
+    def is_valid(self, max_transfer_amount) -> bool:
+        return self.unpack().is_valid(max_transfer_amount)
+
+
 class ActionQueue(NamedTuple):
-    data: UnitAction  # UnitAction[UNIT_ACTION_QUEUE_SIZE]
+    data: Union[UnitAction, PackedUnitAction]  # UnitAction[UNIT_ACTION_QUEUE_SIZE]
     front: jnp.int8 = jnp.int8(0)
     rear: jnp.int8 = jnp.int8(0)
     count: jnp.int8 = jnp.int8(0)
@@ -197,7 +245,7 @@ class ActionQueue(NamedTuple):
         return cls(data, jnp.int8(0), n_actions, n_actions)
 
     def to_lux(self) -> List[LuxAction]:
-        data = np.array(self._get_sorted_data())
+        data = np.array(self._get_sorted_data().unpack())
         data = data[:, :self.count].T
         return [format_action_vec(code) for code in data]
 
@@ -211,95 +259,100 @@ class ActionQueue(NamedTuple):
     def capacity(self) -> int:
         return self.data[0].shape[-1]
 
+    @property
+    def is_packed(self) -> bool:
+        return isinstance(self.data, PackedUnitAction)
+
+    def pack(self) -> "ActionQueue":
+        """Store actions as `PackedUnitAction`, see `JuxBufferConfig.PACKED_ACTION_QUEUE`."""
+        return self._replace(data=self.data.pack())
+
+    def unpack(self) -> "ActionQueue":
+        return self._replace(data=self.data.unpack())
+
+    def to_layout(self, action: Union[UnitAction, PackedUnitAction]) -> Union[UnitAction, PackedUnitAction]:
+        """Convert `action`, packed or not, to the layout of `self.data`."""
+        return action.pack() if self.is_packed else action.unpack()
+
+    def slot_mask(self, idx: Array) -> Array:
+        """bool[..., Q], one-hot mask of slot `idx` in each queue."""
+        return jnp.arange(self.capacity) == jnp.asarray(idx)[..., None]
+
+    def write(self, idx: Array, action: UnitAction, mask: Array) -> Union[UnitAction, PackedUnitAction]:
+        """
+        Return `self.data` with `action` written into slot `idx` of queues where `mask` is True. It is a masked select
+        over the whole `[..., Q]` buffers instead of a scatter, so it works on batched queues without `jax.vmap`.
+        """
+        write = self.slot_mask(idx) & jnp.asarray(mask)[..., None]
+        return jax.tree_map(lambda data, v: jnp.where(write, jnp.asarray(v)[..., None], data), self.data,
+                            self.to_layout(action))
+
     def push_back(self, action: UnitAction) -> "ActionQueue":
         """Push an action into the back of the queue. There is no way to thrown an error in jitted function. It is user's responsibility to check if the queue is full.
 
+        It works on batched queues with leading batch dimensions, and is branch-free, so it is cheap under `jax.vmap`.
+
         Args:
             action (UnitAction): action to push into.
 
         Returns:
-            ActionQueue: Updated queue.
+            ActionQueue: Updated queue. A full queue is left unchanged.
         """
-
-        # if self.is_full():
-        #     raise ValueError("ActionQueue is full")
-
-        # There is no way to thrown an error in jitted function.
-        # It is user's responsibility to check if the queue is full.
-        # TODO: design an error code?
-        def _push(action: UnitAction):
-            data = jax.tree_map(lambda data, v: data.at[..., self.rear].set(v), self.data, action)
-            rear = (self.rear + 1) % self.capacity
-            count = self.count + 1
-            return ActionQueue(data, self.front, rear, count)
-
-        return jax.lax.cond(
-            self.is_full(),
-            lambda _: self,
-            _push,
-            action,
+        push = ~self.is_full()
+        return ActionQueue(
+            data=self.write(self.rear, action, push),
+            front=self.front,
+            rear=jnp.where(push, (self.rear + 1) % self.capacity, self.rear),
+            count=jnp.where(push, self.count + 1, self.count),
         )
 
     def push_front(self, action: UnitAction) -> "ActionQueue":
         """Push an action into the front of the queue. There is no way to thrown an error in jitted function. It is user's responsibility to check if the queue is full.
 
+        It works on batched queues with leading batch dimensions, and is branch-free, so it is cheap under `jax.vmap`.
+
         Args:
             action (UnitAction): action to push into.
 
         Returns:
-            ActionQueue: Updated queue.
+            ActionQueue: Updated queue. A full queue is left unchanged.
         """
-
-        # if self.is_full():
-        #     raise ValueError("ActionQueue is full")
-
-        # There is no way to thrown an error in jitted function.
-        # It is user's responsibility to check if the queue is full.
-        # TODO: design an error code?
-        def _push(action: UnitAction):
-            front = (self.front - 1 + self.capacity) % self.capacity
-            data = jax.tree_map(lambda data, v: data.at[..., front].set(v), self.data, action)
-            count = self.count + 1
-            return ActionQueue(data, front, self.rear, count)
-
-        return jax.lax.cond(
-            self.is_full(),
-            lambda _: self,
-            _push,
-            action,
+        push = ~self.is_full()
+        front = (self.front - 1 + self.capacity) % self.capacity
+        return ActionQueue(
+            data=self.write(front, action, push),
+            front=jnp.where(push, front, self.front),
+            rear=self.rear,
+            count=jnp.where(push, self.count + 1, self.count),
         )
 
     def pop(self) -> Tuple[UnitAction, "ActionQueue"]:
-        return jax.lax.cond(
-            self.is_empty(),
-            # if empty, return empty action and self.
-            lambda self: (UnitAction(), self),
-            # else, return the front action and updated queue.
-            lambda self: (
-                self.peek(),
-                ActionQueue(
-                    data=self.data,
-                    front=(self.front + 1) % self.capacity,
-                    rear=self.rear,
-                    count=self.count - 1,
-                ),
-            ),
-            self,
+        """
+        Pop the front action. If the queue is empty, return an empty `UnitAction()` and the queue unchanged. It works on
+        batched queues with leading batch dimensions, and is branch-free.
+        """
+        empty = self.is_empty()
+        action = jux.tree_util.tree_where(empty, UnitAction(), self.peek())
+        queue = ActionQueue(
+            data=self.data,
+            front=jnp.where(empty, self.front, (self.front + 1) % self.capacity),
+            rear=self.rear,
+            count=jnp.where(empty, self.count, self.count - 1),
         )
+        return action, queue
 
     def peek(self) -> UnitAction:
         '''Return the front of the queue. There is no way to thrown an error in jitted function. It is user's responsibility to check if the queue is empty.
 
+        It works on batched queues with leading batch dimensions.
+
         Returns:
-            ActionQueue: Updated queue.
+            UnitAction: the front action.
         '''
-        # if self.is_empty():
-        #     raise ValueError("ActionQueue is empty")
-
-        # There is no way to thrown an error in jitted function.
-        # It is user's responsibility to check if the queue is empty.
-        # TODO: design an error code?
-        return jax.tree_map(lambda x: x[..., self.front], self.data)
+        # one flat index per queue, which gathers faster than `jnp.take_along_axis` over batch dimensions
+        front = jnp.asarray(self.front, jnp.int32)
+        idx = jnp.arange(front.size, dtype=jnp.int32).reshape(front.shape) * self.capacity + front
+        return jax.tree_map(lambda x: x.reshape(-1)[idx], self.data).unpack()
 
     def clear(self) -> "ActionQueue":
         return ActionQueue(self.data, jnp.int8(0), jnp.int8(0), jnp.int8(0))
@@ -314,8 +367,8 @@ class ActionQueue(NamedTuple):
         if not isinstance(other, ActionQueue):
             return False
         mask = jnp.arange(self.capacity) < self.count
-        self_data = self._get_sorted_data()
-        other_data = other._get_sorted_data()
+        self_data = self._get_sorted_data().unpack()
+        other_data = other._get_sorted_data().unpack()
         data_eq = [a == b for a, b in zip(self_data, other_data)]
         data_eq = reduce(lambda x, y: x & y, data_eq)  # and all attributes together
         data_eq = (data_eq | ~mask).all(-1)
@@ -324,7 +377,7 @@ class ActionQueue(NamedTuple):
 
 class JuxAction(NamedTuple):
     factory_action: Array  # int8[2, MAX_N_FACTORIES]
-    unit_action_queue: UnitAction  # UnitAction[2, MAX_N_UNITS, UNIT_ACTION_QUEUE_SIZE]
+    unit_action_queue: Union[UnitAction, PackedUnitAction]  # UnitAction[2, MAX_N_UNITS, UNIT_ACTION_QUEUE_SIZE]
     unit_action_queue_count: Array  # int8[2, MAX_N_UNITS]
     unit_action_queue_update: Array  # bool[2, MAX_N_UNITS]
 
@@ -370,20 +423,30 @@ class JuxAction(NamedTuple):
         unit_action_queue_count = np.zeros((2, state.MAX_N_UNITS), dtype=ActionQueue.__annotations__['count'])
         unit_action_queue_update = np.zeros((2, state.MAX_N_UNITS), dtype=np.bool_)
 
+        # look up ids on host, as one device lookup per unit dominates the conversion time
+        unit_ids, n_units, factory_ids, n_factories = jax.device_get((
+            state.units.unit_id,
+            state.n_units,
+            state.factories.unit_id,
+            state.n_factories,
+        ))
+        unit_id2idx = {int(unit_ids[p, i]): (p, i) for p in range(2) for i in range(n_units[p])}
+        factory_id2idx = {int(factory_ids[p, i]): (p, i) for p in range(2) for i in range(n_factories[p])}
+
         for player_id, player_actions in lux_action.items():
             player_id = int(player_id.split('_')[-1])
             for unit_id, action in player_actions.items():
                 if unit_id.startswith('factory_'):
                     unit_id = int(unit_id.split('_')[-1])
-                    pid, idx = state.factory_id2idx[unit_id]
+                    assert unit_id in factory_id2idx
+                    pid, idx = factory_id2idx[unit_id]
                     assert pid == player_id
-                    assert 0 <= idx < state.n_factories[player_id]
                     factory_action[player_id, idx] = action
                 elif unit_id.startswith('unit_'):
                     unit_id = int(unit_id.split('_')[-1])
-                    pid, idx = state.unit_id2idx[unit_id]
+                    assert unit_id in unit_id2idx
+                    pid, idx = unit_id2idx[unit_id]
                     assert pid == player_id
-                    assert 0 <= idx < state.n_units[player_id]
 
                     queue_size = len(action)
                     action = np.array(action)
@@ -410,6 +473,96 @@ class JuxAction(NamedTuple):
             unit_action_queue_update,
         )
 
+    @staticmethod
+    def from_spatial(
+        state,
+        unit_action: UnitAction,  # UnitAction[..., 2, H, W] or UnitAction[..., 2, H, W, Q']
+        factory_action: Array,  # int[..., 2, H, W]
+        unit_action_queue_count: Optional[Array] = None,  # int[..., 2, H, W]
+        unit_action_queue_update: Optional[Array] = None,  # bool[..., 2, H, W]
+    ) -> "JuxAction":
+        """
+        Decode actions laid out per map cell, as produced by spatial policy nets, into a `JuxAction`. Each unit
+        takes the action at its position, and each factory takes the action at its center. Actions in cells
+        without a unit or factory of that team are ignored. It is jittable, and works on batched states, in which
+        case all inputs have the same leading batch dimensions as the state.
+
+        Args:
+            state (State): the current game state.
+            unit_action (UnitAction): per-cell unit actions. Leaves of shape `[..., 2, H, W]` give a single action
+                per unit, and leaves of shape `[..., 2, H, W, Q']` with `Q' <= UNIT_ACTION_QUEUE_SIZE` give an
+                action queue per unit.
+            factory_action (Array): per-cell `FactoryAction`.
+            unit_action_queue_count (Array, optional): per-cell queue length. Defaults to the full length, 1 for
+                single actions and Q' for queues.
+            unit_action_queue_update (Array, optional): per-cell flag of whether to replace the unit's action
+                queue. Defaults to True for all units.
+
+        Returns:
+            JuxAction: the decoded actions.
+        """
+        if state.env_steps.ndim > 0:
+            return jax.vmap(JuxAction.from_spatial)(
+                state,
+                unit_action,
+                factory_action,
+                unit_action_queue_count,
+                unit_action_queue_update,
+            )
+
+        queue_size = state.env_cfg.UNIT_ACTION_QUEUE_SIZE
+        if unit_action.action_type.ndim == 3:
+            unit_action = jax.tree_map(lambda x: x[..., None], unit_action)
+        n_actions = unit_action.action_type.shape[-1]
+        assert n_actions <= queue_size, f"at most {queue_size} actions per unit, but got {n_actions}."
+
+        team_idx = jnp.arange(2)[:, None]  # int[2, 1]
+
+        def _gather(map: Array, pos: Position, fill_value) -> Array:
+            # positions of empty slots are out of map, and get the fill value.
+            return map.at[team_idx, pos.x, pos.y].get(mode='fill', fill_value=fill_value)
+
+        # unit actions
+        unit_mask = state.unit_mask  # bool[2, U]
+        unit_pos = state.units.pos
+        unit_action_queue = jax.tree_map(
+            lambda x, default: _gather(x, unit_pos, 0).astype(default.dtype),
+            unit_action,
+            UnitAction.do_nothing(),
+        )  # UnitAction[2, U, Q']
+        unit_action_queue = jax.tree_map(
+            lambda x, default: jnp.concatenate(
+                [x, jnp.full(x.shape[:-1] + (queue_size - n_actions, ), default, x.dtype)],
+                axis=-1,
+            ),
+            unit_action_queue,
+            UnitAction.do_nothing(),
+        )  # UnitAction[2, U, Q]
+
+        count_dtype = ActionQueue.__annotations__['count']
+        if unit_action_queue_count is None:
+            unit_action_queue_count = jnp.full(unit_mask.shape, n_actions, dtype=count_dtype)
+        else:
+            unit_action_queue_count = _gather(unit_action_queue_count, unit_pos, 0)
+            unit_action_queue_count = jnp.clip(unit_action_queue_count, 0, n_actions).astype(count_dtype)
+        if unit_action_queue_update is None:
+            unit_action_queue_update = unit_mask
+        else:
+            unit_action_queue_update = _gather(unit_action_queue_update, unit_pos, False).astype(jnp.bool_)
+            unit_action_queue_update = unit_action_queue_update & unit_mask
+        unit_action_queue_count = jnp.where(unit_action_queue_update, unit_action_queue_count, 0)
+
+        # factory actions
+        factory_action = _gather(factory_action, state.factories.pos, FactoryAction.DO_NOTHING)
+        factory_action = jnp.where(state.factory_mask, factory_action, FactoryAction.DO_NOTHING).astype(jnp.int8)
+
+        return JuxAction(
+            factory_action,
+            unit_action_queue,
+            unit_action_queue_count,
+            unit_action_queue_update,
+        )
+
     def to_lux(self: "JuxAction", state) -> Dict[str, Dict[str, Union[int, Array]]]:
         """Convert `JuxAction` to dict format that can be passed into `LuxAI_S2` object.
 
@@ -444,6 +597,7 @@ class JuxAction(NamedTuple):
             'player_0': {},
             'player_1': {},
         }
+        self = self._replace(unit_action_queue=self.unit_action_queue.unpack())
         self = jax.tree_map(lambda x: np.array(x), self)
 
         # factory action
@@ -531,6 +685,20 @@ class JuxAction(NamedTuple):
         return jax.tree_map(jux.torch.to_torch, self)
 
 
+class ActionMasks(NamedTuple):
+    """
+    Boolean masks of actions that pass validation in the current state, see `State.action_masks()`. Masks of
+    non-existent units and factories are all False.
+    """
+    move: Array  # bool[..., 2, U, 5], indexed by `Direction`. Moving to CENTER is always valid.
+    transfer: Array  # bool[..., 2, U, 5], indexed by `Direction`, only True if there is a receiver.
+    pickup: Array  # bool[..., 2, U, 5], indexed by `ResourceType`, only True if the factory has the resource.
+    dig: Array  # bool[..., 2, U]
+    self_destruct: Array  # bool[..., 2, U]
+    recharge: Array  # bool[..., 2, U]
+    factory: Array  # bool[..., 2, F, 3], indexed by `FactoryAction` (BUILD_LIGHT, BUILD_HEAVY, WATER)
+
+
 def bid_action_from_lux(lux_bid_action: Dict[str, Dict[str, Any]]) -> Tuple[Array, Array]:
     '''
     Convert a `LuxAI_S2` bid action to a format that `JuxEnv.step_bid()` can receive.
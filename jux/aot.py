@@ -0,0 +1,170 @@
+"""Ahead-of-time compilation of `JuxEnvBatch`, with an on-disk cache of compiled executables."""
+import hashlib
+import os
+import pickle
+import stat
+import warnings
+from typing import Callable, Dict, NamedTuple, Optional, Tuple
+
+import jax
+import jax.numpy as jnp
+import jaxlib
+from jax.experimental import serialize_executable
+
+import jux
+from jux.actions import JuxAction, bid_action_from_lux, factory_placement_action_from_lux
+
+DEFAULT_CACHE_DIR = os.environ.get('JUX_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'jux'))
+
+
+class CompiledJuxEnvBatch(NamedTuple):
+    """
+    Compiled executables of `JuxEnvBatch` methods for a fixed batch size. They are called like the
+    corresponding `JuxEnvBatch` methods, but only accept inputs of exactly the compiled shapes and dtypes, see
+    `abstract_args()`.
+    """
+    reset: Callable
+    reset_to_late_game: Callable
+    step_bid: Callable
+    step_factory_placement: Callable
+    step_late_game: Callable
+    step: Callable
+    step_late_game_auto_reset: Callable
+
+
+def abstract_args(env_batch, batch_size: int) -> Dict[str, Tuple]:
+    """
+    The abstract arguments (`jax.ShapeDtypeStruct`) each `JuxEnvBatch` method is compiled for.
+
+    Args:
+        env_batch (JuxEnvBatch): the batch environment.
+        batch_size (int): the number of envs B.
+
+    Returns:
+        Dict[str, Tuple]: method name -> tuple of abstract positional arguments.
+    """
+
+    def _batch(tree):
+        return jax.tree_map(lambda x: jax.ShapeDtypeStruct((batch_size, *jnp.shape(x)), jnp.result_type(x)), tree)
+
+    seeds = jax.ShapeDtypeStruct((batch_size, ), jnp.int32)
+    states = jax.eval_shape(lambda seeds: env_batch.reset(seeds), seeds)
+    bid_action = _batch(
+        bid_action_from_lux({
+            'player_0': {
+                'bid': 0,
+                'faction': 'AlphaStrike'
+            },
+            'player_1': {
+                'bid': 0,
+                'faction': 'AlphaStrike'
+            },
+        }))
+    placement_action = _batch(factory_placement_action_from_lux({'player_0': {}, 'player_1': {}}))
+    late_action = _batch(JuxAction.empty(env_batch.env_cfg, env_batch.buf_cfg))
+
+    return {
+        'reset': (seeds, ),
+        'reset_to_late_game': (seeds, ),
+        'step_bid': (states, *bid_action),
+        'step_factory_placement': (states, *placement_action),
+        'step_late_game': (states, late_action),
+        'step': (states, bid_action, placement_action, late_action),
+        'step_late_game_auto_reset': (states, late_action),
+    }
+
+
+def cache_key(env_batch, batch_size: int, name: str) -> str:
+    """
+    The cache key of a compiled method. It depends on the configs, the batch size, the jux, jax and jaxlib
+    versions, and the backend.
+    """
+    device = jax.devices()[0]
+    key = repr((
+        name,
+        batch_size,
+        env_batch.env_cfg,
+        env_batch.buf_cfg,
+        env_batch.donate_state,
+        env_batch.skip_unused_actions,
+        jux.__version__,
+        jax.__version__,
+        jaxlib.__version__,
+        device.platform,
+        device.device_kind,
+    ))
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def _lower(env_batch, name: str, args: Tuple):
+    if name in vars(env_batch):
+        # replaced by a jitted function that donates its input, see `JuxEnvBatch.__init__()`
+        return vars(env_batch)[name].lower(*args)
+    return getattr(type(env_batch), name).lower(env_batch, *args)
+
+
+def _is_trusted(path: str) -> bool:
+    # Unpickling runs arbitrary code, so only load files that no other user can have written.
+    st = os.stat(path)
+    if hasattr(os, 'getuid') and st.st_uid != os.getuid():
+        return False
+    return not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+
+def _load(path: str) -> Optional[Callable]:
+    if not _is_trusted(path):
+        warnings.warn(f"Cached executable {path} is not owned by the current user or is writable by others, "
+                      "skip loading it.")
+        return None
+    try:
+        with open(path, 'rb') as f:
+            payload, in_tree, out_tree = pickle.load(f)
+        return serialize_executable.deserialize_and_load(payload, in_tree, out_tree)
+    except Exception as e:
+        warnings.warn(f"Failed to load cached executable {path}: {e}")
+        return None
+
+
+def _save(path: str, compiled) -> None:
+    try:
+        serialized = serialize_executable.serialize(compiled)
+    except Exception as e:
+        # e.g. the CPU runtime of some jaxlib versions does not support serialization.
+        warnings.warn(f"Compiled executable is not serializable on this backend, skip caching: {e}")
+        return
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(serialized, f)
+    os.chmod(tmp_path, 0o600)
+    os.replace(tmp_path, path)  # atomic, so concurrent workers never read a partial file
+
+
+def precompile(env_batch, batch_size: int, cache_dir: Optional[str] = DEFAULT_CACHE_DIR) -> CompiledJuxEnvBatch:
+    """
+    Lower and compile `reset` and all `step_*` methods of a `JuxEnvBatch` for a fixed batch size. Compiled
+    executables are serialized to `cache_dir`, and later calls, also from other processes, load them from there
+    instead of compiling again. Cached files are only loaded if they are owned by the current user and not
+    writable by others, as loading unpickles them.
+
+    Args:
+        env_batch (JuxEnvBatch): the batch environment.
+        batch_size (int): the number of envs B.
+        cache_dir (str, optional): directory of the executable cache. Defaults to `$JUX_CACHE_DIR` or
+            `~/.cache/jux`. If None, the cache is disabled.
+
+    Returns:
+        CompiledJuxEnvBatch: the compiled methods.
+    """
+    compiled = {}
+    for name, args in abstract_args(env_batch, batch_size).items():
+        path = None
+        if cache_dir is not None:
+            path = os.path.join(cache_dir, f"{name}-{cache_key(env_batch, batch_size, name)}.pkl")
+            if os.path.exists(path):
+                compiled[name] = _load(path)
+        if compiled.get(name) is None:
+            compiled[name] = _lower(env_batch, name, args).compile()
+            if path is not None:
+                _save(path, compiled[name])
+    return CompiledJuxEnvBatch(**compiled)
@@ -0,0 +1,340 @@
+"""
+Throughput benchmark of `JuxEnvBatch.step_late_game()`, which reproduces the throughput tables in README on any
+backend, including CPU.
+
+It sweeps batch size x `MAX_N_UNITS` x map size. For each config, it measures the time to lower and compile the step
+apart from the steady-state steps per second. Actions are sampled by `random_policy()` from
+`REPLAY_ACTION_DISTRIBUTION`, the frequencies of action types in replays, among actions that pass validation. States
+are first played for some warm-up steps with the same policy, so that robots are built and busy.
+
+Optionally, the single-thread Python implementation `luxai_s2` is measured on a replay as the baseline of the
+relative throughput in README.
+
+Usage:
+    python -m jux.benchmark [--batch-size 1 64] [--max-n-units 100 1000] [--map-size 64] \
+        [--lux-replay tests/replay2.0_0.json.gz] [--output results.json]
+"""
+import argparse
+import json
+import platform
+import time
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+from jax import Array
+
+import jux
+import jux.utils
+from jux.actions import FactoryAction, JuxAction, UnitAction, UnitActionType
+from jux.config import EnvConfig, JuxBufferConfig
+from jux.env import JuxEnvBatch
+from jux.state import State
+
+
+class ActionDistribution(NamedTuple):
+    """
+    Probabilities of action types taken by `random_policy()`. Invalid actions are excluded before sampling, and
+    probabilities of the valid ones are renormalized.
+    """
+    unit: Sequence[float]  # float[7], indexed by `UnitActionType` + 1, i.e. DO_NOTHING first
+    factory: Sequence[float]  # float[4], indexed by `FactoryAction` + 1, i.e. DO_NOTHING first
+    update_queue: float  # probability that a unit replaces its action queue in a step
+
+
+# Frequencies of next actions of units and factories in the late game of `tests/replay2.0_*.json.gz`.
+REPLAY_ACTION_DISTRIBUTION = ActionDistribution(
+    unit=(0.12, 0.35, 0.12, 0.12, 0.055, 0.0, 0.235),
+    factory=(0.585, 0.012, 0.01, 0.393),
+    update_queue=0.65,
+)
+
+
+class BenchmarkResult(NamedTuple):
+    batch_size: int
+    max_n_units: int
+    map_size: int
+    compile_time: float  # seconds to lower and compile `step_late_game()`
+    step_time: float  # seconds per batched step in steady state
+    steps_per_second: float  # env steps per second, i.e. batch_size / step_time
+    mean_n_units: float  # mean number of units per team in the timed states
+    state_bytes_per_env: int
+
+
+def _sample(key: Array, p: Array, valid: Array) -> Array:
+    # sample an index along the last axis with probabilities `p` restricted to `valid`
+    logits = jnp.where(valid, jnp.log(p), -jnp.inf)
+    return jax.random.categorical(key, logits, axis=-1)
+
+
+def random_policy(dist: ActionDistribution, states: State, key: Array) -> JuxAction:
+    """
+    Sample a single repeated action per unit and an action per factory, among actions that pass validation (see
+    `State.action_masks()`), with action types distributed as `dist`. It is jittable and works on batched states.
+
+    Args:
+        dist (ActionDistribution): probabilities of action types.
+        states (State): batched states.
+        key (Array): a PRNGKey.
+
+    Returns:
+        JuxAction: batched actions.
+    """
+    masks = states.action_masks()
+    unit_mask = states.unit_mask
+    keys = jax.random.split(key, 6)
+
+    # unit action type
+    unit_valid = jnp.stack(
+        [
+            unit_mask,  # DO_NOTHING
+            masks.move[..., 1:].any(-1),
+            masks.transfer.any(-1),
+            masks.pickup.any(-1),
+            masks.dig,
+            masks.self_destruct,
+            masks.recharge,
+        ],
+        axis=-1,
+    )  # bool[B, 2, U, 7]
+    action_type = _sample(keys[0], jnp.asarray(dist.unit), unit_valid) - 1  # int[B, 2, U]
+
+    # direction and resource are uniform among valid ones
+    uniform = jnp.ones(5)
+    move_direction = _sample(keys[1], uniform, masks.move.at[..., 0].set(False))
+    transfer_direction = _sample(keys[2], uniform, masks.transfer)
+    direction = jnp.where(action_type == UnitActionType.TRANSFER, transfer_direction, move_direction)
+    pickup_resource = _sample(keys[3], uniform, masks.pickup)
+    transfer_resource = jnp.argmax(states.units.ledger, axis=-1)  # transfer the most abundant resource
+    resource_type = jnp.where(action_type == UnitActionType.PICKUP, pickup_resource, transfer_resource)
+    capacity = states.units.ledger_capacity(states.env_cfg.ROBOTS)  # int[B, 2, U, 5]
+    amount = jnp.take_along_axis(capacity, resource_type[..., None], axis=-1)[..., 0]
+    amount = jnp.minimum(amount, states.env_cfg.max_transfer_amount)
+
+    unit_action = UnitAction(
+        action_type=action_type,
+        direction=direction,
+        resource_type=resource_type,
+        amount=amount,
+        repeat=jnp.ones_like(action_type),
+        n=jnp.ones_like(action_type),
+    )
+    unit_action = UnitAction(*[x.astype(t) for x, t in zip(unit_action, UnitAction.__annotations__.values())])
+
+    # factory action
+    factory_valid = jnp.concatenate([states.factory_mask[..., None], masks.factory], axis=-1)  # bool[B, 2, F, 4]
+    factory_action = _sample(keys[4], jnp.asarray(dist.factory), factory_valid) - 1  # int[B, 2, F]
+    factory_action = jnp.where(states.factory_mask, factory_action, FactoryAction.DO_NOTHING)
+
+    empty = JuxAction.empty(
+        states.env_cfg,
+        JuxBufferConfig(MAX_N_UNITS=states.MAX_N_UNITS, MAX_N_FACTORIES=states.MAX_N_FACTORIES),
+    )
+    empty = jax.tree_map(lambda x: jnp.broadcast_to(x, states.env_steps.shape + x.shape), empty)
+    # DO_NOTHING is not a valid action in a queue, so units doing nothing get an empty queue
+    update = unit_mask & (jax.random.uniform(keys[5], unit_mask.shape) < dist.update_queue)
+    count = update & (action_type != UnitActionType.DO_NOTHING)
+    return empty._replace(
+        factory_action=factory_action.astype(empty.factory_action.dtype),
+        unit_action_queue=jax.tree_map(lambda q, a: q.at[..., 0].set(a), empty.unit_action_queue, unit_action),
+        unit_action_queue_count=count.astype(empty.unit_action_queue_count.dtype),
+        unit_action_queue_update=update,
+    )
+
+
+_random_policy_jitted = jax.jit(random_policy)
+
+
+def _nbytes(tree) -> int:
+    return sum(x.nbytes for x in jax.tree_util.tree_leaves(tree))
+
+
+def benchmark_step_late_game(
+    batch_size: int,
+    max_n_units: int = JuxBufferConfig.MAX_N_UNITS,
+    map_size: int = EnvConfig.map_size,
+    warmup: int = 100,
+    repeat: int = 20,
+    pool_size: int = 4,
+    seed: int = 0,
+    dist: ActionDistribution = REPLAY_ACTION_DISTRIBUTION,
+) -> BenchmarkResult:
+    """
+    Benchmark `JuxEnvBatch.step_late_game()` for one config.
+
+    Args:
+        batch_size (int): the number of envs B.
+        max_n_units (int): `JuxBufferConfig.MAX_N_UNITS`.
+        map_size (int): the map size, used for both `EnvConfig.map_size` and `JuxBufferConfig.MAP_SIZE`.
+        warmup (int): the number of steps played before timing.
+        repeat (int): the number of timed steps.
+        pool_size (int): the number of last warm-up (states, actions) pairs the timed steps cycle through.
+        seed (int): the seed of maps and actions.
+        dist (ActionDistribution): probabilities of action types.
+
+    Returns:
+        BenchmarkResult: the measurement.
+    """
+    env_batch = JuxEnvBatch(
+        env_cfg=EnvConfig(map_size=map_size),
+        buf_cfg=JuxBufferConfig(MAX_N_UNITS=max_n_units, MAP_SIZE=map_size),
+    )
+    key = jax.random.PRNGKey(seed)
+    states = env_batch.reset_to_late_game(jnp.arange(seed, seed + batch_size))
+    actions = _random_policy_jitted(dist, states, key)
+    jax.block_until_ready(actions)
+
+    start = time.perf_counter()
+    step = JuxEnvBatch.step_late_game.lower(env_batch, states, actions).compile()
+    compile_time = time.perf_counter() - start
+
+    pool = []
+    for key in jax.random.split(key, warmup + pool_size):
+        actions = _random_policy_jitted(dist, states, key)
+        pool = (pool + [(states, actions)])[-pool_size:]
+        states, _ = step(states, actions)
+    jax.block_until_ready(pool)
+
+    step(*pool[0])  # the first call of an executable may include one-off costs
+    start = time.perf_counter()
+    for i in range(repeat):
+        states, _ = step(*pool[i % len(pool)])
+    jax.block_until_ready(states)
+    step_time = (time.perf_counter() - start) / repeat
+
+    return BenchmarkResult(
+        batch_size=batch_size,
+        max_n_units=max_n_units,
+        map_size=map_size,
+        compile_time=compile_time,
+        step_time=step_time,
+        steps_per_second=batch_size / step_time,
+        mean_n_units=float(np.mean([np.asarray(s.n_units).mean() for s, _ in pool])),
+        state_bytes_per_env=_nbytes(pool[0][0]) // batch_size,
+    )
+
+
+def lux_steps_per_second(replay: str, max_steps: Optional[int] = None) -> float:
+    """
+    Measure steps per second of the single-thread Python implementation `luxai_s2` in the late game of a replay,
+    which is the baseline of the relative throughput.
+
+    Args:
+        replay (str): a replay file or url, see `jux.utils.load_replay()`.
+        max_steps (int, optional): stop after this many late game steps.
+
+    Returns:
+        float: steps per second.
+    """
+    lux_env, lux_actions = jux.utils.load_replay(replay)
+    n_steps, elapsed = 0, 0.0
+    for lux_act in lux_actions:
+        if max_steps is not None and n_steps >= max_steps:
+            break
+        late_game = lux_env.state.real_env_steps >= 0
+        start = time.perf_counter()
+        _, _, dones, _, _ = lux_env.step(lux_act)
+        if late_game:
+            elapsed += time.perf_counter() - start
+            n_steps += 1
+        if dones['player_0'] or dones['player_1']:
+            break
+    return n_steps / elapsed
+
+
+def environment() -> Dict[str, Any]:
+    """Versions and devices, recorded with results."""
+    return dict(
+        jux_version=jux.__version__,
+        jax_version=jax.__version__,
+        backend=jax.default_backend(),
+        devices=[d.device_kind for d in jax.devices()],
+        python_version=platform.python_version(),
+        processor=platform.processor() or platform.machine(),
+    )
+
+
+def run(
+    batch_sizes: Sequence[int],
+    max_n_units: Sequence[int],
+    map_sizes: Sequence[int],
+    lux_replay: Optional[str] = None,
+    callback: Optional[Callable[[Dict[str, Any]], None]] = None,
+    **kwargs,
+) -> Dict[str, Any]:
+    """
+    Run `benchmark_step_late_game()` on all combinations of configs.
+
+    Args:
+        batch_sizes, max_n_units, map_sizes: the sweep.
+        lux_replay (str, optional): if given, also measure the `luxai_s2` baseline on this replay, and report the
+            relative throughput of each config.
+        callback (Callable, optional): called with each result as soon as it is measured, e.g. to print progress.
+        kwargs: passed to `benchmark_step_late_game()`.
+
+    Returns:
+        Dict: JSON serializable results, with keys 'environment', 'lux_steps_per_second' and 'results'.
+    """
+    lux_sps = None if lux_replay is None else lux_steps_per_second(lux_replay)
+    results: List[Dict[str, Any]] = []
+    for map_size in map_sizes:
+        for n in max_n_units:
+            for batch_size in batch_sizes:
+                result = benchmark_step_late_game(batch_size, n, map_size, **kwargs)._asdict()
+                if lux_sps is not None:
+                    result['relative_throughput'] = result['steps_per_second'] / lux_sps
+                results.append(result)
+                if callback is not None:
+                    callback(result)
+    return dict(environment=environment(), lux_steps_per_second=lux_sps, results=results)
+
+
+def format_header() -> str:
+    return (f"{'map':>4} {'UNITS':>6} {'batch':>6} {'compile (s)':>12} {'step (ms)':>10} {'steps/s':>10} "
+            f"{'relative':>9} {'units':>6} {'KB/env':>7}")
+
+
+def format_row(result: Dict[str, Any]) -> str:
+    relative = result.get('relative_throughput')
+    relative = '' if relative is None else f"{relative:.2f}x"
+    return (f"{result['map_size']:>4} {result['max_n_units']:>6} {result['batch_size']:>6} "
+            f"{result['compile_time']:>12.2f} {result['step_time'] * 1e3:>10.3f} {result['steps_per_second']:>10.0f} "
+            f"{relative:>9} {result['mean_n_units']:>6.1f} {result['state_bytes_per_env'] // 1024:>7}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch-size', type=int, nargs='+', default=[1, 64])
+    parser.add_argument('--max-n-units', type=int, nargs='+', default=[100, 200, 400, 600, 800, 1000])
+    parser.add_argument('--map-size', type=int, nargs='+', default=[EnvConfig.map_size])
+    parser.add_argument('--warmup', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--lux-replay', type=str, default=None)
+    parser.add_argument('--output', type=str, default=None, help='write results as JSON to this file')
+    args = parser.parse_args()
+
+    env = environment()
+    print(f"backend: {env['backend']}, devices: {env['devices']}, jux {env['jux_version']}, jax {env['jax_version']}")
+    print(format_header())
+    report = run(
+        args.batch_size,
+        args.max_n_units,
+        args.map_size,
+        lux_replay=args.lux_replay,
+        callback=lambda result: print(format_row(result), flush=True),
+        warmup=args.warmup,
+        repeat=args.repeat,
+        seed=args.seed,
+    )
+    if report['lux_steps_per_second'] is not None:
+        print(f"luxai_s2 baseline: {report['lux_steps_per_second']:.1f} steps/s")
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,6 @@ from copy import copy
 from typing import Any, Dict, NamedTuple, Tuple
 
 import jax
-import numpy as np
 from luxai_s2.config import EnvConfig as LuxEnvConfig
 from luxai_s2.config import UnitConfig as LuxUnitConfig
 
@@ -143,17 +142,6 @@ class EnvConfig(NamedTuple):
         return EnvConfig(**lux_env_config)
 
     def to_lux(self) -> LuxEnvConfig:
-
-        def _to_lux(x):
-            if isinstance(x, jax.Array):
-                if len(x.shape) > 0:
-                    return np.array(x[0]).item()
-                else:
-                    return x.item()
-            else:
-                return x
-
-        self = jax.tree_map(_to_lux, self)
         self: Dict[str, Any] = self._asdict()
 
         self['ROBOTS'] = dict(
@@ -164,11 +152,19 @@ class EnvConfig(NamedTuple):
         return LuxEnvConfig(**self)
 
 
+# Configs are static metadata, not leaves, of any pytree containing them (e.g. `State.env_cfg`). They are not
+# traced under `jax.jit` or batched under `jax.vmap`, so game logic sees plain python scalars, and states in one
+# batch must share the same config.
+for _cfg_cls in (UnitConfig, EnvConfig):
+    jax.tree_util.register_pytree_node(_cfg_cls, lambda cfg: ((), cfg), lambda cfg, _: cfg)
+
 default = EnvConfig()
 
 
 class JuxBufferConfig(NamedTuple):
     MAX_N_UNITS: int = 1000
-    MAX_GLOBAL_ID: int = 1000 * 2
+    MAX_GLOBAL_ID: int = 1000 * 2  # deprecated and unused, units are found by `State.unit_id2idx()`
     MAX_N_FACTORIES: int = default.MAX_FACTORIES + 1
     MAP_SIZE: int = default.map_size
+    COMPACT_DTYPES: bool = False  # store bounded quantities of `State` narrowed, see `State.compact_dtypes()`
+    PACKED_ACTION_QUEUE: bool = False  # store action queues packed, see `State.pack_action_queues()`
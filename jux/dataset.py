@@ -0,0 +1,287 @@
+"""
+Replay-to-tensor datasets for imitation learning.
+
+`build_dataset()` converts replays into transitions of the late game, stepped with JUX instead of `luxai_s2`.
+Replays are converted in a process pool, and transitions are written into shards, each a directory of `.npy` files
+which can be memory-mapped with `load_shard()`:
+
+    actions.<field>.npy: leaves of `JuxAction[N]`, the actions taken in each transition, with `MAX_N_UNITS` of the
+        dataset, e.g. `actions.factory_action.npy` and `actions.unit_action_queue.action_type.npy`.
+    rewards.npy, dones.npy: `[N, 2]` rewards and dones after each transition.
+    episode.npy, step.npy: `[N]` index of the replay in the shard, and `real_env_steps` before each transition.
+    features.spatial.npy, features.scalars.npy: optional `[N, 2, ...]` `State.to_features()` of both players before
+        each transition.
+
+N is the number of transitions in the shard. Consecutive replays are packed into one shard up to `shard_size`
+transitions, and `index.json` lists the shards with their replays, and the replays that failed to convert.
+
+Usage:
+    python -m jux.dataset replays/ --out dataset/ [--features] [--max-n-units 200] [--workers 8]
+"""
+import argparse
+import functools
+import glob
+import itertools
+import json
+import multiprocessing
+import os
+import os.path as osp
+import time
+import traceback
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import jax
+import numpy as np
+
+import jux.tree_util
+import jux.utils
+from jux.actions import JuxAction
+from jux.config import EnvConfig, JuxBufferConfig
+from jux.env import JuxEnv
+from jux.state import Features, State
+
+INDEX_FILE = 'index.json'
+
+
+class Transitions(NamedTuple):
+    """Transitions of a shard. Leaves are `np.ndarray`s or `np.memmap`s with leading dimension N."""
+    actions: JuxAction  # JuxAction[N]
+    rewards: np.ndarray  # int[N, 2]
+    dones: np.ndarray  # bool[N, 2]
+    episode: np.ndarray  # int32[N]
+    step: np.ndarray  # int32[N]
+    features: Optional[Features] = None  # Features[N, 2]
+
+
+def _leaf_name(path) -> str:
+    return '.'.join(k.name for k in path)
+
+
+def _flatten(prefix: str, tree) -> Dict[str, np.ndarray]:
+    return {f"{prefix}.{_leaf_name(path)}": x for path, x in jax.tree_util.tree_flatten_with_path(tree)[0]}
+
+
+def _unflatten(prefix: str, arrays: Dict[str, np.ndarray], template):
+    paths, treedef = jax.tree_util.tree_flatten_with_path(template)
+    return jax.tree_util.tree_unflatten(treedef, [arrays[f"{prefix}.{_leaf_name(p)}"] for p, _ in paths])
+
+
+@functools.partial(jax.jit, static_argnums=(0, 3))
+def _transition(env: JuxEnv, state: State, actions: JuxAction, features: bool):
+    obs = jux.tree_util.batch_into_leaf([state.to_features(0), state.to_features(1)]) if features else None
+    state, (_, rewards, dones, _) = env.step_late_game(state, actions)
+    return state, rewards, dones, obs
+
+
+def convert_replay(
+    replay: str,
+    buf_cfg: JuxBufferConfig = JuxBufferConfig(),
+    features: bool = False,
+    max_steps: Optional[int] = None,
+) -> Dict[str, np.ndarray]:
+    """
+    Convert the late game of a replay into transitions. Bidding and factory placement are played with `luxai_s2`,
+    and the rest of the game with `JuxEnv.step_late_game()`.
+
+    Args:
+        replay (str): a replay file, see `jux.utils.load_replay()`.
+        buf_cfg (JuxBufferConfig): the buffer config. `MAX_N_UNITS` must fit all units of the replay.
+        features (bool): whether to encode `State.to_features()` of both players before each step.
+        max_steps (int, optional): convert at most this many steps.
+
+    Returns:
+        Dict[str, np.ndarray]: file name (without `.npy`) -> array, see the module docstring. 'episode' is all 0.
+    """
+    lux_env, lux_actions = jux.utils.load_replay(replay)
+    while lux_env.state.real_env_steps < 0:
+        lux_env.step(next(lux_actions))
+    state = State.from_lux(lux_env.state, buf_cfg)
+    env = JuxEnv(state.env_cfg, buf_cfg)
+
+    actions, rewards, dones, steps, obs = [], [], [], [], []
+    for lux_act in itertools.islice(lux_actions, max_steps):
+        if (np.asarray(state.n_units) >= state.MAX_N_UNITS).any():
+            raise ValueError(f"Units of {replay} may not fit in MAX_N_UNITS={state.MAX_N_UNITS}.")
+        action = JuxAction.from_lux(state, jux.utils.live_actions(state, lux_act))
+        steps.append(int(state.real_env_steps))
+        state, reward, done, feature = _transition(env, state, action, features)
+        actions.append(action)
+        rewards.append(reward)
+        dones.append(done)
+        obs.append(feature)
+        if done.any():
+            break
+
+    actions = jax.device_get(jux.tree_util.batch_into_leaf(actions))
+    # `JuxAction.from_lux()` leaves slots beyond the queue length uninitialized
+    slot = np.arange(state.UNIT_ACTION_QUEUE_SIZE)
+    in_queue = slot < actions.unit_action_queue_count[..., None]
+    actions = actions._replace(unit_action_queue=jax.tree_map(
+        lambda x: np.where(in_queue, x, 0).astype(x.dtype),
+        actions.unit_action_queue,
+    ))
+    arrays = {
+        **_flatten('actions', actions),
+        'rewards': np.stack(jax.device_get(rewards)),
+        'dones': np.stack(jax.device_get(dones)),
+        'episode': np.zeros(len(steps), np.int32),
+        'step': np.array(steps, np.int32),
+    }
+    if features:
+        arrays.update(_flatten('features', jax.device_get(jux.tree_util.batch_into_leaf(obs))))
+    return arrays
+
+
+def _convert_worker(replay: str, buf_cfg: JuxBufferConfig, features: bool,
+                    max_steps: Optional[int]) -> Tuple[str, Optional[Dict[str, np.ndarray]], Optional[str]]:
+    # one broken replay should not stop the whole dataset
+    try:
+        return replay, convert_replay(replay, buf_cfg, features, max_steps), None
+    except Exception:
+        return replay, None, traceback.format_exc()
+
+
+def _write_shard(path: str, episodes: List[Dict[str, np.ndarray]]):
+    os.makedirs(path, exist_ok=True)
+    for name in episodes[0]:
+        if name == 'episode':
+            array = np.concatenate([np.full(len(e['episode']), i, np.int32) for i, e in enumerate(episodes)])
+        else:
+            array = np.concatenate([e[name] for e in episodes])
+        np.save(osp.join(path, f"{name}.npy"), array)
+
+
+def find_replays(replay_dir: str) -> List[str]:
+    """Replay files in `replay_dir`, i.e. `*.json` and `*.json.gz`, sorted by name."""
+    return sorted(glob.glob(osp.join(replay_dir, '*.json')) + glob.glob(osp.join(replay_dir, '*.json.gz')))
+
+
+def build_dataset(
+    replays: Sequence[str],
+    out_dir: str,
+    buf_cfg: JuxBufferConfig = JuxBufferConfig(),
+    features: bool = False,
+    shard_size: int = 100_000,
+    n_workers: Optional[int] = None,
+    max_steps: Optional[int] = None,
+) -> Dict:
+    """
+    Convert replays with `convert_replay()` in a process pool, and write the transitions into shards.
+
+    Args:
+        replays (Sequence[str]): replay files, e.g. `find_replays(replay_dir)`.
+        out_dir (str): the output directory.
+        buf_cfg (JuxBufferConfig): the buffer config, shared by all shards.
+        features (bool): whether to write `State.to_features()` of both players.
+        shard_size (int): the number of transitions per shard, beyond which a new shard is started. A replay is
+            never split across shards. Replays of different map sizes go to different shards.
+        n_workers (int, optional): the number of worker processes. Defaults to the number of CPUs. If 0, replays
+            are converted in this process.
+        max_steps (int, optional): convert at most this many steps per replay.
+
+    Returns:
+        Dict: the content of `index.json`.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    n_workers = os.cpu_count() if n_workers is None else n_workers
+    convert = functools.partial(_convert_worker, buf_cfg=buf_cfg, features=features, max_steps=max_steps)
+
+    index = dict(buf_cfg=buf_cfg._asdict(), features=features, shards=[], failed={})
+    pending: List[Dict[str, np.ndarray]] = []
+    pending_replays: List[str] = []
+
+    def _flush():
+        if not pending:
+            return
+        name = f"shard_{len(index['shards']):05d}"
+        _write_shard(osp.join(out_dir, name), pending)
+        n_steps = sum(len(e['step']) for e in pending)
+        index['shards'].append(dict(path=name, n_steps=n_steps, replays=list(pending_replays)))
+        pending.clear()
+        pending_replays.clear()
+
+    def _signature(arrays):
+        return {k: v.shape[1:] for k, v in arrays.items()}
+
+    if n_workers == 0:
+        results = map(convert, replays)
+    else:
+        # JAX is not fork-safe, so workers are spawned
+        pool = multiprocessing.get_context('spawn').Pool(n_workers)
+        results = pool.imap(convert, replays)
+    try:
+        for replay, arrays, error in results:
+            if error is not None:
+                index['failed'][replay] = error
+                continue
+            if pending and (_signature(arrays) != _signature(pending[0])
+                            or sum(len(e['step']) for e in pending) + len(arrays['step']) > shard_size):
+                _flush()
+            pending.append(arrays)
+            pending_replays.append(replay)
+        _flush()
+    finally:
+        if n_workers != 0:
+            pool.close()
+            pool.join()
+
+    with open(osp.join(out_dir, INDEX_FILE), 'w') as f:
+        json.dump(index, f, indent=2)
+    return index
+
+
+def load_shard(path: str, mmap_mode: Optional[str] = 'r') -> Transitions:
+    """
+    Load a shard written by `build_dataset()`.
+
+    Args:
+        path (str): the shard directory.
+        mmap_mode (str, optional): passed to `np.load()`. Defaults to 'r', i.e. read-only memory maps. If None,
+            arrays are read into memory.
+
+    Returns:
+        Transitions: transitions of the shard.
+    """
+    arrays = {
+        osp.basename(f)[:-len('.npy')]: np.load(f, mmap_mode=mmap_mode)
+        for f in glob.glob(osp.join(path, '*.npy'))
+    }
+    # only the tree structure of the template is used
+    actions = _unflatten('actions', arrays, JuxAction.empty(EnvConfig(), JuxBufferConfig(MAX_N_UNITS=1)))
+    features = None
+    if 'features.spatial' in arrays:
+        features = Features(arrays['features.spatial'], arrays['features.scalars'])
+    return Transitions(actions, arrays['rewards'], arrays['dones'], arrays['episode'], arrays['step'], features)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('replays', nargs='+', help='replay directories or files')
+    parser.add_argument('--out', required=True)
+    parser.add_argument('--features', action='store_true')
+    parser.add_argument('--max-n-units', type=int, default=JuxBufferConfig.MAX_N_UNITS)
+    parser.add_argument('--shard-size', type=int, default=100_000)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--max-steps', type=int, default=None)
+    args = parser.parse_args()
+
+    replays = [r for arg in args.replays for r in (find_replays(arg) if osp.isdir(arg) else [arg])]
+    start = time.perf_counter()
+    index = build_dataset(
+        replays,
+        args.out,
+        JuxBufferConfig(MAX_N_UNITS=args.max_n_units),
+        features=args.features,
+        shard_size=args.shard_size,
+        n_workers=args.workers,
+        max_steps=args.max_steps,
+    )
+    n_steps = sum(shard['n_steps'] for shard in index['shards'])
+    print(f"converted {len(replays) - len(index['failed'])}/{len(replays)} replays into {len(index['shards'])} "
+          f"shards of {n_steps} transitions in {time.perf_counter() - start:.1f}s")
+    for replay, error in index['failed'].items():
+        print(f"failed: {replay}\n{error}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,34 +1,125 @@
 from functools import partial
-from typing import Dict, Tuple
+from typing import Any, Callable, Dict, NamedTuple, Optional, Sequence, Tuple
 
 import jax
 import jax.numpy as jnp
+import numpy as np
 from jax import Array
 from luxai_s2 import LuxAI_S2
 
+import jux.aot
+import jux.tree_util
 from jux.actions import JuxAction
 from jux.config import EnvConfig, JuxBufferConfig
+from jux.map import Board
 from jux.state import State
+from jux.utils import INT32_MAX
+
+
+class Trajectory(NamedTuple):
+    """Stacked outputs of `JuxEnvBatch.rollout()`. All leaves have a leading time axis of length `n_steps`."""
+    actions: JuxAction  # JuxAction[T, B]
+    rewards: Array  # int[T, B, 2]
+    dones: Array  # bool[T, B, 2]
+    features: Any = None  # output of feature_fn, stacked along time axis, or None
+
+
+def _donate_state(env, methods: Dict[str, Dict]) -> None:
+    """Replace jitted methods of `env` by versions that donate their first argument (the input `State`)."""
+    for name, jit_kwargs in methods.items():
+        fn = getattr(type(env), name).__wrapped__
+        setattr(env, name, jax.jit(partial(fn, env), donate_argnums=0, **jit_kwargs))
 
 
 class JuxEnv:
+    """
+    Args:
+        env_cfg (EnvConfig): the game config.
+        buf_cfg (JuxBufferConfig): the buffer config.
+        donate_state (bool): If True, `step_bid()`, `step_factory_placement()`, `step_late_game()` and `step()` donate
+            the buffers of the input `State` to XLA, so the new state is written in place of the old one, and
+            peak memory is roughly halved. The input state, and any observation returned with it, becomes
+            invalid after the call, and accessing it raises an error. `reset()` takes no state, so it has
+            nothing to donate.
+        skip_unused_actions (bool): If True, `step_late_game()` skips the handlers of self-destruct, factory build,
+            transfer and pickup actions with `jax.lax.cond` when no unit or factory takes the action. It does not
+            change results, but saves time when these actions are rare.
+    """
     metadata = {"render.modes": ["human", "rgb_array"], "name": "jux_v0"}
-
-    def __init__(self, env_cfg=EnvConfig(), buf_cfg=JuxBufferConfig()) -> None:
+    _DONATE_STATE_METHODS = {
+        'step_bid': {},
+        'step_factory_placement': {},
+        'step_late_game': {},
+        'step': {},
+    }
+
+    def __init__(
+        self,
+        env_cfg=EnvConfig(),
+        buf_cfg=JuxBufferConfig(),
+        donate_state: bool = False,
+        skip_unused_actions: bool = False,
+    ) -> None:
         self.env_cfg = env_cfg
         self.buf_cfg = buf_cfg
+        self.donate_state = donate_state
+        self.skip_unused_actions = skip_unused_actions
         self._dummy_env = LuxAI_S2()  # for rendering
+        if donate_state:
+            _donate_state(self, self._DONATE_STATE_METHODS)
 
     def __hash__(self) -> int:
-        return hash((JuxEnv, self.env_cfg, self.buf_cfg))
+        return hash((JuxEnv, self.env_cfg, self.buf_cfg, self.donate_state, self.skip_unused_actions))
 
     def __eq__(self, __o: object) -> bool:
-        return isinstance(__o, JuxEnv) and self.env_cfg == __o.env_cfg and self.buf_cfg == __o.buf_cfg
+        return (isinstance(__o, JuxEnv) and self.env_cfg == __o.env_cfg and self.buf_cfg == __o.buf_cfg
+                and self.donate_state == __o.donate_state and self.skip_unused_actions == __o.skip_unused_actions)
 
     @partial(jax.jit, static_argnums=(0, ))
     def reset(self, seed: int) -> State:
         return State.new(seed, self.env_cfg, self.buf_cfg)
 
+    @partial(jax.jit, static_argnums=(0, ))
+    def reset_to_late_game(self, seed: int) -> State:
+        """Reset the environment, and play the bidding and factory placement phases with a default policy, so that
+        the returned state is ready for `step_late_game()`.
+
+        Both players bid 0 with faction `AlphaStrike`. Factories are placed on uniformly sampled valid spawns, and
+        each player splits its remaining water and metal evenly among the factories it has not placed yet. The
+        sampling is seeded by `state.rng_state`, so the result only depends on `seed`.
+
+        Args:
+            seed (int): the seed for map generation.
+
+        Returns:
+            State: a state with `state.real_env_steps == 0`.
+        """
+        state = self.reset(seed)
+        state, _ = self.step_bid(state, jnp.zeros(2, dtype=jnp.int32), jnp.zeros(2, dtype=jnp.int8))
+
+        def _place_factory(state: State) -> State:
+            player = state.next_player
+            key = jax.random.fold_in(state.rng_state, state.env_steps)
+            valid_spawns_mask = state.board.valid_spawns_mask
+            idx = jax.random.categorical(key, jnp.where(valid_spawns_mask.ravel(), 0.0, -jnp.inf))
+            spawn = jnp.array(jnp.divmod(idx, valid_spawns_mask.shape[1]))
+
+            factories_to_place = jnp.maximum(state.teams.factories_to_place[player], 1)
+            water = state.teams.init_water[player] // factories_to_place
+            metal = state.teams.init_metal[player] // factories_to_place
+
+            state, _ = self.step_factory_placement(
+                state,
+                jnp.array([spawn, spawn]),
+                jnp.array([water, water]),
+                jnp.array([metal, metal]),
+            )
+            return state
+
+        # every placement step increases env_steps, so the loop always terminates.
+        state = jax.lax.while_loop(lambda state: state.real_env_steps < 0, _place_factory, state)
+        return state
+
     @partial(jax.jit, static_argnums=(0, ))
     def step_bid(self, state: State, bid: Array, faction: Array) -> Tuple[State, Tuple[Dict, Array, Array, Dict]]:
         """Step the first bidding step.
@@ -138,13 +229,21 @@ class JuxEnv:
             dones (Array): bool[2], done indicator. If game ends, then `dones[0] == dones[1] == True`
             infos (Dict): empty dict, because there is no extra info.
         """
-        state = state._step_late_game(actions)
+        return self._step_late_game(state, actions)
+
+    def _step_late_game(self,
+                        state: State,
+                        actions: JuxAction,
+                        batch_axis_name: Optional[str] = None) -> Tuple[State, Tuple[Dict, Array, Array, Dict]]:
+        # `batch_axis_name` is only given by `JuxEnvBatch`, which calls this under a `jax.vmap` of that name.
+        # See `State._step_late_game()`.
+        state = state._step_late_game(actions, self.skip_unused_actions, batch_axis_name)
 
         # perfect info game, so observations = state
         observations = {'player_0': state, 'player_1': state}
 
-        # rewards = lichen. There is 1000 penalty for losing all factories.
-        rewards = state.team_lichen_score() - (state.n_factories == 0) * 1000
+        # rewards = lichen. A player losing all factories gets -1000 instead.
+        rewards = jnp.where(state.n_factories == 0, -1000, state.team_lichen_score())
 
         # info is empty
         infos = {'player_0': {}, 'player_1': {}}
@@ -155,6 +254,71 @@ class JuxEnv:
 
         return state, (observations, rewards, dones, infos)
 
+    @partial(jax.jit, static_argnums=(0, ))
+    def step(
+        self,
+        state: State,
+        bid_action: Tuple[Array, Array],
+        placement_action: Tuple[Array, Array, Array],
+        late_action: JuxAction,
+    ) -> Tuple[State, Tuple[Dict, Array, Array, Dict]]:
+        """
+        Step the game in any phase. The phase is decided by `state.env_steps`, and only the action of the current
+        phase is used, the other two are ignored. It is dispatched with `jax.lax.switch`, so under `jax.vmap` envs
+        in the same batch may be in different phases.
+
+        Args:
+            state (State): The current game state.
+            bid_action (Tuple[Array, Array]): (bid, faction), see `step_bid()`.
+            placement_action (Tuple[Array, Array, Array]): (spawn, water, metal), see `step_factory_placement()`.
+            late_action (JuxAction): see `step_late_game()`.
+
+        Returns:
+            state, (observations, rewards, dones, infos)
+
+            See `step_late_game()`. In bidding and factory placement phases, rewards are 0 and dones are False.
+        """
+        return self._step(state, bid_action, placement_action, late_action)
+
+    def _step(
+        self,
+        state: State,
+        bid_action: Tuple[Array, Array],
+        placement_action: Tuple[Array, Array, Array],
+        late_action: JuxAction,
+        batch_axis_name: Optional[str] = None,
+    ) -> Tuple[State, Tuple[Dict, Array, Array, Dict]]:
+        phase = jnp.where(
+            state.env_cfg.BIDDING_SYSTEM & (state.env_steps == 0),
+            0,
+            jnp.where(state.real_env_steps < 0, 1, 2),
+        )
+        reward_dtype = Board.__annotations__['lichen']
+
+        def _step(step_fn, *args):
+
+            def _fn(state):
+                state, (_, rewards, dones, _) = step_fn(state, *args)
+                return state, rewards.astype(reward_dtype), dones
+
+            return _fn
+
+        state, rewards, dones = jax.lax.switch(
+            phase,
+            [
+                _step(self.step_bid, *bid_action),
+                _step(self.step_factory_placement, *placement_action),
+                _step(partial(self._step_late_game, batch_axis_name=batch_axis_name), late_action),
+            ],
+            state,
+        )
+
+        # perfect info game, so observations = state
+        observations = {'player_0': state, 'player_1': state}
+        infos = {'player_0': {}, 'player_1': {}}
+
+        return state, (observations, rewards, dones, infos)
+
     def render(self, state: State, mode='human', **kwargs):
         """render the environment.
 
@@ -186,6 +350,27 @@ class JuxEnv:
 
 
 class JuxEnvBatch:
+    """
+    Batched version of `JuxEnv`. All methods take and return states with a leading batch dimension.
+
+    Args:
+        env_cfg (EnvConfig): the game config.
+        buf_cfg (JuxBufferConfig): the buffer config.
+        donate_state (bool): If True, `step_bid()`, `step_factory_placement()`, `step_late_game()`, `step()`,
+            `step_late_game_auto_reset()` and `rollout()` donate the buffers of the input states. See `JuxEnv`
+            for the contract.
+        skip_unused_actions (bool): If True, a rarely used action handler is skipped when no env in the batch
+            takes the action. See `JuxEnv`.
+    """
+    AXIS_NAME = 'batch'
+    _DONATE_STATE_METHODS = {
+        'step_bid': {},
+        'step_factory_placement': {},
+        'step_late_game': {},
+        'step': {},
+        'step_late_game_auto_reset': {},
+        'rollout': dict(static_argnums=(1, 3), static_argnames=('feature_fn', 'auto_reset')),
+    }
 
     @property
     def env_cfg(self) -> EnvConfig:
@@ -195,25 +380,74 @@ class JuxEnvBatch:
     def buf_cfg(self) -> JuxBufferConfig:
         return self.jux_env.buf_cfg
 
-    def __init__(self, env_cfg=EnvConfig(), buf_cfg=JuxBufferConfig()) -> None:
-        self.jux_env = JuxEnv(env_cfg, buf_cfg)
+    @property
+    def donate_state(self) -> bool:
+        return self.jux_env.donate_state
+
+    @property
+    def skip_unused_actions(self) -> bool:
+        return self.jux_env.skip_unused_actions
+
+    def __init__(
+        self,
+        env_cfg=EnvConfig(),
+        buf_cfg=JuxBufferConfig(),
+        donate_state: bool = False,
+        skip_unused_actions: bool = False,
+    ) -> None:
+        self.jux_env = JuxEnv(env_cfg, buf_cfg, donate_state, skip_unused_actions)
+        if donate_state:
+            _donate_state(self, self._DONATE_STATE_METHODS)
 
     def __hash__(self) -> int:
-        return hash((JuxEnvBatch, self.jux_env.env_cfg, self.jux_env.buf_cfg))
+        return hash((JuxEnvBatch, self.jux_env))
 
     def __eq__(self, __o: object) -> bool:
-        return isinstance(__o, JuxEnvBatch) and self.env_cfg == __o.env_cfg and self.buf_cfg == __o.buf_cfg
+        return isinstance(__o, JuxEnvBatch) and self.jux_env == __o.jux_env
 
-    @partial(jax.jit, static_argnums=(0, ))
-    def reset(self, seeds: Array) -> Tuple[State, Tuple[Dict, int, bool, Dict]]:
+    def precompile(self, batch_size: int, cache_dir: Optional[str] = jux.aot.DEFAULT_CACHE_DIR) \
+                                                                        -> jux.aot.CompiledJuxEnvBatch:
+        """
+        Compile `reset()`, `reset_to_late_game()` and all `step_*()` methods ahead of time for `batch_size` envs,
+        using an on-disk executable cache. See `jux.aot.precompile()`.
+
+        Example:
+            >>> env_batch = JuxEnvBatch()
+            >>> compiled = env_batch.precompile(batch_size=16)
+            >>> states = compiled.reset_to_late_game(jnp.arange(16))
+            >>> states, (observations, rewards, dones, infos) = compiled.step_late_game(states, actions)
+        """
+        return jux.aot.precompile(self, batch_size, cache_dir)
+
+    @partial(jax.jit, static_argnums=(0, 2))
+    def reset(self, seeds: Array, same_factories_per_team: bool = True) -> State:
+        """
+        Args:
+            seeds (Array): int[B], seeds for map generation.
+            same_factories_per_team (bool): If True, all envs share `factories_per_team` of the first env, so
+                that they leave the factory placement phase at the same step, as required by `step_bid()` and
+                `step_factory_placement()` being called in lockstep. Set it to False if envs are stepped with
+                `step()`, which handles envs in different phases.
+
+        Returns:
+            State: batched initial states.
+        """
         states = jax.vmap(self.jux_env.reset)(seeds)
 
-        # for env in the same batch, they must have same state.board.factories_per_team,
-        # so that they have same number of steps to place factory
-        factories_per_team = states.board.factories_per_team.at[:].set(states.board.factories_per_team[0])
-        states = states._replace(board=states.board._replace(factories_per_team=factories_per_team))
+        if same_factories_per_team:
+            # for env in the same batch, they must have same state.board.factories_per_team,
+            # so that they have same number of steps to place factory
+            factories_per_team = states.board.factories_per_team.at[:].set(states.board.factories_per_team[0])
+            states = states._replace(board=states.board._replace(factories_per_team=factories_per_team))
         return states
 
+    @partial(jax.jit, static_argnums=(0, ))
+    def reset_to_late_game(self, seeds: Array) -> State:
+        """Batched version of `JuxEnv.reset_to_late_game()`. Unlike `reset()`, envs in the batch may have different
+        `factories_per_team`, because the bidding and factory placement phases are already finished.
+        """
+        return jax.vmap(self.jux_env.reset_to_late_game)(seeds)
+
     @partial(jax.jit, static_argnums=(0, ))
     def step_bid(self, states: State, bid: Array, faction: Array) -> Tuple[State, Tuple[Dict, Array, Array, Dict]]:
         states, (observations, rewards, dones, infos) = jax.vmap(self.jux_env.step_bid)(states, bid, faction)
@@ -232,5 +466,364 @@ class JuxEnvBatch:
 
     @partial(jax.jit, static_argnums=(0, ))
     def step_late_game(self, states: State, actions: JuxAction) -> Tuple[State, Tuple[Dict, Array, Array, Dict]]:
-        states, (observations, rewards, dones, infos) = jax.vmap(self.jux_env.step_late_game)(states, actions)
+        states, (observations, rewards, dones, infos) = jax.vmap(
+            partial(self.jux_env._step_late_game, batch_axis_name=self.AXIS_NAME),
+            axis_name=self.AXIS_NAME,
+        )(states, actions)
         return states, (observations, rewards, dones, infos)
+
+    @partial(jax.jit, static_argnums=(0, ))
+    def step(
+        self,
+        states: State,
+        bid_action: Tuple[Array, Array],
+        placement_action: Tuple[Array, Array, Array],
+        late_action: JuxAction,
+    ) -> Tuple[State, Tuple[Dict, Array, Array, Dict]]:
+        """
+        Batched version of `JuxEnv.step()`. Envs in the batch may be in different phases. Note that under
+        `jax.vmap`, `jax.lax.switch` evaluates all three phases for every env, so stepping a batch that is
+        entirely in the late game phase is faster with `step_late_game()`.
+        """
+        return jax.vmap(
+            partial(self.jux_env._step, batch_axis_name=self.AXIS_NAME),
+            axis_name=self.AXIS_NAME,
+        )(states, bid_action, placement_action, late_action)
+
+    @partial(jax.jit, static_argnums=(0, ))
+    def step_late_game_auto_reset(self, states: State,
+                                  actions: JuxAction) -> Tuple[State, Tuple[Dict, Array, Array, Dict]]:
+        """
+        Same as `step_late_game()`, but every env that is done after this step is reset by
+        `JuxEnv.reset_to_late_game()` in the same jitted call, so envs in the batch can end episodes at
+        different steps without leaving the device.
+
+        The seed of a reset env is drawn from the `rng_state` of its terminal state. Resetting is skipped as a
+        whole if no env in the batch is done.
+
+        Args:
+            states (State): current game states.
+            actions (JuxAction): actions for all envs, see `JuxEnv.step_late_game()`.
+
+        Returns:
+            states, (observations, rewards, dones, infos)
+
+            states (State): new game states. Done envs are replaced by fresh states with `real_env_steps == 0`.
+            observations (Dict): observations of the terminal step, i.e. the states before reset.
+            rewards (Array): int[B, 2], rewards of this step. For done envs, they are the final rewards.
+            dones (Array): bool[B, 2], done indicator of this step.
+            infos (Dict): empty dict, because there is no extra info.
+        """
+        states, (observations, rewards, dones, infos) = self.step_late_game(states, actions)
+        done = dones[:, 0]
+
+        def _reset_done_envs(states: State) -> State:
+            keys = jax.vmap(jax.random.split)(states.rng_state)[:, 0]
+            seeds = jax.vmap(lambda key: jax.random.randint(key, (), 0, INT32_MAX))(keys)
+            new_states = jax.vmap(self.jux_env.reset_to_late_game)(seeds)
+            return jux.tree_util.tree_where(done, new_states, states)
+
+        states = jax.lax.cond(done.any(), _reset_done_envs, lambda states: states, states)
+        return states, (observations, rewards, dones, infos)
+
+    @partial(jax.jit, static_argnums=(0, 2, 4), static_argnames=('feature_fn', 'auto_reset'))
+    def rollout(
+        self,
+        states: State,
+        policy_fn: Callable,
+        params: Any,
+        n_steps: int,
+        key: Optional[Array] = None,
+        feature_fn: Optional[Callable[[State], Any]] = None,
+        auto_reset: bool = False,
+    ) -> Tuple[State, Trajectory]:
+        """
+        Run `n_steps` late game steps in a single compiled call with `jax.lax.scan`. At each step, actions are
+        generated by `policy_fn` and fed to `step_late_game()` (or `step_late_game_auto_reset()` if `auto_reset`).
+
+        `policy_fn`, `n_steps` and `feature_fn` are static, so they must be hashable. Passing a new function
+        object (e.g. a new lambda) triggers recompilation, while new `params` do not.
+
+        Args:
+            states (State): current game states.
+            policy_fn (Callable): a jittable function. If `key` is None, it is called as
+                `policy_fn(params, states)`, otherwise as `policy_fn(params, states, key)` with a fresh key
+                for each step. It must return a batched `JuxAction`.
+            params (Any): a pytree passed to `policy_fn`, e.g. network weights.
+            n_steps (int): number of steps T.
+            key (Array, optional): a PRNGKey, split into one key per step for `policy_fn`.
+            feature_fn (Callable, optional): a jittable function mapping the states before each step to
+                observation features, which are stacked into `Trajectory.features`.
+            auto_reset (bool): whether to reset finished envs, see `step_late_game_auto_reset()`.
+
+        Returns:
+            states, trajectory
+
+            states (State): game states after `n_steps` steps.
+            trajectory (Trajectory): stacked actions, rewards, dones and features.
+        """
+        step_fn = self.step_late_game_auto_reset if auto_reset else self.step_late_game
+        keys = None if key is None else jax.random.split(key, n_steps)
+
+        def _step(states: State, key: Optional[Array]) -> Tuple[State, Trajectory]:
+            features = None if feature_fn is None else feature_fn(states)
+            actions = policy_fn(params, states) if key is None else policy_fn(params, states, key)
+            states, (_, rewards, dones, _) = step_fn(states, actions)
+            return states, Trajectory(actions, rewards, dones, features)
+
+        return jax.lax.scan(_step, states, keys, length=n_steps)
+
+
+class JuxEnvSharded:
+    """
+    A batch of environments split across multiple devices with `jax.pmap`. Each device runs its own
+    `JuxEnvBatch` executable on `B // D` envs, where D is the number of devices. On CPU, multiple host devices can
+    be created with `XLA_FLAGS=--xla_force_host_platform_device_count=D`.
+
+    Sharded states and actions have two leading dimensions `[D, B // D]`. Use `shard()` to split a batch
+    `[B, ...]` across devices, and `gather()` to fetch sharded outputs, such as rewards and dones, back to host
+    as `[B, ...]` numpy arrays.
+
+    Args:
+        env_cfg (EnvConfig): the game config.
+        buf_cfg (JuxBufferConfig): the buffer config.
+        devices (Sequence[jax.Device], optional): devices to use. Defaults to `jax.devices()`.
+        donate_state (bool): If True, step methods donate the input states. See `JuxEnv` for the contract.
+        skip_unused_actions (bool): See `JuxEnvBatch`. Handlers are skipped per device.
+    """
+    AXIS_NAME = 'device'
+
+    @property
+    def env_cfg(self) -> EnvConfig:
+        return self.batch_env.env_cfg
+
+    @property
+    def buf_cfg(self) -> JuxBufferConfig:
+        return self.batch_env.buf_cfg
+
+    @property
+    def n_devices(self) -> int:
+        return len(self.devices)
+
+    def __init__(
+        self,
+        env_cfg=EnvConfig(),
+        buf_cfg=JuxBufferConfig(),
+        devices: Optional[Sequence[jax.Device]] = None,
+        donate_state: bool = False,
+        skip_unused_actions: bool = False,
+    ) -> None:
+        self.batch_env = JuxEnvBatch(env_cfg, buf_cfg, skip_unused_actions=skip_unused_actions)
+        self.devices = list(jax.devices() if devices is None else devices)
+        self.donate_state = donate_state
+
+        pmap = partial(jax.pmap, axis_name=self.AXIS_NAME, devices=self.devices)
+        donate_argnums = (0, ) if donate_state else ()
+        self._reset = pmap(self._reset_shard, static_broadcasted_argnums=(1, ))
+        self._reset_to_late_game = pmap(self.batch_env.reset_to_late_game)
+        self._step_bid = pmap(self.batch_env.step_bid, donate_argnums=donate_argnums)
+        self._step_factory_placement = pmap(self.batch_env.step_factory_placement, donate_argnums=donate_argnums)
+        self._step_late_game = pmap(self.batch_env.step_late_game, donate_argnums=donate_argnums)
+        self._step = pmap(self.batch_env.step, donate_argnums=donate_argnums)
+        self._step_late_game_auto_reset = pmap(self.batch_env.step_late_game_auto_reset, donate_argnums=donate_argnums)
+
+    def shard(self, tree):
+        """Reshape the leading batch dimension `[B, ...]` of each leaf into `[D, B // D, ...]`."""
+
+        def _shard(x):
+            x = jnp.asarray(x)
+            if x.shape[0] % self.n_devices != 0:
+                raise ValueError(f"batch size {x.shape[0]} is not divisible by the number of devices {self.n_devices}")
+            return x.reshape(self.n_devices, x.shape[0] // self.n_devices, *x.shape[1:])
+
+        return jax.tree_map(_shard, tree)
+
+    def unshard(self, tree):
+        """Inverse of `shard()`. Reshape `[D, B // D, ...]` into `[B, ...]`. Leaves stay on device."""
+        return jax.tree_map(lambda x: x.reshape(-1, *x.shape[2:]), tree)
+
+    def gather(self, tree):
+        """
+        Fetch sharded outputs from all devices to host, and merge the device dimension into the batch dimension.
+
+        Example:
+            >>> states, (_, rewards, dones, _) = env.step_late_game(states, actions)
+            >>> rewards, dones = env.gather((rewards, dones))  # int[B, 2], bool[B, 2]
+        """
+        return jax.tree_map(lambda x: np.asarray(x).reshape(-1, *x.shape[2:]), tree)
+
+    def _reset_shard(self, seeds: Array, same_factories_per_team: bool) -> State:
+        states = self.batch_env.reset(seeds, False)
+        if same_factories_per_team:
+            # use factories_per_team of the first env across all devices
+            factories_per_team = jax.lax.all_gather(states.board.factories_per_team[0], self.AXIS_NAME)[0]
+            factories_per_team = jnp.full_like(states.board.factories_per_team, factories_per_team)
+            states = states._replace(board=states.board._replace(factories_per_team=factories_per_team))
+        return states
+
+    def reset(self, seeds: Array, same_factories_per_team: bool = True) -> State:
+        """
+        Args:
+            seeds (Array): int[B], seeds for map generation. B must be divisible by the number of devices.
+            same_factories_per_team (bool): see `JuxEnvBatch.reset()`. The first env on the first device decides
+                `factories_per_team` for all envs.
+
+        Returns:
+            State: sharded initial states, with leading dimensions `[D, B // D]`.
+        """
+        return self._reset(self.shard(seeds), same_factories_per_team)
+
+    def reset_to_late_game(self, seeds: Array) -> State:
+        """Sharded version of `JuxEnvBatch.reset_to_late_game()`. `seeds` is int[B]."""
+        return self._reset_to_late_game(self.shard(seeds))
+
+    def step_bid(self, states: State, bid: Array, faction: Array) -> Tuple[State, Tuple[Dict, Array, Array, Dict]]:
+        """Sharded version of `JuxEnvBatch.step_bid()`. All arguments are sharded."""
+        return self._step_bid(states, bid, faction)
+
+    def step_factory_placement(self, states: State, spawn: Array, water: Array, metal: Array) \
+                                                            -> Tuple[State, Tuple[Dict, Array, Array, Dict]]:
+        """Sharded version of `JuxEnvBatch.step_factory_placement()`. All arguments are sharded."""
+        return self._step_factory_placement(states, spawn, water, metal)
+
+    def step_late_game(self, states: State, actions: JuxAction) -> Tuple[State, Tuple[Dict, Array, Array, Dict]]:
+        """Sharded version of `JuxEnvBatch.step_late_game()`. All arguments are sharded."""
+        return self._step_late_game(states, actions)
+
+    def step(
+        self,
+        states: State,
+        bid_action: Tuple[Array, Array],
+        placement_action: Tuple[Array, Array, Array],
+        late_action: JuxAction,
+    ) -> Tuple[State, Tuple[Dict, Array, Array, Dict]]:
+        """Sharded version of `JuxEnvBatch.step()`. All arguments are sharded."""
+        return self._step(states, bid_action, placement_action, late_action)
+
+    def step_late_game_auto_reset(self, states: State,
+                                  actions: JuxAction) -> Tuple[State, Tuple[Dict, Array, Array, Dict]]:
+        """
+        Sharded version of `JuxEnvBatch.step_late_game_auto_reset()`. All arguments are sharded. Whether to
+        reset is decided per device, so one device resetting its envs does not slow down the others.
+        """
+        return self._step_late_game_auto_reset(states, actions)
+
+
+class JuxEnvBucketed:
+    """
+    A batch of environments whose unit buffer grows and shrinks with the games. The step cost grows with
+    `MAX_N_UNITS`, but a buffer too small for the games silently drops units. This env keeps one `JuxEnvBatch`
+    per unit capacity (bucket), and after each step migrates the states to the smallest bucket that fits the
+    largest `n_units` in the batch, see `State.resize_units()`. Each bucket is compiled the first time it is used.
+
+    A bucket fits when it has room for `MAX_N_FACTORIES` more units per team, which is the most units one step
+    can build, so no unit is ever dropped. States only move down to a smaller bucket when it fits twice that
+    margin, so they do not bounce between two buckets.
+
+    The current bucket is `states.MAX_N_UNITS`, and actions passed to step methods shall match it, e.g. created
+    by `JuxAction.empty(env.env_cfg, env.batch_env(states).buf_cfg)`. Reading `n_units` after each step syncs
+    the device with host.
+
+    Args:
+        env_cfg (EnvConfig): the game config.
+        buf_cfg (JuxBufferConfig): the buffer config. `buf_cfg.MAX_N_UNITS` is the largest bucket.
+        unit_buckets (Sequence[int]): capacities of smaller buckets. Those not less than `buf_cfg.MAX_N_UNITS`
+            are ignored.
+        donate_state (bool): If True, step methods donate the input states. See `JuxEnv` for the contract.
+        skip_unused_actions (bool): See `JuxEnvBatch`.
+    """
+    DEFAULT_UNIT_BUCKETS = (64, 128, 256, 512)
+
+    @property
+    def env_cfg(self) -> EnvConfig:
+        return self.batch_envs[-1].env_cfg
+
+    @property
+    def buf_cfg(self) -> JuxBufferConfig:
+        return self.batch_envs[-1].buf_cfg
+
+    @property
+    def unit_buckets(self) -> Tuple[int, ...]:
+        return tuple(batch_env.buf_cfg.MAX_N_UNITS for batch_env in self.batch_envs)
+
+    def __init__(
+        self,
+        env_cfg=EnvConfig(),
+        buf_cfg=JuxBufferConfig(),
+        unit_buckets: Sequence[int] = DEFAULT_UNIT_BUCKETS,
+        donate_state: bool = False,
+        skip_unused_actions: bool = False,
+    ) -> None:
+        buckets = sorted({b for b in unit_buckets if b < buf_cfg.MAX_N_UNITS} | {buf_cfg.MAX_N_UNITS})
+        self.batch_envs = [
+            JuxEnvBatch(env_cfg, buf_cfg._replace(MAX_N_UNITS=b), donate_state, skip_unused_actions) for b in buckets
+        ]
+        self._resize_units = jax.jit(State.resize_units, static_argnums=(1, ))
+
+    def batch_env(self, states: State) -> JuxEnvBatch:
+        """The `JuxEnvBatch` of the bucket `states` are in."""
+        return self.batch_envs[self.unit_buckets.index(states.MAX_N_UNITS)]
+
+    def bucket_for(self, n_units: int) -> int:
+        """The smallest bucket with room for `MAX_N_FACTORIES` more units than `n_units`."""
+        for b in self.unit_buckets:
+            if n_units + self.buf_cfg.MAX_N_FACTORIES <= b:
+                return b
+        return self.unit_buckets[-1]
+
+    def migrate(self, states: State) -> State:
+        """
+        Move `states` to a bigger bucket if any env may run out of unit slots in the next step, or to a smaller
+        bucket if all envs fit in it with margin.
+        """
+        n_units = int(jnp.max(states.n_units))
+        margin = self.buf_cfg.MAX_N_FACTORIES
+        if n_units + margin > states.MAX_N_UNITS:
+            bucket = self.bucket_for(n_units)
+        else:
+            bucket = min(self.bucket_for(n_units + margin), states.MAX_N_UNITS)
+        if bucket != states.MAX_N_UNITS:
+            states = self._resize_units(states, bucket)
+        return states
+
+    def reset(self, seeds: Array, same_factories_per_team: bool = True) -> State:
+        """Same as `JuxEnvBatch.reset()`. States start in the smallest bucket."""
+        return self.batch_envs[0].reset(seeds, same_factories_per_team)
+
+    def reset_to_late_game(self, seeds: Array) -> State:
+        """Same as `JuxEnvBatch.reset_to_late_game()`. States start in the smallest bucket."""
+        return self.batch_envs[0].reset_to_late_game(seeds)
+
+    def step_bid(self, states: State, bid: Array, faction: Array) -> Tuple[State, Tuple[Dict, Array, Array, Dict]]:
+        """Same as `JuxEnvBatch.step_bid()`."""
+        return self.batch_env(states).step_bid(states, bid, faction)
+
+    def step_factory_placement(self, states: State, spawn: Array, water: Array, metal: Array) \
+                                                            -> Tuple[State, Tuple[Dict, Array, Array, Dict]]:
+        """Same as `JuxEnvBatch.step_factory_placement()`."""
+        return self.batch_env(states).step_factory_placement(states, spawn, water, metal)
+
+    def step_late_game(self, states: State, actions: JuxAction) -> Tuple[State, Tuple[Dict, Array, Array, Dict]]:
+        """
+        Same as `JuxEnvBatch.step_late_game()`, followed by `migrate()`. Only the returned states are migrated,
+        observations keep the bucket the step ran in.
+        """
+        states, outputs = self.batch_env(states).step_late_game(states, actions)
+        return self.migrate(states), outputs
+
+    def step(
+        self,
+        states: State,
+        bid_action: Tuple[Array, Array],
+        placement_action: Tuple[Array, Array, Array],
+        late_action: JuxAction,
+    ) -> Tuple[State, Tuple[Dict, Array, Array, Dict]]:
+        """Same as `JuxEnvBatch.step()`, followed by `migrate()`."""
+        states, outputs = self.batch_env(states).step(states, bid_action, placement_action, late_action)
+        return self.migrate(states), outputs
+
+    def step_late_game_auto_reset(self, states: State,
+                                  actions: JuxAction) -> Tuple[State, Tuple[Dict, Array, Array, Dict]]:
+        """Same as `JuxEnvBatch.step_late_game_auto_reset()`, followed by `migrate()`."""
+        states, outputs = self.batch_env(states).step_late_game_auto_reset(states, actions)
+        return self.migrate(states), outputs
@@ -1,6 +1,6 @@
 from typing import Dict, NamedTuple, Tuple
 
-import jax
+from jax import Array
 from jax import numpy as jnp
 from luxai_s2.factory import Factory as LuxFactory
 from luxai_s2.team import Team as LuxTeam
@@ -8,6 +8,7 @@ from luxai_s2.team import Team as LuxTeam
 from jux.config import EnvConfig
 from jux.map.position import Position, direct2delta_xy
 from jux.unit import ResourceType, Unit, UnitCargo
+from jux.unit_cargo import add_to_ledger, ledger_amount, sub_from_ledger
 from jux.utils import INT32_MAX, imax
 
 
@@ -48,55 +49,35 @@ class Factory(NamedTuple):
             cargo=UnitCargo.from_lux(cargo),
         )
 
-    def add_resource(self, resource: ResourceType, transfer_amount: int) -> Tuple['Factory', int]:
-        # If resource != ResourceType.power, call UnitCargo.add_resource.
-        # else, call Unit.add_power.
-        transfer_amount = jnp.maximum(transfer_amount, 0)
-
-        def add_power(self: Factory, transfer_amount: int):
-            new_factory = self._replace(power=self.power + transfer_amount)
-            return new_factory, transfer_amount
-
-        def add_others(self: Factory, transfer_amount: int):
-            new_cargo, transfer_amount = self.cargo.add_resource(
-                resource=resource,
-                amount=transfer_amount,
-                cargo_space=jnp.iinfo(jnp.int32).max // 2,
-            )
-            new_factory = self._replace(cargo=new_cargo)
-            return new_factory, transfer_amount
-
-        new_factory, transfer_amount = jax.lax.cond(
-            resource == ResourceType.power,
-            add_power,
-            add_others,
-            *(self, transfer_amount),
+    @property
+    def ledger(self) -> Array:
+        '''int[..., 5], the cargo stock and power of the factory, indexed by `ResourceType`. See `Unit.ledger`.'''
+        return jnp.concatenate([self.cargo.stock, jnp.expand_dims(self.power, -1)], axis=-1)
+
+    def ledger_capacity(self) -> Array:
+        '''int[5], the capacity of each column of `Factory.ledger`. Factories have infinite cargo space (here is
+        int32.max//2) and battery (here is int32.max).'''
+        n_cargo = self.cargo.stock.shape[-1]
+        return jnp.array([INT32_MAX // 2] * n_cargo + [INT32_MAX], dtype=jnp.int32)
+
+    def replace_ledger(self, ledger: Array) -> 'Factory':
+        '''Write a ledger, as returned by `Factory.ledger`, back into cargo stock and power.'''
+        return self._replace(
+            cargo=UnitCargo(ledger[..., :-1].astype(self.cargo.stock.dtype)),
+            power=ledger[..., -1].astype(jnp.result_type(self.power)),
         )
-        return new_factory, transfer_amount
+
+    def add_resource(self, resource: ResourceType, transfer_amount: int) -> Tuple['Factory', int]:
+        ledger = self.ledger
+        amount = ledger_amount(resource, transfer_amount, ledger.shape[-1])
+        ledger, transfer_amount = add_to_ledger(ledger, amount, self.ledger_capacity())
+        return self.replace_ledger(ledger), transfer_amount.sum(-1)
 
     def sub_resource(self, resource: ResourceType, amount: int) -> Tuple['Factory', int]:
-        # If resource != ResourceType.power, call UnitCargo.add_resource.
-        # else, call Unit.sub_resource.
-        def sub_power(self, resource: ResourceType, amount: int):
-            transfer_amount = jnp.minimum(self.power, amount)
-            new_factory = self._replace(power=self.power - transfer_amount)
-            return new_factory, transfer_amount
-
-        def sub_others(self: Unit, resource: ResourceType, amount: int):
-            new_cargo, transfer_amount = self.cargo.sub_resource(
-                resource=resource,
-                amount=amount,
-            )
-            new_factory = self._replace(cargo=new_cargo)
-            return new_factory, transfer_amount
-
-        new_factory, transfer_amount = jax.lax.cond(
-            resource == ResourceType.power,
-            sub_power,
-            sub_others,
-            *(self, resource, amount),
-        )
-        return new_factory, transfer_amount
+        ledger = self.ledger
+        amount = ledger_amount(resource, amount, ledger.shape[-1])
+        ledger, transfer_amount = sub_from_ledger(ledger, amount)
+        return self.replace_ledger(ledger), transfer_amount.sum(-1)
 
     @classmethod
     def from_lux(cls, lux_factory: LuxFactory) -> "Factory":
@@ -0,0 +1,210 @@
+"""
+Profiling of the step pipeline.
+
+`State._step_late_game()` wraps each of its stages in `jax.named_scope`, e.g. `validate_actions`, `dig`, `movement`,
+`water`, `destroy` or `power`. The scopes show up in the op names of `jax.profiler` traces and of the compiled HLO,
+and `stage_costs()` splits a traced function by them, to compile each stage on its own and report the cost estimates
+of `compiled.cost_analysis()` per stage.
+
+Usage:
+    python -m jux.profiling [--batch-size 16] [--max-n-units 1000] [--map-size 64] [--log-dir /tmp/jux-trace]
+"""
+import argparse
+import re
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+import jax
+import jax.numpy as jnp
+from jax import core
+
+import jux.aot
+from jux.config import EnvConfig, JuxBufferConfig
+from jux.env import JuxEnvBatch
+
+OTHER_STAGE = 'other'
+
+
+class StageCost(NamedTuple):
+    """Cost estimates of one stage, as reported by `compiled.cost_analysis()` of the stage compiled on its own."""
+    stage: str
+    n_eqns: int  # number of jaxpr equations in the stage
+    flops: float
+    transcendentals: float
+    bytes_accessed: float
+
+
+def _stage_of(eqn: core.JaxprEqn) -> str:
+    # The name stack looks like 'vmap(dig)/cond', so the stage is the outermost scope with transforms stripped.
+    name_stack = str(eqn.source_info.name_stack)
+    return re.match(r'^(?:\w+\()*([^()/]*)', name_stack).group(1)
+
+
+def _stage_level(closed_jaxpr: core.ClosedJaxpr) -> Optional[core.ClosedJaxpr]:
+    # Stages may be nested in calls of jitted functions, so search for the outermost jaxpr with scoped equations.
+    if any(_stage_of(eqn) for eqn in closed_jaxpr.jaxpr.eqns):
+        return closed_jaxpr
+    for eqn in closed_jaxpr.jaxpr.eqns:
+        if eqn.primitive.name == 'pjit':
+            level = _stage_level(eqn.params['jaxpr'])
+            if level is not None:
+                return level
+    return None
+
+
+def _cost(cost_analysis) -> Dict[str, float]:
+    # `cost_analysis()` returns one dict per device program on some jax versions.
+    if isinstance(cost_analysis, (list, tuple)):
+        cost_analysis = cost_analysis[0] if cost_analysis else {}
+    return cost_analysis or {}
+
+
+def _compile_cost(closed_jaxpr: core.ClosedJaxpr) -> Dict[str, float]:
+    args = [jax.ShapeDtypeStruct(v.aval.shape, v.aval.dtype) for v in closed_jaxpr.jaxpr.invars]
+    return _cost(jax.jit(core.jaxpr_as_fun(closed_jaxpr)).lower(*args).compile().cost_analysis())
+
+
+def stage_jaxprs(fn: Callable, *args) -> Dict[str, core.ClosedJaxpr]:
+    """
+    Trace `fn(*args)`, and split it into one jaxpr per stage, i.e. per outermost `jax.named_scope`. Equations out of
+    any scope are collected in the stage 'other'. The jaxpr of a stage takes all values it reads from other stages as
+    inputs, and returns all values it computes for later stages.
+
+    Args:
+        fn (Callable): the function to trace.
+        args: arguments of `fn`, arrays or `jax.ShapeDtypeStruct`.
+
+    Returns:
+        Dict[str, ClosedJaxpr]: stage name -> jaxpr of the stage, in the order stages first appear.
+    """
+    closed_jaxpr = jax.make_jaxpr(fn)(*args)
+    closed_jaxpr = _stage_level(closed_jaxpr) or closed_jaxpr
+    jaxpr = closed_jaxpr.jaxpr
+    consts = dict(zip(jaxpr.constvars, closed_jaxpr.consts))
+
+    stage_eqns: Dict[str, List[core.JaxprEqn]] = {}
+    for eqn in jaxpr.eqns:
+        stage_eqns.setdefault(_stage_of(eqn) or OTHER_STAGE, []).append(eqn)
+
+    # a variable computed in a stage is an output of the stage, if other stages or the function return it
+    stage_of_eqn = {id(eqn): stage for stage, eqns in stage_eqns.items() for eqn in eqns}
+    read_by = {v: {None} for v in jaxpr.outvars if isinstance(v, core.Var)}
+    for eqn in jaxpr.eqns:
+        for v in eqn.invars:
+            if isinstance(v, core.Var):
+                read_by.setdefault(v, set()).add(stage_of_eqn[id(eqn)])
+
+    stages = {}
+    for stage, eqns in stage_eqns.items():
+        defined = {v for eqn in eqns for v in eqn.outvars if not isinstance(v, core.DropVar)}
+        invars, constvars = [], []
+        for eqn in eqns:
+            for v in eqn.invars:
+                if isinstance(v, core.Var) and v not in defined and v not in invars and v not in constvars:
+                    (constvars if v in consts else invars).append(v)
+        outvars = [v for eqn in eqns for v in eqn.outvars if v in defined and read_by.get(v, set()) - {stage}]
+        stage_jaxpr = core.Jaxpr(constvars, invars, outvars, eqns)
+        stages[stage] = core.ClosedJaxpr(stage_jaxpr, [consts[v] for v in constvars])
+    return stages
+
+
+def stage_costs(fn: Callable, *args) -> List[StageCost]:
+    """
+    Compile each stage of `fn(*args)` on its own, see `stage_jaxprs()`, and collect its cost estimates. XLA fuses
+    across stages when compiling the whole function, so the sum over stages is an estimate of the total.
+
+    Returns:
+        List[StageCost]: one entry per stage, in the order stages first appear.
+    """
+    costs = []
+    for stage, closed_jaxpr in stage_jaxprs(fn, *args).items():
+        cost = _compile_cost(closed_jaxpr)
+        costs.append(
+            StageCost(
+                stage=stage,
+                n_eqns=len(closed_jaxpr.jaxpr.eqns),
+                flops=cost.get('flops', 0.0),
+                transcendentals=cost.get('transcendentals', 0.0),
+                bytes_accessed=cost.get('bytes accessed', 0.0),
+            ))
+    return costs
+
+
+def format_table(costs: List[StageCost]) -> str:
+    """Format stage costs as a table, with the share of each stage in the total bytes accessed."""
+    total = StageCost(
+        stage='total',
+        n_eqns=sum(c.n_eqns for c in costs),
+        flops=sum(c.flops for c in costs),
+        transcendentals=sum(c.transcendentals for c in costs),
+        bytes_accessed=sum(c.bytes_accessed for c in costs),
+    )
+    lines = [f"{'stage':>20} {'eqns':>6} {'MFLOP':>10} {'transc.':>10} {'MB accessed':>12} {'share':>7}"]
+    for c in costs + [total]:
+        share = c.bytes_accessed / max(total.bytes_accessed, 1)
+        lines.append(f"{c.stage:>20} {c.n_eqns:>6} {c.flops / 1e6:>10.2f} {c.transcendentals:>10.0f} "
+                     f"{c.bytes_accessed / 1e6:>12.2f} {share:>6.1%}")
+    return '\n'.join(lines)
+
+
+def profile_step_late_game(
+    env_batch: JuxEnvBatch,
+    batch_size: int,
+    log_dir: Optional[str] = None,
+    repeat: int = 10,
+    seed: int = 0,
+) -> List[StageCost]:
+    """
+    Profile `JuxEnvBatch.step_late_game()` of `env_batch` for `batch_size` envs.
+
+    Args:
+        env_batch (JuxEnvBatch): the batch environment, which determines `EnvConfig` and `JuxBufferConfig`.
+        batch_size (int): the number of envs B.
+        log_dir (str, optional): if given, capture a `jax.profiler` trace of `repeat` steps into it, which can be
+            viewed with TensorBoard or Perfetto. Stages appear in the op names of the trace.
+        repeat (int): the number of traced steps.
+        seed (int): the first seed of the states, which are reset to the late game.
+
+    Returns:
+        List[StageCost]: cost estimates of each stage, see `stage_costs()`.
+    """
+    args = jux.aot.abstract_args(env_batch, batch_size)['step_late_game']
+    costs = stage_costs(env_batch.step_late_game, *args)
+
+    if log_dir is not None:
+        states = env_batch.reset_to_late_game(jnp.arange(seed, seed + batch_size))
+        actions = jax.tree_map(lambda x: jnp.zeros(x.shape, x.dtype), args[1])
+        jax.block_until_ready(env_batch.step_late_game(states, actions))  # compile out of the trace
+        with jax.profiler.trace(log_dir):
+            for _ in range(repeat):
+                states, _ = env_batch.step_late_game(states, actions)
+            jax.block_until_ready(states)
+    return costs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--max-n-units', type=int, default=JuxBufferConfig.MAX_N_UNITS)
+    parser.add_argument('--map-size', type=int, default=EnvConfig.map_size)
+    parser.add_argument('--skip-unused-actions', action='store_true')
+    parser.add_argument('--log-dir', type=str, default=None)
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    env_batch = JuxEnvBatch(
+        env_cfg=EnvConfig(map_size=args.map_size),
+        buf_cfg=JuxBufferConfig(MAX_N_UNITS=args.max_n_units),
+        skip_unused_actions=args.skip_unused_actions,
+    )
+    start = time.perf_counter()
+    costs = profile_step_late_game(env_batch, args.batch_size, args.log_dir, args.repeat)
+    print(f"backend: {jax.default_backend()}, batch size: {args.batch_size}, MAX_N_UNITS: {args.max_n_units}, "
+          f"map size: {args.map_size}, profiled in {time.perf_counter() - start:.1f}s")
+    print(format_table(costs))
+    if args.log_dir is not None:
+        print(f"trace written to {args.log_dir}")
+
+
+if __name__ == '__main__':
+    main()
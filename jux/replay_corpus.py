@@ -0,0 +1,383 @@
+"""
+Offline replay corpus and batched parity checking.
+
+A corpus is a directory of compressed `.npz` files, one per replay, built once from replays with `luxai_s2` by
+`build_corpus()`. Each file holds the late game of the replay, pre-parsed into JUX tensors:
+
+    meta: a JSON string with the source replay, `EnvConfig`, the number of steps T and the unit buffer size U.
+    state/<path>: leaves of the initial `State` of the late game, with `MAX_N_UNITS=U`.
+    actions/<path>: leaves of `JuxAction[T]`.
+    reference/<key>: `key_tensors()` of the `luxai_s2` state after each step, stacked into `[T, ...]`.
+    reference/rewards, reference/dones: `[T, 2]` rewards and dones of `luxai_s2`.
+
+U is the largest number of units a team has in the replay, so files stay small and replays of different lengths and
+sizes can be batched after padding.
+
+`check_parity()` steps many replays at once in `JuxEnvBatch`, and compares `key_tensors()` with the reference after
+each step, without `luxai_s2` or network access.
+
+Usage:
+    python -m jux.replay_corpus build tests/replay2.0_0.json.gz tests/replay2.0_1.json.gz --out corpus/
+    python -m jux.replay_corpus check corpus/ [--batch-size 64]
+"""
+import argparse
+import functools
+import glob
+import json
+import os
+import os.path as osp
+import time
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+from jax import Array
+
+import jux.tree_util
+import jux.utils
+from jux.actions import JuxAction
+from jux.config import EnvConfig, JuxBufferConfig, UnitConfig
+from jux.env import JuxEnvBatch
+from jux.state import State
+
+FORMAT_VERSION = 1
+
+
+def key_tensors(state: State) -> Dict[str, Array]:
+    """
+    The tensors compared by parity checks: board arrays, and unit and factory tables. Slots of non-existent units
+    and factories are zeroed, so that they do not depend on buffer contents. It works on batched states.
+
+    Returns:
+        Dict[str, Array]: name -> tensor.
+    """
+    unit_mask = state.unit_mask  # bool[..., 2, U]
+    factory_mask = state.factory_mask  # bool[..., 2, F]
+
+    def _masked(x: Array, mask: Array) -> Array:
+        mask = mask.reshape(mask.shape + (1, ) * (x.ndim - mask.ndim))
+        return jnp.where(mask, x, 0)
+
+    return {
+        'real_env_steps': state.real_env_steps,
+        'board.rubble': state.board.rubble,
+        'board.lichen': state.board.lichen,
+        'board.lichen_strains': state.board.lichen_strains,
+        'n_units': state.n_units,
+        'units.unit_id': _masked(state.units.unit_id, unit_mask),
+        'units.unit_type': _masked(state.units.unit_type, unit_mask),
+        'units.pos': _masked(state.units.pos.pos, unit_mask),
+        'units.power': _masked(state.units.power, unit_mask),
+        'units.cargo': _masked(state.units.cargo.stock, unit_mask),
+        'n_factories': state.n_factories,
+        'factories.unit_id': _masked(state.factories.unit_id, factory_mask),
+        'factories.pos': _masked(state.factories.pos.pos, factory_mask),
+        'factories.power': _masked(state.factories.power, factory_mask),
+        'factories.cargo': _masked(state.factories.cargo.stock, factory_mask),
+    }
+
+
+_key_tensors_jitted = jax.jit(key_tensors)
+
+
+def _env_cfg_to_dict(env_cfg: EnvConfig) -> Dict[str, Any]:
+    return {**env_cfg._asdict(), 'ROBOTS': [unit_cfg._asdict() for unit_cfg in env_cfg.ROBOTS]}
+
+
+def _env_cfg_from_dict(d: Dict[str, Any]) -> EnvConfig:
+    return EnvConfig(**{**d, 'ROBOTS': tuple(UnitConfig(**unit_cfg) for unit_cfg in d['ROBOTS'])})
+
+
+def _flatten(prefix: str, tree) -> Dict[str, np.ndarray]:
+    return {
+        f"{prefix}/{jax.tree_util.keystr(path)}": np.asarray(x)
+        for path, x in jax.tree_util.tree_flatten_with_path(tree)[0]
+    }
+
+
+def _unflatten(prefix: str, data, template):
+    paths, treedef = jax.tree_util.tree_flatten_with_path(template)
+    return jax.tree_util.tree_unflatten(treedef, [data[f"{prefix}/{jax.tree_util.keystr(p)}"] for p, _ in paths])
+
+
+@functools.lru_cache(maxsize=None)
+def _state_template(env_cfg: EnvConfig) -> State:
+    # only the tree structure is used, so any buffer config does
+    return jax.eval_shape(lambda: State.new(0, env_cfg, JuxBufferConfig(MAX_N_UNITS=1, MAP_SIZE=env_cfg.map_size)))
+
+
+def _late_game(replay: str, max_steps: Optional[int]):
+    # the lux env at the start of the late game, and the actions of the late game
+    lux_env, lux_actions = jux.utils.load_replay(replay)
+    while lux_env.state.real_env_steps < 0:
+        lux_env.step(next(lux_actions))
+    lux_actions = list(lux_actions)
+    return lux_env, lux_actions[:max_steps]
+
+
+def record_replay(replay: str, path: str, max_steps: Optional[int] = None) -> str:
+    """
+    Replay the late game of `replay` with `luxai_s2`, and save it as a corpus file.
+
+    Args:
+        replay (str): a replay file or url, see `jux.utils.load_replay()`.
+        path (str): the `.npz` file to write.
+        max_steps (int, optional): record at most this many steps.
+
+    Returns:
+        str: `path`.
+    """
+    # first pass: find the unit buffer size. Units are built before collisions are resolved in a step, so the
+    # buffer must also hold one new unit per factory.
+    lux_env, lux_actions = _late_game(replay, max_steps)
+    max_n_units = 1
+    for lux_act in lux_actions:
+        max_n_units = max(
+            max_n_units,
+            *(len(lux_env.state.units[p]) + len(lux_env.state.factories[p]) for p in lux_env.state.units),
+        )
+        _, _, dones, _, _ = lux_env.step(jux.utils.live_actions(lux_env.state, lux_act))
+        if dones['player_0'] or dones['player_1']:
+            break
+
+    # second pass: record
+    lux_env, lux_actions = _late_game(replay, max_steps)
+    buf_cfg = JuxBufferConfig(MAX_N_UNITS=max_n_units)
+    state = State.from_lux(lux_env.state, buf_cfg)
+    init_state = state
+    actions, reference, rewards, dones = [], [], [], []
+    for lux_act in lux_actions:
+        lux_act = jux.utils.live_actions(lux_env.state, lux_act)
+        actions.append(JuxAction.from_lux(state, lux_act))
+        _, lux_rewards, lux_dones, _, _ = lux_env.step(lux_act)
+        state = State.from_lux(lux_env.state, buf_cfg)
+        reference.append(jax.tree_map(np.asarray, _key_tensors_jitted(state)))
+        rewards.append([lux_rewards['player_0'], lux_rewards['player_1']])
+        dones.append([lux_dones['player_0'], lux_dones['player_1']])
+        if lux_dones['player_0'] or lux_dones['player_1']:
+            break
+
+    actions = jux.tree_util.batch_into_leaf([jax.tree_map(np.asarray, a) for a in actions])
+    # `JuxAction.from_lux()` leaves slots beyond the queue length uninitialized
+    slot = np.arange(init_state.UNIT_ACTION_QUEUE_SIZE)
+    in_queue = slot < np.asarray(actions.unit_action_queue_count)[..., None]
+    actions = actions._replace(unit_action_queue=jax.tree_map(
+        lambda x: np.where(in_queue, x, 0).astype(x.dtype),
+        actions.unit_action_queue,
+    ))
+    meta = dict(
+        format_version=FORMAT_VERSION,
+        replay=str(replay),
+        env_cfg=_env_cfg_to_dict(init_state.env_cfg),
+        n_steps=len(actions.factory_action),
+        max_n_units=max_n_units,
+    )
+    np.savez_compressed(
+        path,
+        meta=np.array(json.dumps(meta)),
+        **_flatten('state', init_state),
+        **_flatten('actions', actions),
+        **{f"reference/{k}": np.stack([r[k] for r in reference]) for k in reference[0]},
+        **{'reference/rewards': np.array(rewards, np.int32), 'reference/dones': np.array(dones, np.bool_)},
+    )
+    return path
+
+
+def build_corpus(replays: Sequence[str], out_dir: str, max_steps: Optional[int] = None) -> List[str]:
+    """
+    Record replays into a corpus directory, see `record_replay()`. Files are named after the replays.
+
+    Returns:
+        List[str]: paths of the corpus files.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    paths = []
+    for replay in replays:
+        name = osp.basename(replay)
+        for ext in ('.gz', '.json'):
+            name = name[:-len(ext)] if name.endswith(ext) else name
+        paths.append(record_replay(replay, osp.join(out_dir, f"{name}.npz"), max_steps))
+    return paths
+
+
+class CorpusEntry(NamedTuple):
+    """A replay of the corpus loaded into host memory."""
+    path: str
+    meta: Dict[str, Any]
+    env_cfg: EnvConfig
+    state: State  # State with MAX_N_UNITS=meta['max_n_units']
+    actions: JuxAction  # JuxAction[T]
+    reference: Dict[str, np.ndarray]  # name -> [T, ...], including 'rewards' and 'dones'
+
+    @property
+    def n_steps(self) -> int:
+        return self.meta['n_steps']
+
+
+def load_entry(path: str) -> CorpusEntry:
+    with np.load(path) as data:
+        meta = json.loads(str(data['meta']))
+        env_cfg = _env_cfg_from_dict(meta['env_cfg'])
+        state = _unflatten('state', data, _state_template(env_cfg))
+        action_template = JuxAction.empty(env_cfg, JuxBufferConfig(MAX_N_UNITS=meta['max_n_units']))
+        actions = _unflatten('actions', data, action_template)
+        reference = {k[len('reference/'):]: data[k] for k in data.files if k.startswith('reference/')}
+    return CorpusEntry(path, meta, env_cfg, state, actions, reference)
+
+
+def _pad_actions(actions: JuxAction, n_steps: int, empty: JuxAction) -> JuxAction:
+    # pad `JuxAction[T]` with empty actions to `n_steps` steps and the unit buffer of `empty`
+    def _pad(x, e):
+        out = np.broadcast_to(np.asarray(e), (n_steps, ) + e.shape).copy()
+        out[(slice(0, len(x)), ) + tuple(slice(0, s) for s in x.shape[1:])] = x
+        return out
+
+    return jax.tree_map(_pad, actions, empty)
+
+
+def _pad_reference(reference: np.ndarray, n_steps: int, shape) -> np.ndarray:
+    out = np.zeros((n_steps, ) + tuple(shape), reference.dtype)
+    out[(slice(0, len(reference)), ) + tuple(slice(0, s) for s in reference.shape[1:])] = reference
+    return out
+
+
+class ParityResult(NamedTuple):
+    path: str
+    replay: str
+    n_steps: int
+    first_mismatch: Optional[int]  # the first step whose results differ from the reference, or None
+    mismatched_keys: List[str]  # keys that differ at `first_mismatch`
+
+    @property
+    def ok(self) -> bool:
+        return self.first_mismatch is None
+
+
+@functools.partial(jax.jit, static_argnums=(0, ))
+def _step_and_compare(env_batch: JuxEnvBatch, states: State, actions: JuxAction, reference: Dict[str, Array]):
+    # step `[T, B]` actions with `jax.lax.scan`, and compare with the reference after each step. bool[T, B, K]
+
+    def _step(states, xs):
+        actions, reference = xs
+        states, (_, rewards, dones, _) = env_batch.step_late_game(states, actions)
+        results = {**key_tensors(states), 'rewards': rewards, 'dones': dones}
+        equal = [(results[k] == reference[k]).reshape(len(rewards), -1).all(-1) for k in sorted(reference)]
+        return states, jnp.stack(equal, axis=-1)
+
+    return jax.lax.scan(_step, states, (actions, reference))
+
+
+def check_parity(
+    paths: Sequence[str],
+    batch_size: int = 64,
+    max_n_units: Optional[int] = None,
+    chunk_size: int = 50,
+) -> List[ParityResult]:
+    """
+    Step corpus replays in batches with `JuxEnvBatch.step_late_game()`, and compare `key_tensors()`, rewards and
+    dones with the reference after each step. Replays in a batch are padded to the same number of steps and unit
+    buffer size, and stepped `chunk_size` steps per compiled call.
+
+    Args:
+        paths (Sequence[str]): corpus files.
+        batch_size (int): the number of replays stepped at once.
+        max_n_units (int, optional): the unit buffer size, no less than the `max_n_units` of any replay. Defaults
+            to the largest of them in each batch.
+        chunk_size (int): the number of steps per compiled call.
+
+    Returns:
+        List[ParityResult]: one result per corpus file, in the same order.
+    """
+    entries = {path: load_entry(path) for path in paths}
+
+    # replays in a batch must share the same `EnvConfig`
+    groups: Dict[EnvConfig, List[str]] = {}
+    for path, entry in entries.items():
+        groups.setdefault(entry.env_cfg, []).append(path)
+
+    results = {}
+    for env_cfg, group in groups.items():
+        for i in range(0, len(group), batch_size):
+            batch = [entries[path] for path in group[i:i + batch_size]]
+            for entry, result in zip(batch, _check_batch(env_cfg, batch, max_n_units, chunk_size)):
+                results[entry.path] = result
+    return [results[path] for path in paths]
+
+
+def _check_batch(env_cfg: EnvConfig, batch: List[CorpusEntry], max_n_units: Optional[int],
+                 chunk_size: int) -> List[ParityResult]:
+    n_units = max(entry.meta['max_n_units'] for entry in batch)
+    n_units = n_units if max_n_units is None else max_n_units
+    assert n_units >= max(entry.meta['max_n_units'] for entry in batch), "max_n_units is too small for the corpus."
+    buf_cfg = JuxBufferConfig(MAX_N_UNITS=n_units, MAP_SIZE=env_cfg.map_size)
+    env_batch = JuxEnvBatch(env_cfg, buf_cfg)
+    n_steps = max(entry.n_steps for entry in batch)
+    empty = JuxAction.empty(env_cfg, buf_cfg)
+
+    states = jux.tree_util.batch_into_leaf([entry.state.resize_units(n_units) for entry in batch])
+    keys = sorted(batch[0].reference)
+    shapes = jax.eval_shape(lambda s: {**key_tensors(s), 'rewards': s.n_units, 'dones': s.n_units}, states)
+    equal = []
+    for start in range(0, n_steps, chunk_size):
+        length = min(chunk_size, n_steps - start)
+        actions = [
+            _pad_actions(jax.tree_map(lambda x: x[start:start + length], entry.actions), length, empty)
+            for entry in batch
+        ]
+        actions = jax.tree_map(lambda *xs: np.stack(xs, axis=1), *actions)  # [T, B, ...]
+        reference = {
+            k: np.stack([
+                _pad_reference(entry.reference[k][start:start + length], length, shapes[k].shape[1:])
+                for entry in batch
+            ],
+                        axis=1)
+            for k in keys
+        }
+        states, chunk_equal = _step_and_compare(env_batch, states, actions, reference)
+        equal.append(np.asarray(chunk_equal))
+    equal = np.concatenate(equal)  # bool[T, B, K]
+
+    results = []
+    for b, entry in enumerate(batch):
+        mismatch = ~equal[:entry.n_steps, b]  # bool[T, K]
+        steps = np.flatnonzero(mismatch.any(-1))
+        first = int(steps[0]) if len(steps) else None
+        mismatched_keys = [] if first is None else [k for k, m in zip(keys, mismatch[first]) if m]
+        results.append(ParityResult(entry.path, entry.meta['replay'], entry.n_steps, first, mismatched_keys))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build = subparsers.add_parser('build', help='record replays into a corpus directory')
+    build.add_argument('replays', nargs='+')
+    build.add_argument('--out', required=True)
+    build.add_argument('--max-steps', type=int, default=None)
+    check = subparsers.add_parser('check', help='check parity of JUX against a corpus')
+    check.add_argument('corpus', help='a corpus directory or file')
+    check.add_argument('--batch-size', type=int, default=64)
+    check.add_argument('--max-n-units', type=int, default=None)
+    check.add_argument('--chunk-size', type=int, default=50)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.command == 'build':
+        paths = build_corpus(args.replays, args.out, args.max_steps)
+        print(f"recorded {len(paths)} replays into {args.out} in {time.perf_counter() - start:.1f}s")
+        return
+
+    paths = sorted(glob.glob(osp.join(args.corpus, '*.npz'))) if osp.isdir(args.corpus) else [args.corpus]
+    results = check_parity(paths, args.batch_size, args.max_n_units, args.chunk_size)
+    for r in results:
+        status = 'ok' if r.ok else f"mismatch at step {r.first_mismatch}: {', '.join(r.mismatched_keys)}"
+        print(f"{r.path}: {r.n_steps} steps, {status}")
+    n_failed = sum(not r.ok for r in results)
+    print(f"{len(results) - n_failed}/{len(results)} replays ok in {time.perf_counter() - start:.1f}s")
+    if n_failed:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
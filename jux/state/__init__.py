@@ -1 +1 @@
-from .state import JuxAction, State
+from .state import Features, JuxAction, State
@@ -1,5 +1,5 @@
 import functools
-from typing import Dict, List, NamedTuple, Tuple, Union
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple, Union
 
 import chex
 import jax
@@ -10,7 +10,7 @@ from luxai_s2.state import State as LuxState
 
 import jux.map_generator.flood
 import jux.tree_util
-from jux.actions import FactoryAction, JuxAction, UnitAction, UnitActionType
+from jux.actions import ActionMasks, FactoryAction, JuxAction, UnitAction, UnitActionType
 from jux.config import EnvConfig, JuxBufferConfig
 from jux.factory import Factory, LuxFactory
 from jux.map import Board
@@ -18,7 +18,7 @@ from jux.map.position import Direction, Position, direct2delta_xy
 from jux.team import FactionTypes, LuxTeam, Team
 from jux.unit import ActionQueue, LuxUnit, Unit, UnitCargo, UnitType
 from jux.unit_cargo import ResourceType
-from jux.utils import INT32_MAX, imax
+from jux.utils import INT32_MAX, checked_astype, imax, narrowest_int
 
 
 def is_day(env_cfg: EnvConfig, env_step):
@@ -32,9 +32,129 @@ def sort_by_unit_id(units: Union[Unit, Factory]):
     return units
 
 
+def compact(objs: Union[Unit, Factory], keep: Array, empty: Union[Unit, Factory]) -> Tuple[Union[Unit, Factory], Array]:
+    '''
+    Move kept objects to the front of each team in their original order, and fill the rest with `empty`. It is a
+    stable partition by prefix sums, which is linear in the buffer size, unlike sorting.
+
+    Args:
+        objs: Unit[2, N] or Factory[2, N].
+        keep: bool[2, N], indicator of objects to keep.
+        empty: a single empty object to fill the rest.
+
+    Returns:
+        objs: Unit[2, N] or Factory[2, N], compacted objects.
+        src_idx: int[2, N], the original idx of each compacted object. Only the part of kept objects is valid.
+    '''
+    n = keep.shape[1]
+    team_idx = jnp.arange(2)[:, None]
+    # scatter only the idx with prefix sums, then gather all leaves with it once.
+    dst_idx = jnp.where(keep, jnp.cumsum(keep, axis=1) - 1, n)  # int[2, N], dropped objects go out of range
+    src_idx = jnp.full(keep.shape, n - 1).at[team_idx, dst_idx].set(jnp.arange(n), mode='drop')  # int[2, N]
+    is_kept = jnp.arange(n) < keep.sum(axis=1, keepdims=True)  # bool[2, N]
+    objs = jax.tree_map(lambda x: x[team_idx, src_idx], objs)
+    empty = jax.tree_map(lambda x: jnp.array(x)[None, None], empty)
+    objs = jux.tree_util.tree_where(is_kept, objs, empty)
+    return objs, src_idx
+
+
+def any_in_batch(x: Array, batch_axis_name: Optional[str] = None) -> Array:
+    '''
+    `x.any()`, also reduced over the named `jax.vmap` axis `batch_axis_name` if given. The result is then the same
+    for all envs in the batch, so `jax.lax.cond` on it stays a real branch instead of being turned into `select` by
+    `jax.vmap`.
+    '''
+    any_ = x.any()
+    if batch_axis_name is not None:
+        any_ = jax.lax.pmax(any_.astype(jnp.int32), batch_axis_name) > 0
+    return any_
+
+
+def keep_dtypes(step_fn: Callable) -> Callable:
+    """
+    Run a step of `State` in the default dtypes, and narrow the new state back if the given state has compact dtypes.
+    The compact layout is for storage only, see `State.compact_dtypes()`.
+    """
+
+    @functools.wraps(step_fn)
+    def _step_fn(self: 'State', *args, **kwargs) -> 'State':
+        compact = self.has_compact_dtypes
+        self = step_fn(self.default_dtypes(), *args, **kwargs)
+        return self.compact_dtypes() if compact else self
+
+    return _step_fn
+
+
 batch_into_leaf_jitted = jax.jit(jux.tree_util.batch_into_leaf, static_argnames=('axis', ))
 
 
+class Features(NamedTuple):
+    """
+    Observation features of one player, see `State.to_features()`. Features are relative to the player, i.e.
+    `my_*` refers to the player, and `opp_*` to its opponent. Bounded quantities are divided by their maximum in
+    `EnvConfig`, while unbounded ones (factory cargo and power, team resources) are kept as they are.
+    """
+    spatial: Array  # float32[..., H, W, len(SPATIAL_CHANNELS)]
+    scalars: Array  # float32[..., len(SCALAR_FEATURES)]
+
+    SPATIAL_CHANNELS = (
+        'rubble',
+        'ice',
+        'ore',
+        'lichen',
+        'my_lichen',
+        'opp_lichen',
+        'valid_spawn',
+        'my_light',
+        'my_heavy',
+        'opp_light',
+        'opp_heavy',
+        'unit_power',
+        'unit_ice',
+        'unit_ore',
+        'unit_water',
+        'unit_metal',
+        'my_factory',
+        'opp_factory',
+        'factory_ice',
+        'factory_ore',
+        'factory_water',
+        'factory_metal',
+        'factory_power',
+        'is_day',
+    )
+    SCALAR_FEATURES = (
+        'step',
+        'is_day',
+        'cycle_phase',
+        'my_n_factories',
+        'opp_n_factories',
+        'my_n_lights',
+        'opp_n_lights',
+        'my_n_heavies',
+        'opp_n_heavies',
+        'my_lichen_score',
+        'opp_lichen_score',
+        'my_ice',
+        'opp_ice',
+        'my_ore',
+        'opp_ore',
+        'my_water',
+        'opp_water',
+        'my_metal',
+        'opp_metal',
+        'my_power',
+        'opp_power',
+        'my_factories_to_place',
+        'opp_factories_to_place',
+        'my_init_water',
+        'opp_init_water',
+        'my_init_metal',
+        'opp_init_metal',
+        'my_place_next',
+    )
+
+
 class State(NamedTuple):
     env_cfg: EnvConfig
 
@@ -45,15 +165,12 @@ class State(NamedTuple):
     board: Board
 
     # the unit_id and team_id of non-existent units are jnp.iinfo(jnp.int32).max
-    units: Unit  # Unit[2, U]
-
-    # the idx of non-existent units is jnp.iinfo(jnp.int32).max
-    unit_id2idx: Unit.id_dtype()  # int16[MAX_GLOBAL_ID, 2]
+    units: Unit  # Unit[2, U], units of each team are sorted by unit_id
     n_units: Unit.id_dtype()  # int16[2]
     '''
-    The `unit_id2idx` is organized such that
+    Units of each team are sorted by `unit_id`, so `unit_id2idx()` finds units by binary search, such that
     ```
-    [team_id, unit_idx] = unit_id2idx[unit_id]
+    [team_id, unit_idx] = state.unit_id2idx(unit_id)
     assert units[team_id, unit_idx].unit_id == unit_id
     ```
 
@@ -94,10 +211,6 @@ class State(NamedTuple):
     def UNIT_ACTION_QUEUE_SIZE(self):
         return self.units.action_queue.capacity
 
-    @property
-    def MAX_GLOBAL_ID(self):
-        return self.unit_id2idx.shape[-2]
-
     @property
     def factory_idx(self):
         factory_idx = jnp.array(
@@ -162,7 +275,6 @@ class State(NamedTuple):
         empty_unit = jax.tree_map(lambda x: x if isinstance(x, Array) else np.array(x), empty_unit)
         units = jax.tree_map(lambda x: x[None].repeat(buf_cfg.MAX_N_UNITS, axis=0), empty_unit)
         units = jax.tree_map(lambda x: x[None].repeat(2, axis=0), units)
-        unit_id2idx = State.generate_unit_id2idx(units, buf_cfg.MAX_GLOBAL_ID)
         n_units = jnp.zeros(shape=(2, ), dtype=Unit.id_dtype())
 
         empty_factory = Factory.empty()
@@ -180,13 +292,16 @@ class State(NamedTuple):
             env_steps=State.__annotations__['env_steps'](0),
             board=board,
             units=units,
-            unit_id2idx=unit_id2idx,
             n_units=n_units,
             factories=factories,
             factory_id2idx=factory_id2idx,
             n_factories=n_factories,
             teams=teams,
         )
+        if buf_cfg.COMPACT_DTYPES:
+            state = state.compact_dtypes()
+        if buf_cfg.PACKED_ACTION_QUEUE:
+            state = state.pack_action_queues()
         return state
 
     @classmethod
@@ -223,7 +338,6 @@ class State(NamedTuple):
                 return units, n_units
 
             units, n_units = convert_units(lux_state.units)
-            unit_id2idx = State.generate_unit_id2idx(units, buf_cfg.MAX_GLOBAL_ID)
 
             # convert factories
             def convert_factories(lux_factories: LuxFactory) -> Tuple[Factory, Array]:
@@ -274,7 +388,6 @@ class State(NamedTuple):
                 board=Board.from_lux(lux_state.board, buf_cfg),
                 units=units,
                 n_units=n_units,
-                unit_id2idx=unit_id2idx,
                 factories=factories,
                 n_factories=n_factories,
                 factory_id2idx=factory_id2idx,
@@ -282,35 +395,41 @@ class State(NamedTuple):
                 global_id=State.__annotations__['global_id'](lux_state.global_id),
                 place_first=place_first,
             )
+        if buf_cfg.COMPACT_DTYPES:
+            state = state.compact_dtypes()
+        if buf_cfg.PACKED_ACTION_QUEUE:
+            state = state.pack_action_queues()
         state = jax.device_put(state, jax.devices()[0])
         # state.check_id2idx()
         return state
 
-    @staticmethod
-    def generate_unit_id2idx(units: Unit, max_global_id: int) -> Array:
+    def unit_id2idx(self, unit_id: Array) -> Array:
         '''
-        organize unit_id2idx such that
-            unit_id2idx[unit_id] == [team_id, unit_idx]
+        Find units by unit_id, such that
+            [team_id, unit_idx] = state.unit_id2idx(unit_id)
             units[team_id, unit_idx].unit_id == unit_id
+        Units of each team are sorted by unit_id, so it is a binary search over the unit buffer.
+
+        Args:
+            unit_id: int[...], unit ids to find. For batched states, it has the same leading batch dimensions.
+
+        Returns:
+            int[..., 2], [team_id, unit_idx] of each unit. It is INT_MAX of `Unit.id_dtype()` for non-existent units.
         '''
-        units.unit_id: Array
-        max_n_units = units.unit_id.shape[-1]
-        unit_id2idx = jnp.ones((max_global_id, 2), dtype=Unit.id_dtype()) * imax(Unit.id_dtype())
-        unit_id2idx = unit_id2idx.at[units.unit_id[..., 0, :]].set(
-            jnp.array(
-                [jnp.zeros(max_n_units), jnp.arange(max_n_units)],
-                dtype=Unit.id_dtype(),
-            ).T,
-            mode='drop',
-        )
-        unit_id2idx = unit_id2idx.at[units.unit_id[..., 1, :]].set(
-            jnp.array(
-                [jnp.ones(max_n_units), jnp.arange(max_n_units)],
-                dtype=Unit.id_dtype(),
-            ).T,
-            mode='drop',
-        )
-        return unit_id2idx
+        if self.n_units.ndim > 1:
+            return jax.vmap(State.unit_id2idx)(self, unit_id)
+
+        unit_id = jnp.asarray(unit_id)
+        unit_idx = jax.vmap(jnp.searchsorted, in_axes=(0, None))(self.units.unit_id, unit_id)  # int[2, ...]
+        unit_idx = jnp.minimum(unit_idx, self.MAX_N_UNITS - 1)
+        team_idx = jnp.arange(2).reshape((2, ) + (1, ) * unit_id.ndim)
+        found = (self.units.unit_id[team_idx, unit_idx] == unit_id) \
+            & (unit_idx < self.n_units.reshape(team_idx.shape))  # bool[2, ...]
+
+        # a unit belongs to at most one team
+        id2idx = jnp.stack([found[1], jnp.where(found[1], unit_idx[1], unit_idx[0])], axis=-1)
+        id2idx = jnp.where(found.any(axis=0)[..., None], id2idx, imax(Unit.id_dtype()))
+        return id2idx.astype(Unit.id_dtype())
 
     @staticmethod
     def generate_factory_id2idx(factories: Factory, max_n_factories: int) -> Array:
@@ -332,16 +451,124 @@ class State(NamedTuple):
         )
         return factory_id2idx
 
+    def resize_units(self, max_n_units: int) -> "State":
+        """
+        Re-pad the unit buffer to `max_n_units`, with empty units appended or trailing empty slots removed.
+        Units are kept at the same idx, so `board.units_map` stays valid. It works on batched
+        states, and is jittable with `max_n_units` static.
+
+        Args:
+            max_n_units (int): the new `MAX_N_UNITS`. It must be no less than `n_units`, otherwise units beyond
+                it are lost.
+
+        Returns:
+            State: the state with unit buffer of size `max_n_units`.
+        """
+        axis = self.n_units.ndim  # the unit dimension, following batch and team dimensions
+        if max_n_units <= self.MAX_N_UNITS:
+            units = jax.tree_map(lambda x: jax.lax.slice_in_dim(x, 0, max_n_units, axis=axis), self.units)
+        else:
+            n_pad = max_n_units - self.MAX_N_UNITS
+
+            def _pad(x, empty):
+                padding = jnp.broadcast_to(jnp.asarray(empty, x.dtype), x.shape[:axis] + (n_pad, ) + x.shape[axis + 1:])
+                return jnp.concatenate([x, padding], axis=axis)
+
+            units = jax.tree_map(_pad, self.units, self._empty_unit())
+        return self._replace(units=units)
+
+    def _bounded_dtypes(self, compact: bool) -> Tuple[type, type, type]:
+        # dtypes of board.lichen, units.power and units.cargo.stock
+        if not compact:
+            return Board.__annotations__['lichen'], Unit.__annotations__['power'], UnitCargo.__annotations__['stock']
+        env_cfg = self.env_cfg
+        return (
+            narrowest_int(env_cfg.MAX_LICHEN_PER_TILE),
+            narrowest_int(max(robot.BATTERY_CAPACITY for robot in env_cfg.ROBOTS)),
+            narrowest_int(max(robot.CARGO_SPACE for robot in env_cfg.ROBOTS)),
+        )
+
+    def _cast_bounded(self, dtypes: Tuple[type, type, type]) -> 'State':
+        lichen_dtype, power_dtype, stock_dtype = dtypes
+        return self._replace(
+            board=self.board._replace(lichen=checked_astype(self.board.lichen, lichen_dtype)),
+            units=self.units._replace(
+                power=checked_astype(self.units.power, power_dtype),
+                cargo=self.units.cargo._replace(stock=checked_astype(self.units.cargo.stock, stock_dtype)),
+            ),
+        )
+
+    def compact_dtypes(self) -> 'State':
+        """
+        Narrow quantities bounded by `EnvConfig` to the smallest integer dtypes holding their bounds, which is the
+        layout selected by `JuxBufferConfig.COMPACT_DTYPES`:
+            board.lichen: int8, bounded by `MAX_LICHEN_PER_TILE`.
+            units.power: int16, bounded by `BATTERY_CAPACITY` of robots.
+            units.cargo.stock: int16, bounded by `CARGO_SPACE` of robots.
+        A quantity stays in its default dtype if its bound does not fit. Factory power and cargo are unbounded, so
+        they are not narrowed.
+
+        It is a storage layout only. Steps widen the state to the default dtypes on entry, compute in them, and
+        narrow the new state back on exit, so the compact layout saves memory between steps, e.g. in replay buffers
+        or large batches kept on device, but adds two conversions to every step, and does not reduce the memory
+        traffic inside it. Steps never produce out-of-range values, as game logic clips lichen, power and cargo of
+        robots to their bounds. It works on batched states, and is jittable.
+
+        Raises:
+            OverflowError: if a value is out of the range of its compact dtype. Only concrete values are checked, so
+                values traced under `jax.jit` or `jax.vmap`, including those narrowed at the end of a step, are
+                cast without checking.
+
+        Returns:
+            State: the state in the compact layout.
+        """
+        return self._cast_bounded(self._bounded_dtypes(compact=True))
+
+    def default_dtypes(self) -> 'State':
+        """Widen a state in the compact layout back to the default dtypes, see `compact_dtypes()`."""
+        return self._cast_bounded(self._bounded_dtypes(compact=False))
+
+    @property
+    def has_compact_dtypes(self) -> bool:
+        dtypes = (self.board.lichen.dtype, self.units.power.dtype, self.units.cargo.stock.dtype)
+        return dtypes != tuple(map(jnp.dtype, self._bounded_dtypes(compact=False)))
+
+    def pack_action_queues(self) -> 'State':
+        """
+        Store action queues of units as `PackedUnitAction`, two int32 words per action instead of six fields, which
+        is the layout selected by `JuxBufferConfig.PACKED_ACTION_QUEUE`. Reading the next action and pushing it back
+        then gathers and scatters two buffers instead of six. Steps keep the layout of the given state.
+
+        Packing is lossless for valid actions, which are the only actions in queues of a game in progress.
+        It works on batched states, and is jittable.
+
+        Returns:
+            State: the state with packed action queues.
+        """
+        return self._replace(units=self.units._replace(action_queue=self.units.action_queue.pack()))
+
+    def unpack_action_queues(self) -> 'State':
+        """Store action queues of units as `UnitAction` again, see `pack_action_queues()`."""
+        return self._replace(units=self.units._replace(action_queue=self.units.action_queue.unpack()))
+
+    def _like_units(self, units: Unit) -> Unit:
+        # `units` with the action queue layout of `self.units`
+        queue = units.action_queue.pack() if self.units.action_queue.is_packed else units.action_queue.unpack()
+        return units._replace(action_queue=queue)
+
+    def _empty_unit(self) -> Unit:
+        return self._like_units(Unit.empty(self.env_cfg))
+
     def check_id2idx(self):
         n_units = self.n_units[0]
         unit_id = self.units.unit_id[0, :n_units]
-        unit_id2idx = self.unit_id2idx[unit_id]
+        unit_id2idx = self.unit_id2idx(unit_id)
         assert jnp.array_equiv(unit_id2idx[:, 0], 0)
         assert jnp.array_equal(unit_id2idx[:, 1], jnp.arange(n_units))
 
         n_units = self.n_units[1]
         unit_id = self.units.unit_id[1, :n_units]
-        unit_id2idx = self.unit_id2idx[unit_id]
+        unit_id2idx = self.unit_id2idx(unit_id)
         assert jnp.array_equiv(unit_id2idx[:, 0], 1)
         assert jnp.array_equal(unit_id2idx[:, 1], jnp.arange(n_units))
 
@@ -358,6 +585,7 @@ class State(NamedTuple):
         assert jnp.array_equal(factory_id2idx[:, 1], jnp.arange(n_factories))
 
     def to_lux(self) -> LuxState:
+        self = self.default_dtypes()
         lux_env_cfg = self.env_cfg.to_lux()
 
         # convert teams
@@ -479,6 +707,7 @@ class State(NamedTuple):
         chex.assert_shape(actions.unit_action_queue_count, (2, self.MAX_N_UNITS))
         chex.assert_shape(actions.unit_action_queue_update, (2, self.MAX_N_UNITS))
 
+    @keep_dtypes
     def _step_bid(self, bid: Array, faction: Array) -> 'State':
         """The initial bidding step.
 
@@ -582,6 +811,7 @@ class State(NamedTuple):
             *(self, team_id, pos, water, metal),
         )
 
+    @keep_dtypes
     def _step_factory_placement(self, spawn, water, metal) -> 'State':
         """
         The early game step for factory placement. Only half of input arrays is
@@ -627,153 +857,206 @@ class State(NamedTuple):
         )
         return self
 
-    def _step_late_game(self, actions: JuxAction) -> 'State':
+    @keep_dtypes
+    def _step_late_game(self,
+                        actions: JuxAction,
+                        skip_unused_actions: bool = False,
+                        batch_axis_name: Optional[str] = None) -> 'State':
+        '''
+        Args:
+            actions: JuxAction, actions of both players.
+            skip_unused_actions: bool, if True, handlers of self-destruct, factory build, transfer and pickup
+                actions are wrapped in `jax.lax.cond`, and skipped when no unit or factory takes the action.
+            batch_axis_name: str, optional. The axis name of `jax.vmap` over a batch of states. If given, the skip
+                decision is reduced over the batch, so `jax.lax.cond` stays a real branch instead of being turned
+                into `select` by `jax.vmap`, and a handler is skipped only if no env in the batch takes the action.
+                Likewise, dead units and factories are only compacted if any env in the batch has one.
+
+        Returns:
+            State: the new state.
+        '''
         real_env_steps = self.real_env_steps
         unit_mask = self.unit_mask
         factory_mask = self.factory_mask
 
         # 1. Check for malformed actions
-        failed_players = jnp.zeros((2, ), dtype=np.bool_)
-
-        # check factories
-        failed_factory = ((actions.factory_action < FactoryAction.DO_NOTHING) |
-                          (actions.factory_action > FactoryAction.WATER))
-        failed_factory = failed_factory & factory_mask
-        chex.assert_shape(failed_factory, (2, self.MAX_N_FACTORIES))
-        failed_factory = jnp.any(failed_factory, axis=-1)
-        chex.assert_shape(failed_factory, (2, ))
-        failed_players = failed_players | failed_factory
-
-        # check units
-        action_mask = jnp.arange(self.UNIT_ACTION_QUEUE_SIZE, dtype=ActionQueue.__annotations__['count'])
-        action_mask = jnp.repeat(
-            action_mask[None, :],
-            2 * self.MAX_N_UNITS,
-            axis=-2,
-        ).reshape((2, self.MAX_N_UNITS, -1))  # bool[2, U, Q]
-        chex.assert_shape(action_mask, (2, self.MAX_N_UNITS, self.UNIT_ACTION_QUEUE_SIZE))
-        action_mask = action_mask < actions.unit_action_queue_count[..., None]  # bool[2, U, Q]
-        chex.assert_shape(action_mask, (2, self.MAX_N_UNITS, self.UNIT_ACTION_QUEUE_SIZE))
+        with jax.named_scope('validate_actions'):
+            failed_players = jnp.zeros((2, ), dtype=np.bool_)
+
+            # check factories
+            failed_factory = ((actions.factory_action < FactoryAction.DO_NOTHING) |
+                              (actions.factory_action > FactoryAction.WATER))
+            failed_factory = failed_factory & factory_mask
+            chex.assert_shape(failed_factory, (2, self.MAX_N_FACTORIES))
+            failed_factory = jnp.any(failed_factory, axis=-1)
+            chex.assert_shape(failed_factory, (2, ))
+            failed_players = failed_players | failed_factory
+
+            # check units
+            action_mask = jnp.arange(self.UNIT_ACTION_QUEUE_SIZE, dtype=ActionQueue.__annotations__['count'])
+            action_mask = jnp.repeat(
+                action_mask[None, :],
+                2 * self.MAX_N_UNITS,
+                axis=-2,
+            ).reshape((2, self.MAX_N_UNITS, -1))  # bool[2, U, Q]
+            chex.assert_shape(action_mask, (2, self.MAX_N_UNITS, self.UNIT_ACTION_QUEUE_SIZE))
+            action_mask = action_mask < actions.unit_action_queue_count[..., None]  # bool[2, U, Q]
+            chex.assert_shape(action_mask, (2, self.MAX_N_UNITS, self.UNIT_ACTION_QUEUE_SIZE))
 
-        failed_players = failed_players | (actions.unit_action_queue_update & ~unit_mask).any(-1)
+            failed_players = failed_players | (actions.unit_action_queue_update & ~unit_mask).any(-1)
 
-        failed_action = ~actions.unit_action_queue.is_valid(self.env_cfg.max_transfer_amount)  # bool[2, U, Q]
-        failed_action = failed_action & action_mask
-        failed_action = failed_action.any(-1).any(-1)
-        chex.assert_shape(failed_action, (2, ))
-        failed_players = failed_players | failed_action
+            failed_action = ~actions.unit_action_queue.is_valid(self.env_cfg.max_transfer_amount)  # bool[2, U, Q]
+            failed_action = failed_action & action_mask
+            failed_action = failed_action.any(-1).any(-1)
+            chex.assert_shape(failed_action, (2, ))
+            failed_players = failed_players | failed_action
 
         # update units action queue
-        action_queue_power_cost = jnp.array(
-            [unit_cfg.ACTION_QUEUE_POWER_COST for unit_cfg in self.env_cfg.ROBOTS],
-            dtype=Unit.__annotations__['power'],
-        )
-        update_power_req = action_queue_power_cost[self.units.unit_type]
-        chex.assert_shape(update_power_req, (2, self.MAX_N_UNITS))
-        update_queue = actions.unit_action_queue_update & unit_mask & (update_power_req <= self.units.power)
-        new_power = jnp.where(update_queue, self.units.power - update_power_req, self.units.power)
-        chex.assert_shape(new_power, (2, self.MAX_N_UNITS))
-        new_action_queue = jux.actions.ActionQueue(
-            data=jux.tree_util.tree_where(
-                update_queue[..., None],
-                actions.unit_action_queue,
-                self.units.action_queue.data,
-            ),
-            count=jnp.where(update_queue, actions.unit_action_queue_count, self.units.action_queue.count),
-            front=jnp.where(update_queue, 0, self.units.action_queue.front),
-            rear=jnp.where(update_queue, actions.unit_action_queue_count, self.units.action_queue.rear),
-        )
-        new_self: State = self._replace(units=self.units._replace(
-            power=new_power,
-            action_queue=new_action_queue,
-        ))
-        chex.assert_trees_all_equal_shapes(new_self, self)
-        self = new_self
-
-        # get next actions
-        unit_action = jax.vmap(jax.vmap(Unit.next_action))(self.units)
-        unit_action = jux.tree_util.tree_where(
-            unit_mask & ~failed_players[..., None],
-            unit_action,
-            UnitAction.do_nothing(),
-        )
-        factory_actions = jnp.where(
-            factory_mask & ~failed_players[..., None],
-            actions.factory_action,
-            FactoryAction.DO_NOTHING,
-        )
+        with jax.named_scope('update_action_queue'):
+            action_queue_power_cost = jnp.array(
+                [unit_cfg.ACTION_QUEUE_POWER_COST for unit_cfg in self.env_cfg.ROBOTS],
+                dtype=Unit.__annotations__['power'],
+            )
+            update_power_req = action_queue_power_cost[self.units.unit_type]
+            chex.assert_shape(update_power_req, (2, self.MAX_N_UNITS))
+            update_queue = actions.unit_action_queue_update & unit_mask & (update_power_req <= self.units.power)
+            new_power = jnp.where(update_queue, self.units.power - update_power_req, self.units.power)
+            chex.assert_shape(new_power, (2, self.MAX_N_UNITS))
+            new_action_queue = jux.actions.ActionQueue(
+                data=jux.tree_util.tree_where(
+                    update_queue[..., None],
+                    self.units.action_queue.to_layout(actions.unit_action_queue),
+                    self.units.action_queue.data,
+                ),
+                count=jnp.where(update_queue, actions.unit_action_queue_count, self.units.action_queue.count),
+                front=jnp.where(update_queue, 0, self.units.action_queue.front),
+                rear=jnp.where(update_queue, actions.unit_action_queue_count, self.units.action_queue.rear),
+            )
+            new_self: State = self._replace(units=self.units._replace(
+                power=new_power,
+                action_queue=new_action_queue,
+            ))
+            chex.assert_trees_all_equal_shapes(new_self, self)
+            self = new_self
+
+            # get next actions
+            unit_action = self.units.next_action()
+            unit_action = jux.tree_util.tree_where(
+                unit_mask & ~failed_players[..., None],
+                unit_action,
+                UnitAction.do_nothing(),
+            )
+            factory_actions = jnp.where(
+                factory_mask & ~failed_players[..., None],
+                actions.factory_action,
+                FactoryAction.DO_NOTHING,
+            )
 
         # 3. validating all actions against current state is not implemented here, but implemented in each action.
-        valid_movement, movement_power_cost = self._validate_movement_actions(unit_action)
-
-        action_info = dict(
-            valid_transfer=self._validate_transfer_actions(unit_action),  # bool[2, U]
-            valid_pickup=self._validate_pickup_actions(unit_action),  # bool[2, U]
-            valid_dig=self._validate_dig_actions(unit_action),  # bool[2, U]
-            valid_self_destruct=self._validate_self_destruct_actions(unit_action),  # bool[2, U]
-            valid_factory_build=self._validate_factory_build_actions(factory_actions),  # bool[2, F]
-            movement_info=dict(
-                valid=valid_movement,  # bool[2, U]
-                power_cost=movement_power_cost,  # int[2, U]
-            ),
-            valid_recharge=self._validate_recharge_actions(unit_action),
-        )
+        with jax.named_scope('validate_actions'):
+            valid_movement, movement_power_cost = self._validate_movement_actions(unit_action)
+
+            action_info = dict(
+                valid_transfer=self._validate_transfer_actions(unit_action),  # bool[2, U]
+                valid_pickup=self._validate_pickup_actions(unit_action),  # bool[2, U]
+                valid_dig=self._validate_dig_actions(unit_action),  # bool[2, U]
+                valid_self_destruct=self._validate_self_destruct_actions(unit_action),  # bool[2, U]
+                valid_factory_build=self._validate_factory_build_actions(factory_actions),  # bool[2, F]
+                movement_info=dict(
+                    valid=valid_movement,  # bool[2, U]
+                    power_cost=movement_power_cost,  # int[2, U]
+                ),
+                valid_recharge=self._validate_recharge_actions(unit_action),
+            )
 
         # 4. execute actions.
-        self = self._handle_dig_actions(unit_action, action_info['valid_dig'])
-        self, dead = self._handle_self_destruct_actions(unit_action, action_info['valid_self_destruct'])
-        self = self._handle_factory_build_actions(factory_actions, action_info['valid_factory_build'])
-        self, new_dead = self._handle_movement_actions(unit_action, action_info['movement_info'], dead)
-        dead = dead | new_dead
-        # Not all valid recharge actions are executed successfully, there is a `suc` indicator returned.
-        self, recharge_success = self._handle_recharge_actions(unit_action, action_info['valid_recharge'])
-
-        self = self.add_rubble_for_dead_units(dead)
-
-        color, grow_lichen_size, connected_lichen_size = self._cache_water_info(factory_actions)
-        self = self._handle_factory_water_actions(factory_actions, color, grow_lichen_size)
-        self = self._handle_transfer_actions(unit_action, action_info['valid_transfer'])
-        self = self._handle_pickup_actions(unit_action, action_info['valid_pickup'])
+        def _skip_if_unused(handler: Callable, no_op: Callable) -> Callable:
+            if not skip_unused_actions:
+                return handler
+
+            def _handler(self: 'State', actions, valid: Array):
+                used = any_in_batch(valid, batch_axis_name)
+                return jax.lax.cond(used, handler, no_op, self, actions, valid)
+
+            return _handler
+
+        handle_self_destruct_actions = _skip_if_unused(State._handle_self_destruct_actions,
+                                                       lambda self, actions, valid: (self, valid))
+        handle_factory_build_actions = _skip_if_unused(State._handle_factory_build_actions,
+                                                       lambda self, actions, valid: self)
+        handle_transfer_actions = _skip_if_unused(State._handle_transfer_actions, lambda self, actions, valid: self)
+        handle_pickup_actions = _skip_if_unused(State._handle_pickup_actions, lambda self, actions, valid: self)
+
+        with jax.named_scope('dig'):
+            self = self._handle_dig_actions(unit_action, action_info['valid_dig'])
+        with jax.named_scope('self_destruct'):
+            self, dead = handle_self_destruct_actions(self, unit_action, action_info['valid_self_destruct'])
+        with jax.named_scope('factory_build'):
+            self = handle_factory_build_actions(self, factory_actions, action_info['valid_factory_build'])
+        with jax.named_scope('movement'):
+            self, new_dead = self._handle_movement_actions(unit_action, action_info['movement_info'], dead)
+            dead = dead | new_dead
+        with jax.named_scope('recharge'):
+            # Not all valid recharge actions are executed successfully, there is a `suc` indicator returned.
+            self, recharge_success = self._handle_recharge_actions(unit_action, action_info['valid_recharge'])
+
+        with jax.named_scope('destroy'):
+            self = self.add_rubble_for_dead_units(dead)
+
+        with jax.named_scope('water'):
+            color, grow_lichen_size, connected_lichen_size = self._cache_water_info(factory_actions)
+            self = self._handle_factory_water_actions(factory_actions, color, grow_lichen_size)
+        with jax.named_scope('transfer'):
+            self = handle_transfer_actions(self, unit_action, action_info['valid_transfer'])
+        with jax.named_scope('pickup'):
+            self = handle_pickup_actions(self, unit_action, action_info['valid_pickup'])
 
         # handle action pop and repeat
-        success = (
-            action_info['valid_dig'] | \
-            recharge_success | \
-            action_info['movement_info']['valid'] | \
-            action_info['valid_transfer'] | \
-            action_info['valid_pickup']
-        )
-        units = jax.vmap(jax.vmap(Unit.repeat_action))(self.units, success)
-        self = self._replace(units=units)
+        with jax.named_scope('repeat_action'):
+            success = (
+                action_info['valid_dig'] | \
+                recharge_success | \
+                action_info['movement_info']['valid'] | \
+                action_info['valid_transfer'] | \
+                action_info['valid_pickup']
+            )
+            units = self.units.repeat_action(success)
+            self = self._replace(units=units)
 
         # destroy dead units
-        self, _ = self.destroy_unit(dead)
+        with jax.named_scope('destroy'):
+            self, _ = self.destroy_unit(dead, batch_axis_name)
 
         # update lichen
-        new_lichen = self.board.lichen - 1
-        new_lichen = new_lichen.clip(0, self.env_cfg.MAX_LICHEN_PER_TILE)
-        new_lichen_strains = jnp.where(new_lichen == 0, imax(self.board.lichen_strains.dtype),
-                                       self.board.lichen_strains)
-        self = self._replace(board=self.board._replace(
-            lichen=new_lichen,
-            lichen_strains=new_lichen_strains,
-        ))
+        with jax.named_scope('lichen'):
+            new_lichen = self.board.lichen - 1
+            new_lichen = new_lichen.clip(0, self.env_cfg.MAX_LICHEN_PER_TILE)
+            new_lichen_strains = jnp.where(new_lichen == 0, imax(self.board.lichen_strains.dtype),
+                                           self.board.lichen_strains)
+            self = self._replace(board=self.board._replace(
+                lichen=new_lichen,
+                lichen_strains=new_lichen_strains,
+            ))
 
         # resources refining
-        factories = self.factories.refine_step(self.env_cfg)
-        water_cost = self.env_cfg.FACTORY_WATER_CONSUMPTION * self.factory_mask
-        stock = factories.cargo.stock.at[..., ResourceType.water].add(-water_cost)
-        factories = factories._replace(cargo=factories.cargo._replace(stock=stock))
-        self = self._replace(factories=factories)
+        with jax.named_scope('refine'):
+            factories = self.factories.refine_step(self.env_cfg)
+            water_cost = self.env_cfg.FACTORY_WATER_CONSUMPTION * self.factory_mask
+            stock = factories.cargo.stock.at[..., ResourceType.water].add(-water_cost)
+            factories = factories._replace(cargo=factories.cargo._replace(stock=stock))
+            self = self._replace(factories=factories)
 
         # factories gain power
-        delta_power = self.env_cfg.FACTORY_CHARGE + connected_lichen_size * self.env_cfg.POWER_PER_CONNECTED_LICHEN_TILE
-        new_factory_power = self.factories.power + jnp.where(self.factory_mask, delta_power, 0)
-        self = self._replace(factories=self.factories._replace(power=new_factory_power))
+        with jax.named_scope('power'):
+            delta_power = self.env_cfg.FACTORY_CHARGE + \
+                connected_lichen_size * self.env_cfg.POWER_PER_CONNECTED_LICHEN_TILE
+            new_factory_power = self.factories.power + jnp.where(self.factory_mask, delta_power, 0)
+            self = self._replace(factories=self.factories._replace(power=new_factory_power))
 
         # destroy factories without water
-        factories_to_destroy = (self.factories.cargo.water < 0)  # noqa
-        self = self.destroy_factories(factories_to_destroy)
+        with jax.named_scope('destroy'):
+            factories_to_destroy = (self.factories.cargo.water < 0)  # noqa
+            self = self.destroy_factories(factories_to_destroy, batch_axis_name)
 
         # power gain
         def _gain_power(self: 'State') -> Unit:
@@ -781,12 +1064,13 @@ class State(NamedTuple):
             new_units = new_units._replace(power=new_units.power * self.unit_mask)
             return new_units
 
-        self = self._replace(units=jax.lax.cond(
-            is_day(self.env_cfg, real_env_steps),
-            _gain_power,
-            lambda self: self.units,
-            self,
-        ))
+        with jax.named_scope('power'):
+            self = self._replace(units=jax.lax.cond(
+                is_day(self.env_cfg, real_env_steps),
+                _gain_power,
+                lambda self: self.units,
+                self,
+            ))
         '''
         # this if statement is same as above jax.lax.cond
         if is_day(self.env_cfg, real_env_steps):
@@ -822,63 +1106,33 @@ class State(NamedTuple):
         there_is_a_factory = target_factory_idx[..., 1] < self.n_factories[target_factory_idx[..., 0]]  # bool[2, U]
 
         target_unit_id = self.board.units_map[target_pos.x, target_pos.y]  # int[2, U]
-        target_unit_idx = self.unit_id2idx.at[target_unit_id] \
-                                          .get(mode='fill', fill_value=imax(self.unit_id2idx.dtype))  # int[2, U, 2]
+        target_unit_idx = self.unit_id2idx(target_unit_id)  # int[2, U, 2]
         there_is_an_unit = target_unit_idx[..., 1] < self.n_units[target_unit_idx[..., 0]]  # bool[2, U]
 
         transfer_to_factory = valid & there_is_a_factory  # bool[2, U]
         transfer_to_unit = valid & ~there_is_a_factory & there_is_an_unit  # bool[2, U]
-        is_power = (actions.resource_type == ResourceType.power)
 
         # deduce from unit
         transfer_amount = jnp.where(valid, actions.amount, 0)  # int[2, U]
-        units, transfer_amount = jax.vmap(jax.vmap(Unit.sub_resource))(
-            self.units,
-            actions.resource_type,
-            transfer_amount,
-        )
+        units, transfer_amount = self.units.sub_resource(actions.resource_type, transfer_amount)
         self = self._replace(units=units)
 
         # transfer to factory
-        transferred_resource = jnp.where(transfer_to_factory & ~is_power, transfer_amount, 0)  # int[2, U]
-        transferred_power = jnp.where(transfer_to_factory & is_power, transfer_amount, 0)  # int[2, U]
-        factory_stock = self.factories.cargo.stock.at[(
+        factory_ledger = self.factories.ledger.at[(
             target_factory_idx[..., 0],
             target_factory_idx[..., 1],
             actions.resource_type,
-        )].add(transferred_resource, mode='drop')  # int[2, F, 4]
-        factory_power = self.factories.power.at[(
-            target_factory_idx[..., 0],
-            target_factory_idx[..., 1],
-        )].add(transferred_power, mode='drop')  # int[2, F]
-        factories = self.factories._replace(
-            cargo=UnitCargo(factory_stock),
-            power=factory_power,
-        )
-        self = self._replace(factories=factories)
+        )].add(jnp.where(transfer_to_factory, transfer_amount, 0), mode='drop')  # int[2, F, 5]
+        self = self._replace(factories=self.factories.replace_ledger(factory_ledger))
 
         # transfer to unit
-        transferred_resource = jnp.where(transfer_to_unit & ~is_power, transfer_amount, 0)  # int[2, U]
-        transferred_power = jnp.where(transfer_to_unit & is_power, transfer_amount, 0)  # int[2, U]
-        unit_stock = self.units.cargo.stock.at[(
+        unit_ledger = self.units.ledger.at[(
             target_unit_idx[..., 0],
             target_unit_idx[..., 1],
             actions.resource_type,
-        )].add(transferred_resource, mode='drop')  # int[2, U, 4]
-        cargo_space = self.units.get_cfg("CARGO_SPACE", self.env_cfg.ROBOTS)
-        unit_stock = jnp.minimum(unit_stock, cargo_space[..., None])  # int[2, U, 4]
-
-        unit_power = self.units.power.at[(
-            target_unit_idx[..., 0],
-            target_unit_idx[..., 1],
-        )].add(transferred_power, mode='drop')  # int[2, U]
-        battery_capacity = self.units.get_cfg("BATTERY_CAPACITY", self.env_cfg.ROBOTS)
-        unit_power = jnp.minimum(unit_power, battery_capacity)  # int[2, U]
-        units = self.units._replace(
-            cargo=UnitCargo(unit_stock),
-            power=unit_power,
-        )
-        self = self._replace(units=units)
+        )].add(jnp.where(transfer_to_unit, transfer_amount, 0), mode='drop')  # int[2, U, 5]
+        unit_ledger = jnp.minimum(unit_ledger, self.units.ledger_capacity(self.env_cfg.ROBOTS))  # int[2, U, 5]
+        self = self._replace(units=self.units.replace_ledger(unit_ledger))
 
         return self
         # pytype: enable=attribute-error
@@ -919,7 +1173,7 @@ class State(NamedTuple):
         units_map = board.units_map  # int[H, W]
         unit_id_on_factory = units_map[occupy_pos.x, occupy_pos.y]
         unit_id_on_factory = jnp.sort(unit_id_on_factory, axis=-1)  # sort by id, so small ids have higher priority
-        unit_idx_on_factory = self.unit_id2idx[unit_id_on_factory]  # int[2, F, 9, 2]
+        unit_idx_on_factory = self.unit_id2idx(unit_id_on_factory)  # int[2, F, 9, 2]
         unit_team_idx, unit_idx = unit_idx_on_factory[..., 0], unit_idx_on_factory[..., 1]  # int[2, F, 9]
         chex.assert_shape(unit_idx_on_factory, (2, self.MAX_N_FACTORIES, 9, 2))
 
@@ -946,7 +1200,7 @@ class State(NamedTuple):
         )].set(amount)
         chex.assert_shape(amount_by_type, (2, self.MAX_N_FACTORIES, 9, 5))
         cumsum = jnp.cumsum(amount_by_type, axis=-2)  # int[2, F, 9, 5]
-        stock = jnp.concatenate([self.factories.cargo.stock, self.factories.power[..., None]], axis=-1)  # int[2, F, 5]
+        stock = self.factories.ledger  # int[2, F, 5]
         real_cumsum = jnp.minimum(cumsum, stock[:, :, None, :])  # int[2, F, 9, 5]
         real_cumsum_without_self = jnp.concatenate(
             [
@@ -960,23 +1214,14 @@ class State(NamedTuple):
 
         # 3. apply the real_pickup_amount
         factory_lose = real_cumsum[:, :, -1, :]  # int[2, F, 5]
-        fac_power = self.factories.power - factory_lose[:, :, ResourceType.power]  # int[2, F]
-        fac_stock = self.factories.cargo.stock - factory_lose[:, :, :4]  # int[2, F, 4]
-        new_factories = self.factories._replace(power=fac_power, cargo=UnitCargo(fac_stock))
+        new_factories = self.factories.replace_ledger(stock - factory_lose)
 
-        units_power = self.units.power.at[unit_team_idx, unit_idx].add(
-            real_pickup_amount[..., ResourceType.power],
-            mode='drop',
-        )  # int[2, U]
-        battery_capacity = self.units.get_cfg("BATTERY_CAPACITY", self.env_cfg.ROBOTS)
-        units_power = jnp.minimum(units_power, battery_capacity)
-        units_stock = self.units.cargo.stock.at[unit_team_idx, unit_idx].add(
-            real_pickup_amount[..., :4],
+        units_ledger = self.units.ledger.at[unit_team_idx, unit_idx].add(
+            real_pickup_amount,
             mode='drop',
-        )  # int[2, U, 4]
-        cargo_space = self.units.get_cfg("CARGO_SPACE", self.env_cfg.ROBOTS)
-        units_stock = jnp.minimum(units_stock, cargo_space[..., None])
-        new_units = self.units._replace(power=units_power, cargo=UnitCargo(units_stock))
+        )  # int[2, U, 5]
+        units_ledger = jnp.minimum(units_ledger, self.units.ledger_capacity(self.env_cfg.ROBOTS))
+        new_units = self.units.replace_ledger(units_ledger)
         self = self._replace(factories=new_factories, units=new_units)
 
         return self
@@ -1026,17 +1271,11 @@ class State(NamedTuple):
         new_rubble = new_rubble.at[x, y].add(jnp.where(dig_lichen & (new_lichen[x, y] == 0), dig_rubble_removed, 0))
 
         # resources
-        add_resource = jax.vmap(Unit.add_resource, in_axes=(0, None, 0, None))
-        add_resource = jax.vmap(add_resource, in_axes=(0, None, 0, None))
         dig_resource_gain = units.get_cfg("DIG_RESOURCE_GAIN", self.env_cfg.ROBOTS).astype(UnitCargo.dtype())
-
-        # ice
         dig_ice = valid & ~dig_rubble & ~dig_lichen & self.board.ice[x, y]
-        units, _ = add_resource(units, ResourceType.ice, dig_resource_gain * dig_ice, self.env_cfg.ROBOTS)
-
-        # ore
         dig_ore = valid & ~dig_rubble & ~dig_lichen & ~dig_ice & (self.board.ore[x, y] > 0)
-        units, _ = add_resource(units, ResourceType.ore, dig_resource_gain * dig_ore, self.env_cfg.ROBOTS)
+        dig_resource = jnp.where(dig_ice, ResourceType.ice, ResourceType.ore)  # int[2, U]
+        units, _ = units.add_resource(dig_resource, dig_resource_gain * (dig_ice | dig_ore), self.env_cfg.ROBOTS)
 
         new_self = self._replace(
             units=units,
@@ -1107,10 +1346,8 @@ class State(NamedTuple):
         # 2. deduct power and metal
         power_cost = is_build_light * light_power_cost + is_build_heavy * heavy_power_cost
         metal_cost = is_build_light * light_metal_cost + is_build_heavy * heavy_metal_cost
-        factory_sub_resource = jax.vmap(jax.vmap(Factory.sub_resource, in_axes=(0, None, 0)), in_axes=(0, None, 0))
-        factories = self.factories
-        factories, _ = factory_sub_resource(factories, ResourceType.power, power_cost)
-        factories, _ = factory_sub_resource(factories, ResourceType.metal, metal_cost)
+        factories, _ = self.factories.sub_resource(ResourceType.power, power_cost)
+        factories, _ = factories.sub_resource(ResourceType.metal, metal_cost)
         self = self._replace(factories=factories)
 
         # 3. create new units
@@ -1123,10 +1360,9 @@ class State(NamedTuple):
             jnp.array([0, 1]),  # team_id
             is_build_heavy,  # unit_type
             unit_id,  # unit_id
-            # replace UNIT_ACTION_QUEUE_SIZE with a concrete value to make it JIT-able
-            self.env_cfg._replace(UNIT_ACTION_QUEUE_SIZE=self.UNIT_ACTION_QUEUE_SIZE),  # env_cfg
+            self.env_cfg,  # env_cfg
         )
-        created_units = created_units._replace(pos=self.factories.pos)
+        created_units = self._like_units(created_units._replace(pos=self.factories.pos))
 
         # put created units into self.units
         created_units_idx = jnp.cumsum(valid, axis=1) - 1 + self.n_units[..., None]
@@ -1141,7 +1377,6 @@ class State(NamedTuple):
         return self._replace(
             units=new_units,
             n_units=new_n_units,
-            unit_id2idx=State.generate_unit_id2idx(new_units, self.MAX_GLOBAL_ID),
             board=self.board.update_units_map(new_units),
             global_id=self.global_id + n_new_units.sum(dtype=n_new_units.dtype),
         )
@@ -1201,57 +1436,40 @@ class State(NamedTuple):
         chex.assert_shape(light, (2, self.MAX_N_UNITS))  # bool[2, U]
         chex.assert_equal_shape([light, heavy, moving, still])
 
-        # count the number of different types of units in each location
+        # group units by the cell they are in. Units are sorted by cell, and each group is a segment, so that
+        # reductions below cost O(U log U) instead of scanning maps of the board size.
         x, y = units.pos.x, units.pos.y
         is_living = ~already_dead & unit_mask
+        n = 2 * self.MAX_N_UNITS
+        cell = jnp.where(unit_mask, x.astype(jnp.int32) * self.board.width + y, imax(jnp.int32)).reshape(n)  # int[2U]
+        order = jnp.argsort(cell)  # int[2U]
+        sorted_cell = cell[order]
+        is_new_cell = jnp.concatenate([jnp.array([True]), sorted_cell[1:] != sorted_cell[:-1]])  # bool[2U]
+        sorted_segment_id = jnp.cumsum(is_new_cell, dtype=jnp.int32) - 1  # int[2U]
+        segment_id = jnp.zeros(n, dtype=jnp.int32).at[order].set(sorted_segment_id).reshape(2, self.MAX_N_UNITS)
+
+        def segment_reduce(segment_op, data: Array) -> Array:
+            """Reduce `data[2, U, ...]` over units in each cell, and return the result of the cell of each unit."""
+            data = data.reshape(n, *data.shape[2:])[order]
+            result = segment_op(data, sorted_segment_id, num_segments=n, indices_are_sorted=True)
+            return result[segment_id]  # [2, U, ...]
 
-        cnt = jnp.zeros_like(self.board.units_map, dtype=jnp.int8)
-        still_light_cnt = cnt.at[x, y].add(light & still & is_living, mode='drop')  # int[H, W]
-        moving_light_cnt = cnt.at[x, y].add(light & moving & is_living, mode='drop')  # int[H, W]
-        still_heavy_cnt = cnt.at[x, y].add(heavy & still & is_living, mode='drop')  # int[H, W]
-        moving_heavy_cnt = cnt.at[x, y].add(heavy & moving & is_living, mode='drop')  # int[H, W]
-        chex.assert_equal_shape([still_light_cnt, moving_light_cnt, still_heavy_cnt, moving_heavy_cnt, cnt])
-
-        # get the second max power of moving light units
-        max_power = jnp.full_like(self.board.units_map, fill_value=-1, dtype=units.power.dtype)
-        moving_light_max_power = max_power.at[x, y].max(  # int[H, W]
-            jnp.where(light & moving & is_living, units.power, -1),
-            mode='drop',
-        )
-        max_power_in_unit_pos = moving_light_max_power[x, y]  # int[2, U]
-        moving_light_second_max = max_power.at[x, y].max(  # int[H, W]
-            jnp.where(light & moving & is_living & (units.power != max_power_in_unit_pos), units.power, -1),
-            mode='drop',
-        )
-        moving_light_max_cnt = cnt.at[x, y].add(  # int[H, W]
-            light & moving & is_living & (units.power == max_power_in_unit_pos),
-            mode='drop',
-        )
-        moving_light_second_max = jnp.where(moving_light_max_cnt > 1, moving_light_max_power, moving_light_second_max)
-
-        # get the second max power of moving heavy units
-        moving_heavy_max_power = max_power.at[x, y].max(  # int[H, W]
-            jnp.where(heavy & moving & is_living, units.power, -1),
-            mode='drop',
-        )
-        max_power_in_unit_pos = moving_heavy_max_power[x, y]  # int[2, U]
-        moving_heavy_second_max = max_power.at[x, y].max(  # int[H, W]
-            jnp.where(heavy & moving & is_living & (units.power != max_power_in_unit_pos), units.power, -1),
-            mode='drop',
-        )
-        moving_heavy_max_cnt = cnt.at[x, y].add(  # int[H, W]
-            heavy & moving & is_living & (units.power == max_power_in_unit_pos),
-            mode='drop',
+        # count the number of different types of units in each location
+        cnt = segment_reduce(  # int[2, U, 4]
+            jax.ops.segment_sum,
+            (jnp.stack([light & still, light & moving, heavy & still, heavy & moving], axis=-1)
+             & is_living[..., None]).astype(jnp.int8),
         )
-        moving_heavy_second_max = jnp.where(moving_heavy_max_cnt > 1, moving_heavy_max_power, moving_heavy_second_max)
-
-        # map above count to agent-wise
-        still_light_cnt = still_light_cnt[x, y]  # int[2, U]
-        moving_light_cnt = moving_light_cnt[x, y]  # int[2, U]
-        still_heavy_cnt = still_heavy_cnt[x, y]  # int[2, U]
-        moving_heavy_cnt = moving_heavy_cnt[x, y]  # int[2, U]
-        moving_light_second_max = moving_light_second_max[x, y]  # int[2, U]
-        moving_heavy_second_max = moving_heavy_second_max[x, y]  # int[2, U]
+        still_light_cnt, moving_light_cnt, still_heavy_cnt, moving_heavy_cnt = jnp.moveaxis(cnt, -1, 0)
+
+        # get the second max power of moving light and heavy units
+        group = jnp.stack([light & moving, heavy & moving], axis=-1) & is_living[..., None]  # bool[2, U, 2]
+        power = units.power[..., None]  # int[2, U, 1]
+        max_power = segment_reduce(jax.ops.segment_max, jnp.where(group, power, -1))  # int[2, U, 2]
+        second_max = segment_reduce(jax.ops.segment_max, jnp.where(group & (power != max_power), power, -1))
+        max_cnt = segment_reduce(jax.ops.segment_sum, (group & (power == max_power)).astype(jnp.int8))
+        second_max = jnp.where(max_cnt > 1, max_power, second_max)  # int[2, U, 2]
+        moving_light_second_max, moving_heavy_second_max = jnp.moveaxis(second_max, -1, 0)
         chex.assert_shape(still_light_cnt, (2, self.MAX_N_UNITS))  # bool[2, U]
         chex.assert_equal_shape([still_light_cnt, moving_light_cnt, still_heavy_cnt, moving_heavy_cnt])
 
@@ -1301,7 +1519,7 @@ class State(NamedTuple):
             units.pos.x,
             units.pos.y,
         )].add(dead * rubble_after_destruction, mode='drop')
-        rubble = jnp.minimum(rubble, self.env_cfg.MAX_RUBBLE)
+        rubble = jnp.minimum(rubble, self.env_cfg.MAX_RUBBLE).astype(self.board.rubble.dtype)
         lichen = self.board.lichen.at[(
             units.pos.x,
             units.pos.y,
@@ -1323,112 +1541,101 @@ class State(NamedTuple):
 
         return self._replace(board=board)
 
-    def destroy_unit(self, dead: Array) -> Tuple['State', Array]:
+    def destroy_unit(self, dead: Array, batch_axis_name: Optional[str] = None) -> Tuple['State', Array]:
         '''
-        Destroy dead units, and put them into the end of the array.
+        Destroy dead units, and put them into the end of the array. Nothing is moved if no unit is dead.
 
         Args:
             dead: bool[2, U], dead indicator.
+            batch_axis_name: str, optional. The axis name of `jax.vmap` over a batch of states. If given, nothing is
+                moved only if no unit is dead in any env of the batch, see `any_in_batch()`.
 
         Returns:
             new_state: State, new state.
             live_idx: int[2, U], the index of live units. Only the part with self.unit_mask == True is valid.
         '''
-        unit_mask = self.unit_mask  # bool[2, U]
-        units = self.units
 
-        # remove dead units, put them into the end of the array
-        is_alive = ~dead & unit_mask
-        unit_idx = jnp.where(is_alive, self.unit_idx, imax(self.unit_idx.dtype))
-        live_idx = jnp.argsort(unit_idx).astype(self.units.unit_id.dtype)
+        def _destroy(self: 'State') -> Tuple['State', Array]:
+            # remove dead units, put them into the end of the array
+            is_alive = ~dead & self.unit_mask
+            units, live_idx = compact(self.units, is_alive, self._empty_unit())
+            live_idx = live_idx.astype(self.units.unit_id.dtype)
 
-        empty_unit = jax.tree_map(
-            lambda x: jnp.array(x)[None, None],
-            # replace UNIT_ACTION_QUEUE_SIZE with a concrete value to make it JIT-able
-            Unit.empty(self.env_cfg._replace(UNIT_ACTION_QUEUE_SIZE=self.UNIT_ACTION_QUEUE_SIZE)),
-        )
+            # update other states
+            n_units = self.n_units - dead.sum(axis=1, dtype=self.n_units.dtype)
 
-        units = jux.tree_util.tree_where(dead, empty_unit, units)
-        units = jax.tree_map(lambda x: x[jnp.arange(2)[:, None], live_idx], units)
+            # update board
+            board = self.board.update_units_map(units)
 
-        # update other states
-        n_units = self.n_units - dead.sum(axis=1, dtype=self.n_units.dtype)
-        unit_id2idx = State.generate_unit_id2idx(units, self.MAX_GLOBAL_ID)
+            self = self._replace(
+                units=units,
+                n_units=n_units,
+                board=board,
+            )
+            return self, live_idx
 
-        # update board
-        board = self.board.update_units_map(units)
+        return jax.lax.cond(any_in_batch(dead, batch_axis_name), _destroy, lambda self: (self, self.unit_idx), self)
 
-        self = self._replace(
-            units=units,
-            n_units=n_units,
-            unit_id2idx=unit_id2idx,
-            board=board,
-        )
-        return self, live_idx
-
-    def destroy_factories(self, dead: Array) -> 'State':
+    def destroy_factories(self, dead: Array, batch_axis_name: Optional[str] = None) -> 'State':
         '''
-        Destroy dead factories, and put them into the end of the array.
+        Destroy dead factories, and put them into the end of the array. Nothing is changed if no factory is dead.
 
         Args:
             dead: bool[2, F], dead indicator.
+            batch_axis_name: str, optional. See `destroy_unit()`.
 
         Returns:
             new_state: State.
         '''
-        factory_mask = self.factory_mask  # bool[2, F]
-        factories = self.factories
 
-        # add rubble to the board, and remove lichen
-        occupancy = factories.occupancy
+        def _destroy(self: 'State') -> 'State':
+            factory_mask = self.factory_mask  # bool[2, F]
+            factories = self.factories
 
-        rubble = self.board.rubble.at[(
-            occupancy.x,
-            occupancy.y,
-        )].add(dead[..., None] * self.env_cfg.FACTORY_RUBBLE_AFTER_DESTRUCTION, mode='drop')
-        rubble = jnp.minimum(rubble, self.env_cfg.MAX_RUBBLE)
-
-        lichen = self.board.lichen.at[(
-            occupancy.x,
-            occupancy.y,
-        )].min(jnp.where(dead[..., None], 0, imax(self.board.lichen.dtype)), mode='drop')
-        lichen_strains = self.board.lichen_strains.at[(
-            occupancy.x,
-            occupancy.y,
-        )].max(jnp.where(dead[..., None], imax(self.board.lichen_strains.dtype), -1), mode='drop')
-
-        # remove dead factories, put them into the end of the array
-        is_alive = ~dead & factory_mask
-        factory_idx = jnp.where(is_alive, self.factory_idx, imax(self.factory_idx.dtype))
-        live_idx = jnp.argsort(factory_idx).astype(self.factories.unit_id.dtype)
-
-        empty_factory = jax.tree_map(
-            lambda x: jnp.array(x)[None, None],
-            Factory.empty(),
-        )
-
-        factories = jux.tree_util.tree_where(dead, empty_factory, factories)
-        factories = jax.tree_map(lambda x: x[jnp.arange(2)[:, None], live_idx], factories)
+            # add rubble to the board, and remove lichen
+            occupancy = factories.occupancy
 
-        # update other states
-        n_factories = self.n_factories - dead.sum(axis=1, dtype=self.n_factories.dtype)
-        factory_id2idx = State.generate_factory_id2idx(factories, self.MAX_N_FACTORIES)
+            # add in int32, rubble may exceed the range of its own dtype before clipping to MAX_RUBBLE.
+            rubble = self.board.rubble.astype(jnp.int32).at[(
+                occupancy.x,
+                occupancy.y,
+            )].add(dead[..., None] * self.env_cfg.FACTORY_RUBBLE_AFTER_DESTRUCTION, mode='drop')
+            rubble = jnp.minimum(rubble, self.env_cfg.MAX_RUBBLE).astype(self.board.rubble.dtype)
+
+            lichen = self.board.lichen.at[(
+                occupancy.x,
+                occupancy.y,
+            )].min(jnp.where(dead[..., None], 0, imax(self.board.lichen.dtype)), mode='drop')
+            lichen_strains = self.board.lichen_strains.at[(
+                occupancy.x,
+                occupancy.y,
+            )].max(jnp.where(dead[..., None], imax(self.board.lichen_strains.dtype), -1), mode='drop')
+
+            # remove dead factories, put them into the end of the array
+            is_alive = ~dead & factory_mask
+            factories, _ = compact(factories, is_alive, Factory.empty())
+
+            # update other states
+            n_factories = self.n_factories - dead.sum(axis=1, dtype=self.n_factories.dtype)
+            factory_id2idx = State.generate_factory_id2idx(factories, self.MAX_N_FACTORIES)
+
+            # update board
+            board = self.board.update_factories_map(factories)
+            board = board._replace(
+                map=board.map._replace(rubble=rubble),
+                lichen=lichen,
+                lichen_strains=lichen_strains,
+            )
 
-        # update board
-        board = self.board.update_factories_map(factories)
-        board = board._replace(
-            map=board.map._replace(rubble=rubble),
-            lichen=lichen,
-            lichen_strains=lichen_strains,
-        )
+            self = self._replace(
+                factories=factories,
+                n_factories=n_factories,
+                factory_id2idx=factory_id2idx,
+                board=board,
+            )
+            return self
 
-        self = self._replace(
-            factories=factories,
-            n_factories=n_factories,
-            factory_id2idx=factory_id2idx,
-            board=board,
-        )
-        return self
+        return jax.lax.cond(any_in_batch(dead, batch_axis_name), _destroy, lambda self: self, self)
 
     def _validate_recharge_actions(self, actions: UnitAction):
         valid = (actions.action_type == UnitActionType.RECHARGE)
@@ -1439,13 +1646,17 @@ class State(NamedTuple):
         success = valid & (self.units.power >= actions.amount)
         return self, success
 
+    def _validate_factory_water_actions(self, factory_actions: Array, grow_lichen_size: Array) -> Tuple[Array, Array]:
+        water_cost = jnp.ceil(grow_lichen_size / self.env_cfg.LICHEN_WATERING_COST_FACTOR).astype(UnitCargo.dtype())
+        valid = (factory_actions == FactoryAction.WATER) & (self.factories.cargo.water >= water_cost)  # bool[2, F]
+        return valid, water_cost
+
     def _handle_factory_water_actions(self, factory_actions: Array, color: Array, grow_lichen_size: Array) -> 'State':
 
         H, W = self.board.lichen_strains.shape
 
         # check validity
-        water_cost = jnp.ceil(grow_lichen_size / self.env_cfg.LICHEN_WATERING_COST_FACTOR).astype(UnitCargo.dtype())
-        valid = (factory_actions == FactoryAction.WATER) & (self.factories.cargo.water >= water_cost)  # bool[2, F]
+        valid, water_cost = self._validate_factory_water_actions(factory_actions, grow_lichen_size)
         water_cost = jnp.where(valid, water_cost, 0)  # int[2, F]
 
         # new factory stocks
@@ -1611,6 +1822,7 @@ class State(NamedTuple):
         return self.add_rubble_for_dead_units(self.unit_mask)
 
     def team_lichen_score(self: 'State') -> Array:
+        self = self.default_dtypes()
         factory_id2idx = self.generate_factory_id2idx(
             self.factories._replace(unit_id=self.teams.factory_strains),
             self.MAX_N_FACTORIES,
@@ -1625,3 +1837,195 @@ class State(NamedTuple):
         )].set(factory_lichen, mode='drop')
 
         return lichen_score.sum(-1)  # int[2]
+
+    def to_features(self, player: int) -> Features:
+        """
+        Encode the state into fixed-shape observation features for `player`. It is jittable, and works on batched
+        states of any batch shape, in which case `player` is either a scalar shared by all envs, or an array of
+        the batch shape.
+
+        Args:
+            player (int): 0 or 1, the player to encode features for.
+
+        Returns:
+            Features: spatial feature planes `float32[..., H, W, C]` and global scalars `float32[..., S]`, whose
+                channels are named in `Features.SPATIAL_CHANNELS` and `Features.SCALAR_FEATURES`.
+        """
+        if self.env_steps.ndim > 0:
+            in_axes = (0, 0 if jnp.ndim(player) > 0 else None)
+            return jax.vmap(State.to_features, in_axes=in_axes)(self, player)
+        self = self.default_dtypes()
+
+        env_cfg = self.env_cfg
+        board = self.board
+        height, width = board.height, board.width
+        opp = 1 - player
+        is_mine = jnp.array([0, 1]) == player  # bool[2]
+
+        def _to_map(pos: Position, values: Array, mask: Array) -> Array:
+            # sum values of objects at pos into a map. Objects not in mask are dropped.
+            x = jnp.where(mask, pos.x, height)  # out of map
+            map = jnp.zeros((height, width) + values.shape[mask.ndim:], dtype=jnp.float32)
+            return map.at[x, pos.y].add(values, mode='drop')
+
+        # board
+        channels = {
+            'rubble': board.rubble / env_cfg.MAX_RUBBLE,
+            'ice': board.ice,
+            'ore': board.ore,
+            'lichen': board.lichen / env_cfg.MAX_LICHEN_PER_TILE,
+            'valid_spawn': board.valid_spawns_mask,
+            'is_day': jnp.full((height, width), is_day(env_cfg, self.real_env_steps)),
+        }
+        strain_owner = jnp.any(board.lichen_strains[..., None, None] == self.teams.factory_strains, axis=-1)
+        strain_owner = strain_owner & (board.lichen > 0)[..., None]  # bool[H, W, 2]
+        channels['my_lichen'] = strain_owner[..., player]
+        channels['opp_lichen'] = strain_owner[..., opp]
+
+        # units
+        units = self.units
+        unit_mask = self.unit_mask
+        unit_type = jax.nn.one_hot(units.unit_type, 2)  # float[2, U, 2], light and heavy
+        unit_is_mine = is_mine[:, None, None]
+        unit_values = jnp.concatenate(
+            [
+                jnp.where(unit_is_mine, unit_type, 0),
+                jnp.where(unit_is_mine, 0, unit_type),
+                (units.power / units.get_cfg('BATTERY_CAPACITY', env_cfg.ROBOTS))[..., None],
+                units.cargo.stock / units.get_cfg('CARGO_SPACE', env_cfg.ROBOTS)[..., None],
+            ],
+            axis=-1,
+        )  # float[2, U, 9]
+        unit_planes = _to_map(units.pos, unit_values, unit_mask)
+        unit_channels = ('my_light', 'my_heavy', 'opp_light', 'opp_heavy', 'unit_power', 'unit_ice', 'unit_ore',
+                         'unit_water', 'unit_metal')
+        channels.update(zip(unit_channels, jnp.moveaxis(unit_planes, -1, 0)))
+
+        # factories
+        factories = self.factories
+        factory_mask = self.factory_mask
+        factory_values = jnp.concatenate(
+            [
+                jnp.broadcast_to(jnp.stack([is_mine, ~is_mine], axis=-1)[:, None, :], (2, self.MAX_N_FACTORIES, 2)),
+                factories.cargo.stock,
+                factories.power[..., None],
+            ],
+            axis=-1,
+        )  # float[2, F, 7]
+        occupancy = factories.occupancy  # Position[2, F, 9]
+        factory_values = jnp.broadcast_to(factory_values[:, :, None, :], occupancy.x.shape + (7, ))
+        occupancy_mask = jnp.broadcast_to(factory_mask[..., None], occupancy.x.shape)
+        factory_planes = _to_map(occupancy, factory_values, occupancy_mask)
+        factory_channels = ('my_factory', 'opp_factory', 'factory_ice', 'factory_ore', 'factory_water',
+                            'factory_metal', 'factory_power')
+        channels.update(zip(factory_channels, jnp.moveaxis(factory_planes, -1, 0)))
+
+        spatial = jnp.stack([channels[c].astype(jnp.float32) for c in Features.SPATIAL_CHANNELS], axis=-1)
+
+        # global scalars
+        n_heavies = jnp.sum((units.unit_type == UnitType.HEAVY) & unit_mask, axis=-1)
+        n_lights = jnp.sum((units.unit_type == UnitType.LIGHT) & unit_mask, axis=-1)
+        factory_stock = jnp.sum(factories.cargo.stock * factory_mask[..., None], axis=-2)  # int[2, 4]
+        factory_power = jnp.sum(factories.power * factory_mask, axis=-1)  # int[2]
+        team_scalars = {
+            'n_factories': self.n_factories,
+            'n_lights': n_lights,
+            'n_heavies': n_heavies,
+            'lichen_score': self.team_lichen_score(),
+            'ice': factory_stock[:, ResourceType.ice],
+            'ore': factory_stock[:, ResourceType.ore],
+            'water': factory_stock[:, ResourceType.water],
+            'metal': factory_stock[:, ResourceType.metal],
+            'power': factory_power,
+            'factories_to_place': self.teams.factories_to_place,
+            'init_water': self.teams.init_water,
+            'init_metal': self.teams.init_metal,
+        }
+        scalars = {
+            'step': self.real_env_steps / env_cfg.max_episode_length,
+            'is_day': is_day(env_cfg, self.real_env_steps),
+            'cycle_phase': (self.real_env_steps % env_cfg.CYCLE_LENGTH) / env_cfg.CYCLE_LENGTH,
+            'my_place_next': self.next_player == player,
+        }
+        for name, value in team_scalars.items():
+            scalars[f'my_{name}'] = value[player]
+            scalars[f'opp_{name}'] = value[opp]
+        scalars = jnp.stack([jnp.asarray(scalars[c], dtype=jnp.float32) for c in Features.SCALAR_FEATURES], axis=-1)
+
+        return Features(spatial, scalars)
+
+    def action_masks(self) -> ActionMasks:
+        """
+        Compute masks of actions that pass validation in the current state, using the same validators as
+        `_step_late_game()`. A mask is True if a unit executing the action next step (i.e. the action is at the
+        front of its queue) would not fail validation. It does not include the power cost of updating the action
+        queue. Amount of transfer, pickup and recharge actions is not considered.
+
+        It is jittable, and works on batched states of any batch shape.
+
+        Returns:
+            ActionMasks: masks for each unit and factory.
+        """
+        if self.env_steps.ndim > 0:
+            return jax.vmap(State.action_masks)(self)
+        self = self.default_dtypes()
+
+        unit_mask = self.unit_mask
+        factory_mask = self.factory_mask
+
+        def _unit_action(action_type: UnitActionType, direction: Direction = Direction.CENTER) -> UnitAction:
+            action = UnitAction.do_nothing()._replace(
+                action_type=jnp.int8(action_type),
+                direction=jnp.int8(direction),
+            )
+            return jax.tree_map(lambda x: jnp.full((2, self.MAX_N_UNITS), x), action)
+
+        def _factory_action(factory_action: FactoryAction) -> Array:
+            return jnp.full((2, self.MAX_N_FACTORIES), factory_action, dtype=jnp.int8)
+
+        # movement
+        move = [self._validate_movement_actions(_unit_action(UnitActionType.MOVE, d))[0] for d in Direction]
+        move = jnp.stack(move, axis=-1)  # bool[2, U, 5]
+
+        # transfer, only to cells with a unit or a factory
+        transfer = []
+        for d in Direction:
+            valid = self._validate_transfer_actions(_unit_action(UnitActionType.TRANSFER, d))
+            target_pos = Position(self.units.pos.pos + direct2delta_xy[d])
+            there_is_an_unit = self.board.units_map.at[target_pos.x, target_pos.y].get(
+                mode='fill', fill_value=imax(self.board.units_map.dtype)) != imax(self.board.units_map.dtype)
+            there_is_a_factory = self.board.factory_occupancy_map.at[target_pos.x, target_pos.y].get(
+                mode='fill',
+                fill_value=imax(self.board.factory_occupancy_map.dtype),
+            ) != imax(self.board.factory_occupancy_map.dtype)
+            transfer.append(valid & (there_is_an_unit | there_is_a_factory))
+        transfer = jnp.stack(transfer, axis=-1) & unit_mask[..., None]  # bool[2, U, 5]
+
+        # pickup, only resources the factory has
+        pickup = self._validate_pickup_actions(_unit_action(UnitActionType.PICKUP))  # bool[2, U]
+        factory_id = self.board.factory_occupancy_map[self.units.pos.x, self.units.pos.y]  # int[2, U]
+        factory_idx = self.factory_id2idx.at[factory_id].get(mode='fill', fill_value=imax(self.factory_id2idx.dtype))
+        factory_stock = jnp.concatenate([self.factories.cargo.stock, self.factories.power[..., None]], axis=-1)
+        factory_stock = factory_stock.at[factory_idx[..., 0], factory_idx[..., 1]].get(mode='fill', fill_value=0)
+        pickup = pickup[..., None] & (factory_stock > 0) & unit_mask[..., None]  # bool[2, U, 5]
+
+        # factories
+        _, grow_lichen_size, _ = self._cache_water_info(_factory_action(FactoryAction.WATER))
+        factory = jnp.stack(
+            [
+                self._validate_factory_build_actions(_factory_action(FactoryAction.BUILD_LIGHT)),
+                self._validate_factory_build_actions(_factory_action(FactoryAction.BUILD_HEAVY)),
+                self._validate_factory_water_actions(_factory_action(FactoryAction.WATER), grow_lichen_size)[0],
+            ],
+            axis=-1,
+        ) & factory_mask[..., None]  # bool[2, F, 3]
+
+        return ActionMasks(
+            move=move,
+            transfer=transfer,
+            pickup=pickup,
+            dig=self._validate_dig_actions(_unit_action(UnitActionType.DIG)),
+            self_destruct=self._validate_self_destruct_actions(_unit_action(UnitActionType.SELF_DESTRUCT)) & unit_mask,
+            recharge=self._validate_recharge_actions(_unit_action(UnitActionType.RECHARGE)) & unit_mask,
+            factory=factory,
+        )
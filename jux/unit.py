@@ -3,16 +3,17 @@ from typing import Dict, NamedTuple, Tuple, Union
 
 import jax
 import jax.numpy as jnp
-from jax import Array, lax
+from jax import Array
 from luxai_s2.config import EnvConfig as LuxEnvConfig
 from luxai_s2.team import Team as LuxTeam
 from luxai_s2.unit import Unit as LuxUnit
 from luxai_s2.unit import UnitType as LuxUnitType
 
+import jux.tree_util
 from jux.actions import ActionQueue, UnitAction
 from jux.config import EnvConfig, UnitConfig
 from jux.map.position import Position
-from jux.unit_cargo import ResourceType, UnitCargo
+from jux.unit_cargo import ResourceType, UnitCargo, add_to_ledger, ledger_amount, sub_from_ledger
 from jux.utils import INT32_MAX, imax
 
 
@@ -107,13 +108,15 @@ class Unit(NamedTuple):
         return lux_unit
 
     def next_action(self) -> UnitAction:
-        act = self.action_queue.peek()
-        act = jax.lax.cond(
+        """
+        The action at the front of the queue, or `UnitAction.do_nothing()` if the queue is empty. It works on batched
+        units with leading batch dimensions, such as `Unit[2, U]`.
+        """
+        return jux.tree_util.tree_where(
             self.action_queue.is_empty(),
-            lambda: UnitAction.do_nothing(),  # empty action
-            lambda: act,
+            UnitAction.do_nothing(),
+            self.action_queue.peek(),
         )
-        return act
 
     def repeat_action(self, success: bool) -> 'Unit':
         '''
@@ -124,45 +127,54 @@ class Unit(NamedTuple):
 
         From luxai_s2, we set the action's n value equal to repeat if we pop and push back
 
+        It works on batched units with leading batch dimensions, such as `Unit[2, U]`, by masked arithmetic over the
+        whole `[..., Q]` queue buffers, without `jax.lax.cond` or scatters.
+
         Args:
             success (bool[2, U]): whether the action is executed successfully
         Returns:
             Unit: the unit with updated action queue
         '''
-
-        act = self.action_queue.peek()
-        not_empty = ~self.action_queue.is_empty()
+        queue = self.action_queue
+        act = queue.peek()
+        not_empty = ~queue.is_empty()
         n_minus_one = (act.n > 1) & success & not_empty
         pop_only = (act.n <= 1) & ~act.repeat & success & not_empty
         pop_and_push_back = (act.n <= 1) & act.repeat & success & not_empty
 
-        data: UnitAction = jax.tree_map(
-            lambda queue, a: queue.at[self.action_queue.rear].set(a),
-            self.action_queue.data,
+        # the front action is always written to the rear, which is a free slot unless it is pushed back, or the queue
+        # is full, in which case the rear is the front itself.
+        data = queue.write(
+            queue.rear,
             act._replace(n=jnp.where(pop_and_push_back, act.repeat, act.n)),
+            True,
         )
-        n = data.n.at[self.action_queue.front].add(-n_minus_one.astype(data.n.dtype))
-        data = data._replace(n=n)
+        minus_one = queue.slot_mask(queue.front) & n_minus_one[..., None]  # bool[..., Q]
+        if queue.is_packed:
+            # n is in the lowest bits of the packed word
+            data = data._replace(lo=data.lo - minus_one.astype(data.lo.dtype))
+        else:
+            data = data._replace(n=data.n - minus_one.astype(data.n.dtype))
 
         front = jnp.where(
             pop_only | pop_and_push_back,
-            (self.action_queue.front + 1) % self.action_queue.capacity,
-            self.action_queue.front,
+            (queue.front + 1) % queue.capacity,
+            queue.front,
         )
 
         rear = jnp.where(
             pop_and_push_back,
-            (self.action_queue.rear + 1) % self.action_queue.capacity,
-            self.action_queue.rear,
+            (queue.rear + 1) % queue.capacity,
+            queue.rear,
         )
 
         count = jnp.where(
             pop_only,
-            self.action_queue.count - 1,
-            self.action_queue.count,
+            queue.count - 1,
+            queue.count,
         )
 
-        action_queue = self.action_queue._replace(
+        action_queue = queue._replace(
             data=data,
             front=front,
             rear=rear,
@@ -178,63 +190,51 @@ class Unit(NamedTuple):
         rubble_movement_cost = self.get_cfg("RUBBLE_MOVEMENT_COST", unit_cfgs)
         return move_cost + jnp.floor(rubble_movement_cost * rubble_at_target).astype(move_cost.dtype)
 
+    @property
+    def ledger(self) -> Array:
+        '''
+        int[..., 5], the cargo stock and power of the unit, indexed by `ResourceType`. Power is the last column, so
+        `add_resource()` and `sub_resource()` share the same arithmetic for power and cargo, and all their arguments
+        may be batched.
+        '''
+        return jnp.concatenate([self.cargo.stock, jnp.expand_dims(self.power, -1)], axis=-1)
+
+    def ledger_capacity(self, unit_cfgs: Tuple[UnitConfig, UnitConfig]) -> Array:
+        '''int[..., 5], the cargo space of each resource and the battery capacity, indexed by `ResourceType`.'''
+        cargo_space = self.get_cfg("CARGO_SPACE", unit_cfgs)
+        battery_capacity = self.get_cfg("BATTERY_CAPACITY", unit_cfgs)
+        n_cargo = self.cargo.stock.shape[-1]
+        return jnp.concatenate(
+            [
+                jnp.broadcast_to(cargo_space[..., None], cargo_space.shape + (n_cargo, )),
+                battery_capacity[..., None],
+            ],
+            axis=-1,
+        )
+
+    def replace_ledger(self, ledger: Array) -> 'Unit':
+        '''Write a ledger, as returned by `Unit.ledger`, back into cargo stock and power.'''
+        return self._replace(
+            cargo=UnitCargo(ledger[..., :-1].astype(self.cargo.stock.dtype)),
+            power=ledger[..., -1].astype(jnp.result_type(self.power)),
+        )
+
     def add_resource(
         self,
         resource: ResourceType,
         amount: int,
         unit_cfgs: Tuple[UnitConfig, UnitConfig],
     ) -> Tuple['Unit', Union[int, Array]]:
-        # If resource != ResourceType.power, call UnitCargo.add_resource.
-        # else, call Unit.add_power.
-        amount = jnp.maximum(amount, 0)
-        cargo_space = self.get_cfg("CARGO_SPACE", unit_cfgs)
-        battery_capacity = self.get_cfg("BATTERY_CAPACITY", unit_cfgs)
-
-        def add_power(self, resource: ResourceType, amount: int):
-            transfer_amount = jnp.minimum(battery_capacity - self.power, amount)
-            new_unit = self._replace(power=self.power + transfer_amount)
-            return new_unit, transfer_amount
-
-        def add_others(self: Unit, resource: ResourceType, amount: int):
-            new_cargo, transfer_amount = self.cargo.add_resource(
-                resource=resource,
-                amount=amount,
-                cargo_space=cargo_space,
-            )
-            new_unit = self._replace(cargo=new_cargo)
-            return new_unit, transfer_amount
-
-        new_unit, transfer_amount = lax.cond(
-            resource == ResourceType.power,
-            add_power,
-            add_others,
-            *(self, resource, amount),
-        )
-        return new_unit, transfer_amount
+        ledger = self.ledger
+        amount = ledger_amount(resource, amount, ledger.shape[-1])
+        ledger, transfer_amount = add_to_ledger(ledger, amount, self.ledger_capacity(unit_cfgs))
+        return self.replace_ledger(ledger), transfer_amount.sum(-1)
 
     def sub_resource(self, resource: ResourceType, amount: int) -> Tuple['Unit', Union[int, Array]]:
-        # If resource != ResourceType.power, call UnitCargo.add_resource.
-        # else, call Unit.sub_resource.
-        def sub_power(self, resource: ResourceType, amount: int):
-            transfer_amount = jnp.minimum(self.power, amount)
-            new_unit = self._replace(power=self.power - transfer_amount)
-            return new_unit, transfer_amount
-
-        def sub_others(self: Unit, resource: ResourceType, amount: int):
-            new_cargo, transfer_amount = self.cargo.sub_resource(
-                resource=resource,
-                amount=amount,
-            )
-            new_unit = self._replace(cargo=new_cargo)
-            return new_unit, transfer_amount
-
-        new_unit, transfer_amount = lax.cond(
-            resource == ResourceType.power,
-            sub_power,
-            sub_others,
-            *(self, resource, amount),
-        )
-        return new_unit, transfer_amount
+        ledger = self.ledger
+        amount = ledger_amount(resource, amount, ledger.shape[-1])
+        ledger, transfer_amount = sub_from_ledger(ledger, amount)
+        return self.replace_ledger(ledger), transfer_amount.sum(-1)
 
     def gain_power(self, unit_cfgs: Tuple[UnitConfig, UnitConfig]):
         charge = self.get_cfg("CHARGE", unit_cfgs)
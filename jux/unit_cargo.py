@@ -1,5 +1,5 @@
 from enum import IntEnum
-from typing import NamedTuple, Union
+from typing import NamedTuple, Tuple, Union
 
 import jax.numpy as jnp
 from jax import Array
@@ -14,6 +14,40 @@ class ResourceType(IntEnum):
     power = 4
 
 
+def ledger_amount(resource: ResourceType, amount: int, n_columns: int = len(ResourceType)) -> Array:
+    '''Spread `amount` of `resource` into a row of a resource ledger, whose columns are indexed by `ResourceType`, so
+    power is the last column after the cargo stock. Both arguments may be batched.
+
+    Returns:
+        int[..., n_columns]: `amount` in the column of `resource`, and 0 elsewhere.
+    '''
+    resource = jnp.asarray(resource)[..., None]
+    amount = jnp.asarray(amount)[..., None]
+    return jnp.where(jnp.arange(n_columns) == resource, amount, 0)
+
+
+def add_to_ledger(ledger: Array, amount: Array, capacity: Array) -> Tuple[Array, Array]:
+    '''Add `amount` to `ledger` column-wise, without exceeding `capacity`. Negative amounts add nothing.
+
+    Returns:
+        ledger: the new ledger.
+        transfer_amount: the amount of each resource that really transferred.
+    '''
+    transfer_amount = jnp.minimum(capacity - ledger, jnp.maximum(amount, 0))
+    return ledger + transfer_amount, transfer_amount
+
+
+def sub_from_ledger(ledger: Array, amount: Array) -> Tuple[Array, Array]:
+    '''Subtract `amount` from `ledger` column-wise, without going below 0. Negative amounts subtract nothing.
+
+    Returns:
+        ledger: the new ledger.
+        transfer_amount: the amount of each resource that really transferred.
+    '''
+    transfer_amount = jnp.minimum(ledger, jnp.maximum(amount, 0))
+    return ledger - transfer_amount, transfer_amount
+
+
 class UnitCargo(NamedTuple):
     stock: jnp.int32 = jnp.zeros(4, jnp.int32)  # int[4]
 
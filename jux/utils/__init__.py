@@ -26,6 +26,64 @@ def imax(dtype):
         return dtype(jnp.iinfo(dtype).max)
 
 
+def narrowest_int(max_value: int, dtypes=(jnp.int8, jnp.int16, jnp.int32)):
+    """The narrowest of `dtypes` that holds `max_value`."""
+    return next(dtype for dtype in dtypes if max_value <= jnp.iinfo(dtype).max)
+
+
+def checked_astype(x: jax.Array, dtype) -> jax.Array:
+    """
+    Cast integer array `x` to `dtype`, raising `OverflowError` if any value is out of the range of `dtype`. Values
+    traced under `jax.jit` or `jax.vmap` are unknown, so they are cast without checking.
+    """
+    x = jnp.asarray(x)
+    if x.dtype == jnp.dtype(dtype):
+        return x
+    if not isinstance(x, jax.core.Tracer) and x.size > 0:
+        info = jnp.iinfo(dtype)
+        lo, hi = int(x.min()), int(x.max())
+        if lo < info.min or hi > info.max:
+            raise OverflowError(f"values in [{lo}, {hi}] do not fit in {jnp.dtype(dtype).name}")
+    return x.astype(dtype)
+
+
+def live_actions(state, lux_act: Dict) -> Dict:
+    """
+    Drop actions of units and factories that are not alive in `state`. Replays contain actions of units that are
+    already destroyed, which `luxai_s2` ignores, but `JuxAction.from_lux()` cannot look up.
+
+    Args:
+        state: a `luxai_s2` state, or an unbatched jux `State`.
+        lux_act (Dict): actions of both players in `luxai_s2` format. Keys other than unit and factory ids, such as
+            bids and factory placements, are kept.
+
+    Returns:
+        Dict: actions in `luxai_s2` format, without those of dead units and factories.
+    """
+    if hasattr(state, 'n_units'):  # jux State
+        unit_ids, n_units, factory_ids, n_factories = jax.device_get((
+            state.units.unit_id,
+            state.n_units,
+            state.factories.unit_id,
+            state.n_factories,
+        ))
+        live = {}
+        for p in range(2):
+            units = {f'unit_{i}' for i in unit_ids[p, :n_units[p]]}
+            factories = {f'factory_{i}' for i in factory_ids[p, :n_factories[p]]}
+            live[f'player_{p}'] = units | factories
+    else:
+        live = {player: state.units[player].keys() | state.factories[player].keys() for player in state.units}
+    return {
+        player: {
+            k: v
+            for k, v in player_act.items()
+            if not (k.startswith('unit_') or k.startswith('factory_')) or k in live[player]
+        }
+        for player, player_act in lux_act.items()
+    }
+
+
 def _action_v1_to_v2(actions):
     for id, acts in actions.items():
         if not id.startswith('unit_'):
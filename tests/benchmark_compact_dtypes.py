@@ -0,0 +1,71 @@
+"""
+Benchmark the compact layout of `State`, selected by `JuxBufferConfig(COMPACT_DTYPES=True)`, against the default
+layout. Reports bytes per env of the state, and steps per second of `JuxEnvBatch.step_late_game()` on states and
+actions sampled from replays, across `MAX_N_UNITS`.
+
+Usage:
+    python tests/benchmark_compact_dtypes.py [--batch-size 64] [--repeat 20]
+"""
+import argparse
+import time
+
+import jax
+import numpy as np
+
+import jux.tree_util
+from jux.config import JuxBufferConfig
+from jux.env import JuxEnvBatch
+from tests.benchmark_skip_unused_actions import load_samples
+
+
+def nbytes(tree) -> int:
+    return sum(x.nbytes for x in jax.tree_util.tree_leaves(tree))
+
+
+def timeit(fn, *args, repeat: int) -> float:
+    jax.block_until_ready(fn(*args))  # compile
+    start = time.perf_counter()
+    for _ in range(repeat):
+        jax.block_until_ready(fn(*args))
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--max-n-units', type=int, nargs='+', default=[100, 1000])
+    parser.add_argument('--episodes', nargs='+', default=['tests/replay2.0_0.json.gz', 'tests/replay2.0_1.json.gz'])
+    args = parser.parse_args()
+
+    samples = load_samples(args.episodes)
+    rng = np.random.default_rng(0)
+    idx = rng.choice(len(samples), size=args.batch_size)
+    states, actions = jux.tree_util.batch_into_leaf([samples[i] for i in idx])
+    max_n_units = states.MAX_N_UNITS
+
+    print(f"backend: {jax.default_backend()}, batch size: {args.batch_size}, {len(samples)} replay samples")
+    print(f"{'MAX_N_UNITS':>11} {'layout':>8} {'bytes/env':>10} {'steps/s':>10} {'speedup':>8}")
+    for n in args.max_n_units:
+        # samples are loaded with the default `MAX_N_UNITS`, and smaller buffers drop trailing empty slots
+        assert int(states.n_units.max()) <= n <= max_n_units
+        default_states = states.resize_units(n)
+        batch_actions = actions._replace(
+            unit_action_queue=jax.tree_map(lambda x: x[:, :, :n], actions.unit_action_queue),
+            unit_action_queue_count=actions.unit_action_queue_count[:, :, :n],
+            unit_action_queue_update=actions.unit_action_queue_update[:, :, :n],
+        )
+
+        t_default = None
+        for layout, batch_states in [('default', default_states), ('compact', default_states.compact_dtypes())]:
+            env_batch = JuxEnvBatch(buf_cfg=JuxBufferConfig(MAX_N_UNITS=n, COMPACT_DTYPES=layout == 'compact'))
+            new_states, _ = env_batch.step_late_game(batch_states, batch_actions)
+            assert new_states.has_compact_dtypes == (layout == 'compact')
+            t = timeit(env_batch.step_late_game, batch_states, batch_actions, repeat=args.repeat)
+            t_default = t_default or t
+            print(f"{n:>11} {layout:>8} {nbytes(batch_states) // args.batch_size:>10} "
+                  f"{args.batch_size / t:>10.0f} {t_default / t:>7.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""
+Benchmark `State.destroy_unit()` against the previous argsort-based compaction, across `MAX_N_UNITS`, vmapped with a
+dead mask per env, with and without reducing the `lax.cond` predicate over the batch.
+
+Usage:
+    python tests/benchmark_destroy_unit.py [--batch-size 64] [--repeat 20]
+"""
+import argparse
+import time
+from functools import partial
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+import jux.tree_util
+from jux.config import EnvConfig, JuxBufferConfig
+from jux.state import State
+from jux.unit import Unit
+from jux.utils import imax
+
+
+def destroy_unit_argsort(self: State, dead):
+    # the implementation before prefix-sum compaction, as reference
+    is_alive = ~dead & self.unit_mask
+    unit_idx = jnp.where(is_alive, self.unit_idx, imax(self.unit_idx.dtype))
+    live_idx = jnp.argsort(unit_idx).astype(self.units.unit_id.dtype)
+    empty_unit = jax.tree_map(lambda x: jnp.array(x)[None, None], Unit.empty(self.env_cfg))
+    units = jux.tree_util.tree_where(dead, empty_unit, self.units)
+    units = jax.tree_map(lambda x: x[jnp.arange(2)[:, None], live_idx], units)
+    n_units = self.n_units - dead.sum(axis=1, dtype=self.n_units.dtype)
+    board = self.board.update_units_map(units)
+    return self._replace(units=units, n_units=n_units, board=board), live_idx
+
+
+def make_states(max_n_units: int, batch_size: int, seed: int = 0) -> State:
+    """States with half of the unit buffer filled by units at random positions."""
+    env_cfg = EnvConfig()
+    buf_cfg = JuxBufferConfig(MAX_N_UNITS=max_n_units)
+    state = State.new(seed, env_cfg, buf_cfg)
+    n_units = max_n_units // 2
+    live = np.arange(max_n_units) < n_units  # bool[U]
+    team_id = np.arange(2)[:, None]  # int[2, 1]
+    rng = np.random.default_rng(seed)
+    units = state.units._replace(
+        unit_id=jnp.where(live, np.arange(max_n_units) * 2 + team_id, state.units.unit_id).astype(Unit.id_dtype()),
+        team_id=jnp.where(live, team_id, state.units.team_id).astype(state.units.team_id.dtype),
+        pos=state.units.pos._replace(pos=jnp.where(
+            live[:, None],
+            rng.integers(0, env_cfg.map_size, size=(2, max_n_units, 2)),
+            state.units.pos.pos,
+        ).astype(state.units.pos.pos.dtype)),
+    )
+    state = state._replace(
+        units=units,
+        n_units=jnp.array([n_units, n_units], dtype=state.n_units.dtype),
+        board=state.board.update_units_map(units),
+    )
+    return jux.tree_util.batch_into_leaf([state] * batch_size)
+
+
+def timeit(fn, *args, repeat: int) -> float:
+    jax.block_until_ready(fn(*args))  # compile
+    start = time.perf_counter()
+    for _ in range(repeat):
+        jax.block_until_ready(fn(*args))
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--max-n-units', type=int, nargs='+', default=[100, 200, 400, 1000])
+    args = parser.parse_args()
+
+    argsort = jax.jit(jax.vmap(destroy_unit_argsort))
+    # With a dead mask per env, vmap turns `lax.cond` in `destroy_unit` into `select`, which runs both branches and
+    # selects the whole state. With `batch_axis_name`, as in `JuxEnvBatch`, the predicate is reduced over the batch,
+    # so the `lax.cond` is kept, and compaction is skipped if no env in the batch has a dead unit.
+    per_env = jax.jit(jax.vmap(State.destroy_unit))
+    batch_any = jax.jit(jax.vmap(partial(State.destroy_unit, batch_axis_name='batch'), axis_name='batch'))
+
+    print(f"backend: {jax.default_backend()}, batch size: {args.batch_size}, time per call in ms")
+    print("dead: 5% of units in every env, in 1 env only, or none. All dead masks are per env.")
+    print(f"{'MAX_N_UNITS':>11} {'dead':>6} {'argsort':>9} {'per-env':>9} {'batch-any':>9} {'speedup':>8}")
+    for max_n_units in args.max_n_units:
+        states = make_states(max_n_units, args.batch_size)
+        rng = np.random.default_rng(max_n_units)
+        some_dead = jnp.asarray(rng.random((args.batch_size, 2, max_n_units)) < 0.05) & states.unit_mask
+        cases = [
+            ('5%', some_dead),
+            ('1 env', some_dead.at[1:].set(False)),
+            ('none', jnp.zeros_like(some_dead)),
+        ]
+        for name, dead in cases:
+            results = [per_env(states, dead), batch_any(states, dead)]
+            assert jax.vmap(lambda a, b: a == b)(results[0][0], results[1][0]).all()
+            t_old = timeit(argsort, states, dead, repeat=args.repeat)
+            t_per_env = timeit(per_env, states, dead, repeat=args.repeat)
+            t_batch_any = timeit(batch_any, states, dead, repeat=args.repeat)
+            print(f"{max_n_units:>11} {name:>6} {t_old * 1e3:>9.3f} {t_per_env * 1e3:>9.3f} {t_batch_any * 1e3:>9.3f} "
+                  f"{t_old / t_batch_any:>7.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+"""
+Benchmark `jux.map_generator.flood._flood_fill()` against the previous min-label propagation, on the lichen graphs
+`State._cache_water_info()` builds from late-game boards of replays, and on a snake-shaped strain.
+
+Reports the number of rounds of the `while_loop`, per board and the maximum over the batch, which every env of a
+vmapped batch waits for, and the time of a vmapped call. Then compares flooding each replay board from scratch with
+starting from the components of the step before, where components that lost a cell are reset.
+
+Usage:
+    python tests/benchmark_flood_fill.py [--repeat 20]
+"""
+import argparse
+import time
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+import jux.utils
+from jux.map_generator.flood import _flood_fill_with_n_rounds, code2color, color2code
+from jux.state import State
+from jux.utils import imax
+
+
+def flood_fill_min_label(neighbor_ij):
+    # the implementation before pointer jumping, as reference
+    def _cond(args):
+        color, new_color, _ = args
+        return (color != new_color).any()
+
+    def _body(args):
+        color, new_color, n_rounds = args
+        color = new_color
+        neighbor_color = color[neighbor_ij[..., 0], neighbor_ij[..., 1]]  # int[H, W, 5, 2]
+        min_idx = jnp.argmin(color2code(neighbor_color), axis=-1)  # int[H, W]
+        new_color = neighbor_color[ij[..., 0], ij[..., 1], min_idx]  # int[H, W, 2]
+        code = color2code(new_color)  # int[H, W]
+        new_color = code2color(code.at[color[..., 0], color[..., 1]].min(code))  # int[H, W, 2]
+        new_color = new_color[new_color[..., 0], new_color[..., 1]]
+        return color, new_color, n_rounds + 1
+
+    H, W = neighbor_ij.shape[:2]
+    ij = jnp.mgrid[:H, :W].astype(neighbor_ij.dtype).transpose(1, 2, 0)  # int[H, W, 2]
+    color, _, n_rounds = jax.lax.while_loop(_cond, _body, (ij - 1, ij, 0))
+    return color, n_rounds
+
+
+def lichen_neighbor_ij(strains_and_factory):
+    """The graph `State._cache_water_info()` floods: neighbors in the same strain. int[H, W, 5, 2]"""
+    H, W = strains_and_factory.shape
+    ij = np.mgrid[:H, :W].transpose(1, 2, 0)  # int[H, W, 2]
+    delta_ij = np.array([[-1, 0], [0, 1], [1, 0], [0, -1]])
+    neighbor_ij = np.clip(ij[:, :, None] + delta_ij, 0, [H - 1, W - 1])  # int[H, W, 4, 2]
+    neighbor_strain = strains_and_factory[neighbor_ij[..., 0], neighbor_ij[..., 1]]
+    connect = (neighbor_strain == strains_and_factory[..., None]) & (strains_and_factory[..., None] != imax(
+        strains_and_factory.dtype))
+    neighbor_ij = np.where(connect[..., None], neighbor_ij, ij[:, :, None])
+    return np.concatenate([neighbor_ij, ij[:, :, None]], axis=2).astype(np.int8)
+
+
+def replay_strains(episodes):
+    """Strains and factories of late-game boards in replays, as `State._cache_water_info()` sees them.
+
+    Returns:
+        int[N, H, W], and bool[N], whether a board directly follows the previous one in the same replay.
+    """
+    strains = []
+    follows = []
+    for episode in episodes:
+        lux_env, lux_actions = jux.utils.load_replay(episode)
+        for lux_act in lux_actions:
+            if lux_env.state.real_env_steps >= 0:
+                state = State.from_lux(lux_env.state)
+                strains_and_factory = np.minimum(state.board.lichen_strains, state.board.factory_occupancy_map)
+                strains_and_factory = np.where(state.board.rubble == 0, strains_and_factory,
+                                               imax(strains_and_factory.dtype))
+                follows.append(len(strains) > 0 and lux_env.state.real_env_steps > 0)
+                strains.append(strains_and_factory)
+            _, _, dones, _, _ = lux_env.step(jux.utils.live_actions(lux_env.state, lux_act))
+            if dones['player_0'] or dones['player_1']:
+                break
+    return np.stack(strains), np.array(follows)
+
+
+def flood_fill_warm_start(neighbor_ij, color):
+    """
+    `_flood_fill_with_n_rounds()` starting from an initial `color` instead of each cell being its own color, as an
+    experiment. Cells with the same initial color must be connected in `neighbor_ij`, and their color must be the
+    smallest of them.
+    """
+    H, W, N = neighbor_ij.shape[:3]
+
+    def _label(ij):
+        return ij[..., 1].astype(jnp.int32) * H + ij[..., 0].astype(jnp.int32)
+
+    neighbor = _label(neighbor_ij.transpose(1, 0, 2, 3).reshape(W * H, N, 2))  # int[W * H, N]
+
+    def _cond(args):
+        parent, grandparent, _ = args
+        return (parent[parent] != grandparent).any()
+
+    def _body(args):
+        parent, _, n_rounds = args
+        grandparent = parent[parent]
+        min_neighbor = grandparent[neighbor].min(axis=-1)
+        parent = parent.at[parent].min(min_neighbor)
+        parent = jnp.minimum(parent, min_neighbor)
+        parent = jnp.minimum(parent, parent[parent])
+        return parent, grandparent, n_rounds + 1
+
+    label = jnp.arange(W * H, dtype=jnp.int32)
+    parent = _label(color.transpose(1, 0, 2).reshape(W * H, 2))
+    parent, _, n_rounds = jax.lax.while_loop(_cond, _body, (parent, label - 1, 0))
+
+    color = jnp.stack([parent % H, parent // H], axis=-1)
+    color = color.reshape(W, H, 2).transpose(1, 0, 2).astype(neighbor_ij.dtype)
+    return color, n_rounds
+
+
+def warm_start_color(color, strains_and_factory):
+    """
+    The initial color for `flood_fill_warm_start()` from the `color` of the step before: components with a cell that is no
+    longer in the same strain as the component root are reset, and the others are still connected.
+    """
+    H, W = strains_and_factory.shape
+    ij = jnp.mgrid[:H, :W].astype(color.dtype).transpose(1, 2, 0)  # int[H, W, 2]
+    root_strain = strains_and_factory[color[..., 0], color[..., 1]]  # int[H, W]
+    broken = ~(color == ij).all(-1) & ((strains_and_factory != root_strain) |
+                                       (strains_and_factory == imax(strains_and_factory.dtype)))
+    broken = jnp.zeros_like(broken).at[color[..., 0], color[..., 1]].max(broken)
+    broken = broken[color[..., 0], color[..., 1]]
+    return jnp.where(broken[..., None], ij, color)
+
+
+def snake_board(size: int):
+    """A single strain winding through the whole board, with one-cell walls between rows."""
+    strains = np.full((size, size), imax(np.int16), dtype=np.int16)
+    strains[::2] = 0
+    strains[1::4, -1] = 0
+    strains[3::4, 0] = 0
+    return lichen_neighbor_ij(strains)
+
+
+def timeit(fn, *args, repeat: int) -> float:
+    jax.block_until_ready(fn(*args))  # compile
+    start = time.perf_counter()
+    for _ in range(repeat):
+        jax.block_until_ready(fn(*args))
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--every', type=int, default=10)
+    parser.add_argument('--episodes', nargs='+', default=['tests/replay2.0_0.json.gz', 'tests/replay2.0_1.json.gz'])
+    args = parser.parse_args()
+
+    strains, follows = replay_strains(args.episodes)
+    all_replay = np.stack([lichen_neighbor_ij(x) for x in strains])
+    replay = all_replay[::args.every]
+    size = replay.shape[1]
+    cases = {
+        'replay': replay,
+        'snake': np.stack([snake_board(size)] * len(replay)),
+        'replay+snake': np.concatenate([replay[:-1], snake_board(size)[None]]),
+    }
+
+    min_label = jax.jit(jax.vmap(flood_fill_min_label))
+    pointer_jumping = jax.jit(jax.vmap(_flood_fill_with_n_rounds))
+
+    print(f"backend: {jax.default_backend()}, {len(replay)} boards of {size}x{size}, time per vmapped call in ms")
+    print(f"{'boards':>12} {'':>15} {'mean rounds':>11} {'max rounds':>10} {'time':>9}")
+    for name, boards in cases.items():
+        boards = jnp.asarray(boards)
+        results = []
+        for method, fn in [('min-label', min_label), ('pointer-jumping', pointer_jumping)]:
+            color, n_rounds = fn(boards)
+            t = timeit(fn, boards, repeat=args.repeat)
+            results.append(color)
+            print(f"{name:>12} {method:>15} {float(n_rounds.mean()):>11.1f} {int(n_rounds.max()):>10} {t * 1e3:>9.3f}")
+        assert (results[0] == results[1]).all()
+
+    # warm start from the step before
+    all_replay = jnp.asarray(all_replay)
+    prev_color, _ = pointer_jumping(all_replay)
+    boards = all_replay[1:][follows[1:]]
+    from_scratch = jax.jit(jax.vmap(lambda b, c: _flood_fill_with_n_rounds(b)))
+    warm_start = jax.jit(jax.vmap(lambda b, c: flood_fill_warm_start(b, warm_start_color(c[0], c[1]))))
+    prev = (prev_color[:-1][follows[1:]], jnp.asarray(strains[1:][follows[1:]]))
+    print(f"{len(boards)} consecutive replay boards, flooded from scratch or from the step before")
+    results = []
+    for method, fn in [('from scratch', from_scratch), ('warm start', warm_start)]:
+        color, n_rounds = fn(boards, prev)
+        t = timeit(fn, boards, prev, repeat=args.repeat)
+        results.append(color)
+        print(f"{method:>12} rounds {np.bincount(np.asarray(n_rounds))}, max {int(n_rounds.max())}, "
+              f"{t * 1e3:.3f} ms")
+    assert (results[0] == results[1]).all()
+
+
+if __name__ == '__main__':
+    main()
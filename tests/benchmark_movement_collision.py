@@ -0,0 +1,80 @@
+"""
+Benchmark `State._handle_movement_actions()`, which resolves collisions by sorting units by cell, against the
+previous implementation with maps of the board size, across `MAX_N_UNITS`.
+
+Usage:
+    python tests/benchmark_movement_collision.py [--batch-size 64] [--repeat 20]
+"""
+import argparse
+import time
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+import jux.tree_util
+from jux.actions import JuxAction
+from jux.config import EnvConfig, JuxBufferConfig
+from jux.map.position import Position
+from jux.state import State
+from tests.state.test_state import handle_movement_actions_by_map
+
+
+def make_inputs(max_n_units: int, batch_size: int, seed: int = 0):
+    """States with 20 units per team at random positions, all moving in random directions."""
+    env_cfg = EnvConfig()
+    buf_cfg = JuxBufferConfig(MAX_N_UNITS=max_n_units)
+    state = State.new(seed, env_cfg, buf_cfg)
+    rng = np.random.default_rng(seed)
+    n_units = min(20, max_n_units)
+    units = state.units._replace(
+        unit_id=jnp.arange(2 * max_n_units, dtype=state.units.unit_id.dtype).reshape(2, max_n_units),
+        unit_type=jnp.asarray(rng.integers(0, 2, size=(2, max_n_units)), dtype=state.units.unit_type.dtype),
+        pos=Position(
+            jnp.asarray(rng.integers(1, env_cfg.map_size - 1, size=(2, max_n_units, 2)),
+                        dtype=state.units.pos.pos.dtype)),
+        power=jnp.asarray(rng.integers(0, 100, size=(2, max_n_units)), dtype=state.units.power.dtype),
+    )
+    state = state._replace(units=units, n_units=jnp.array([n_units, n_units], dtype=state.n_units.dtype))
+    unit_action = jax.tree_map(lambda x: x[..., 0], JuxAction.empty(env_cfg, buf_cfg).unit_action_queue)
+    unit_action = unit_action._replace(direction=jnp.asarray(rng.integers(1, 5, size=(2, max_n_units)), jnp.int8))
+    movement_info = dict(
+        valid=state.unit_mask,
+        power_cost=jnp.ones((2, max_n_units), dtype=state.units.power.dtype),
+    )
+    already_dead = jnp.zeros((2, max_n_units), dtype=jnp.bool_)
+    batch = lambda x: jux.tree_util.batch_into_leaf([x] * batch_size)
+    return batch(state), batch(unit_action), batch(movement_info), batch(already_dead)
+
+
+def timeit(fn, *args, repeat: int) -> float:
+    jax.block_until_ready(fn(*args))  # compile
+    start = time.perf_counter()
+    for _ in range(repeat):
+        jax.block_until_ready(fn(*args))
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--max-n-units', type=int, nargs='+', default=[32, 100, 200, 400, 1000])
+    args = parser.parse_args()
+
+    by_map = jax.jit(jax.vmap(handle_movement_actions_by_map))
+    by_sort = jax.jit(jax.vmap(State._handle_movement_actions))
+
+    print(f"backend: {jax.default_backend()}, batch size: {args.batch_size}, 20 units per team, time per call in ms")
+    print(f"{'MAX_N_UNITS':>11} {'map':>9} {'sort':>9} {'speedup':>8}")
+    for max_n_units in args.max_n_units:
+        inputs = make_inputs(max_n_units, args.batch_size)
+        (state_a, dead_a), (state_b, dead_b) = by_map(*inputs), by_sort(*inputs)
+        assert (dead_a == dead_b).all() and (state_a.units.power == state_b.units.power).all()
+        t_map = timeit(by_map, *inputs, repeat=args.repeat)
+        t_sort = timeit(by_sort, *inputs, repeat=args.repeat)
+        print(f"{max_n_units:>11} {t_map * 1e3:>9.3f} {t_sort * 1e3:>9.3f} {t_map / t_sort:>7.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+Benchmark unit action queues packed into `PackedUnitAction`, selected by `JuxBufferConfig(PACKED_ACTION_QUEUE=True)`,
+against the default layout of six `UnitAction` fields.
+
+Reports the number of gather and scatter ops in the queue paths, reading the next action (`Unit.next_action()`) and
+popping or pushing it back (`Unit.repeat_action()`), and the time of them and of `JuxEnvBatch.step_late_game()` on
+states and actions sampled from replays.
+
+Usage:
+    python tests/benchmark_packed_action_queue.py [--batch-size 64] [--repeat 20]
+"""
+import argparse
+import re
+import time
+
+import jax
+import numpy as np
+
+import jux.tree_util
+from jux.config import JuxBufferConfig
+from jux.env import JuxEnvBatch
+from jux.unit import Unit
+from tests.benchmark_skip_unused_actions import load_samples
+
+
+def queue_paths(units: Unit, success):
+    return units.next_action(), units.repeat_action(success)
+
+
+def count_ops(fn, *args):
+    hlo = jax.jit(fn).lower(*args).as_text()
+    return {op: len(re.findall(rf'stablehlo\.{op}"?\(', hlo)) for op in ('gather', 'scatter')}
+
+
+def timeit(fn, *args, repeat: int) -> float:
+    jax.block_until_ready(fn(*args))  # compile
+    start = time.perf_counter()
+    for _ in range(repeat):
+        jax.block_until_ready(fn(*args))
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--episodes', nargs='+', default=['tests/replay2.0_0.json.gz', 'tests/replay2.0_1.json.gz'])
+    args = parser.parse_args()
+
+    samples = load_samples(args.episodes)
+    rng = np.random.default_rng(0)
+    idx = rng.choice(len(samples), size=args.batch_size)
+    states, actions = jux.tree_util.batch_into_leaf([samples[i] for i in idx])
+    success = rng.random(states.unit_mask.shape) < 0.5
+    layouts = {
+        'default': states,
+        'packed': states.pack_action_queues(),
+    }
+
+    print(f"backend: {jax.default_backend()}, batch size: {args.batch_size}, {len(samples)} replay samples")
+    print(f"{'layout':>8} {'gathers':>8} {'scatters':>9} {'queue (ms)':>11} {'step (ms)':>10} {'steps/s':>10}")
+    for layout, batch_states in layouts.items():
+        ops = count_ops(queue_paths, batch_states.units, success)
+        t_queue = timeit(jax.jit(queue_paths), batch_states.units, success, repeat=args.repeat)
+        env_batch = JuxEnvBatch(buf_cfg=JuxBufferConfig(PACKED_ACTION_QUEUE=layout == 'packed'))
+        new_states, _ = env_batch.step_late_game(batch_states, actions)
+        assert new_states.units.action_queue.is_packed == (layout == 'packed')
+        t_step = timeit(env_batch.step_late_game, batch_states, actions, repeat=args.repeat)
+        print(f"{layout:>8} {ops['gather']:>8} {ops['scatter']:>9} {t_queue * 1e3:>11.3f} {t_step * 1e3:>10.3f} "
+              f"{args.batch_size / t_step:>10.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+Benchmark `Unit.next_action()` and `Unit.repeat_action()` on whole `Unit[B, 2, U]` buffers, which use masked
+arithmetic over `[B, 2, U, Q]` queues, against the previous per-unit versions with `jax.lax.cond` and scatters under
+`jax.vmap`, across `MAX_N_UNITS`.
+
+Usage:
+    python tests/benchmark_queue_ops.py [--batch-size 64] [--repeat 20]
+"""
+import argparse
+import time
+
+import jax
+import numpy as np
+
+from jux.config import EnvConfig
+from jux.unit import Unit
+from tests.test_unit import next_action_by_cond, random_units, repeat_action_by_scatter
+
+
+def by_vmap(units: Unit, success):
+    vmap3 = lambda f: jax.vmap(jax.vmap(jax.vmap(f)))
+    return vmap3(next_action_by_cond)(units), vmap3(repeat_action_by_scatter)(units, success)
+
+
+def batched(units: Unit, success):
+    return units.next_action(), units.repeat_action(success)
+
+
+def timeit(fn, *args, repeat: int) -> float:
+    jax.block_until_ready(fn(*args))  # compile
+    start = time.perf_counter()
+    for _ in range(repeat):
+        jax.block_until_ready(fn(*args))
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--max-n-units', type=int, nargs='+', default=[100, 400, 1000, 2000])
+    args = parser.parse_args()
+
+    env_cfg = EnvConfig()
+    fn_vmap = jax.jit(by_vmap)
+    fn_batched = jax.jit(batched)
+
+    print(f"backend: {jax.default_backend()}, batch size: {args.batch_size}, time per call in ms")
+    print(f"{'MAX_N_UNITS':>11} {'vmap':>9} {'batched':>9} {'speedup':>8}")
+    for max_n_units in args.max_n_units:
+        units = random_units(env_cfg, (args.batch_size, 2, max_n_units))
+        success = np.random.default_rng(1).random((args.batch_size, 2, max_n_units)) < 0.7
+        jax.tree_util.tree_map(lambda a, b: np.testing.assert_array_equal(a, b), fn_vmap(units, success),
+                               fn_batched(units, success))
+        t_vmap = timeit(fn_vmap, units, success, repeat=args.repeat)
+        t_batched = timeit(fn_batched, units, success, repeat=args.repeat)
+        print(f"{max_n_units:>11} {t_vmap * 1e3:>9.3f} {t_batched * 1e3:>9.3f} {t_vmap / t_batched:>7.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""
+Benchmark `Unit.add_resource()` and `Unit.sub_resource()` on whole `Unit[B, 2, U]` buffers, which treat power as the
+fifth column of a resource ledger, against the previous per-unit versions with `jax.lax.cond` under `jax.vmap`,
+across `MAX_N_UNITS`.
+
+Usage:
+    python tests/benchmark_resource_ledger.py [--batch-size 64] [--repeat 20]
+"""
+import argparse
+import time
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+from jux.config import EnvConfig
+from jux.unit import Unit
+from tests.test_unit import add_resource_by_cond, random_transfers, sub_resource_by_cond
+
+
+def by_vmap(units: Unit, resource, amount, unit_cfgs):
+    vmap3 = lambda f, in_axes=0: jax.vmap(jax.vmap(jax.vmap(f, in_axes), in_axes), in_axes)
+    added = vmap3(add_resource_by_cond, (0, 0, 0, None))(units, resource, amount, unit_cfgs)
+    subtracted = vmap3(sub_resource_by_cond)(units, resource, jnp.maximum(amount, 0))
+    return added, subtracted
+
+
+def batched(units: Unit, resource, amount, unit_cfgs):
+    return units.add_resource(resource, amount, unit_cfgs), units.sub_resource(resource, jnp.maximum(amount, 0))
+
+
+def timeit(fn, *args, repeat: int) -> float:
+    jax.block_until_ready(fn(*args))  # compile
+    start = time.perf_counter()
+    for _ in range(repeat):
+        jax.block_until_ready(fn(*args))
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--max-n-units', type=int, nargs='+', default=[100, 400, 1000, 2000])
+    args = parser.parse_args()
+
+    env_cfg = EnvConfig()
+    fn_vmap = jax.jit(by_vmap, static_argnums=(3, ))
+    fn_batched = jax.jit(batched, static_argnums=(3, ))
+
+    print(f"backend: {jax.default_backend()}, batch size: {args.batch_size}, time per call in ms")
+    print(f"{'MAX_N_UNITS':>11} {'vmap':>9} {'batched':>9} {'speedup':>8}")
+    for max_n_units in args.max_n_units:
+        units, resource, amount = random_transfers(env_cfg, (args.batch_size, 2, max_n_units))
+        fn_args = (units, resource, amount, env_cfg.ROBOTS)
+        jax.tree_util.tree_map(lambda a, b: np.testing.assert_array_equal(a, b), fn_vmap(*fn_args),
+                               fn_batched(*fn_args))
+        t_vmap = timeit(fn_vmap, *fn_args, repeat=args.repeat)
+        t_batched = timeit(fn_batched, *fn_args, repeat=args.repeat)
+        print(f"{max_n_units:>11} {t_vmap * 1e3:>9.3f} {t_batched * 1e3:>9.3f} {t_vmap / t_batched:>7.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Benchmark `JuxEnvSharded.step_late_game()` against `JuxEnvBatch.step_late_game()` on the same total batch size.
+
+On CPU, the batch is split across `--n-devices` host devices, created with
+`XLA_FLAGS=--xla_force_host_platform_device_count`. Each host device runs its shard on its own thread, so the gain
+is bounded by the number of physical cores. On GPU, all visible devices are used and `--n-devices` is ignored.
+
+Usage:
+    python tests/benchmark_sharded.py [--n-devices 4] [--batch-size 64] [--repeat 20]
+"""
+import argparse
+import os
+import time
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n-devices', type=int, default=4)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--max-n-units', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    # must be set before jax initializes its backend
+    os.environ['XLA_FLAGS'] = (f"{os.environ.get('XLA_FLAGS', '')} "
+                               f"--xla_force_host_platform_device_count={args.n_devices}")
+
+    import jax
+    import jax.numpy as jnp
+
+    import jux.tree_util
+    from jux.actions import JuxAction
+    from jux.config import JuxBufferConfig
+    from jux.env import JuxEnvBatch, JuxEnvSharded
+
+    buf_cfg = JuxBufferConfig(MAX_N_UNITS=args.max_n_units)
+    env_batch = JuxEnvBatch(buf_cfg=buf_cfg)
+    seeds = jnp.arange(args.batch_size)
+    actions = JuxAction.empty(env_batch.env_cfg, env_batch.buf_cfg)
+    actions = actions._replace(factory_action=jnp.ones_like(actions.factory_action))  # build heavy robots
+    actions = jux.tree_util.batch_into_leaf([actions] * args.batch_size)
+
+    def steps_per_second(step, states, actions):
+        states, _ = jax.block_until_ready(step(states, actions))  # compile
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            states, _ = step(states, actions)
+        jax.block_until_ready(states)
+        return args.batch_size * args.repeat / (time.perf_counter() - start)
+
+    print(f"backend: {jax.default_backend()}, devices: {jax.device_count()}, cpu cores: {os.cpu_count()}, "
+          f"batch size: {args.batch_size}, MAX_N_UNITS: {args.max_n_units}")
+    print(f"{'devices':>7} {'steps/s':>10} {'speedup':>8}")
+
+    baseline = steps_per_second(env_batch.step_late_game, env_batch.reset_to_late_game(seeds), actions)
+    print(f"{1:>7} {baseline:>10.1f} {1:>7.2f}x")
+
+    n_devices = 2
+    while n_devices <= jax.device_count():
+        if args.batch_size % n_devices == 0:
+            env_sharded = JuxEnvSharded(buf_cfg=buf_cfg, devices=jax.devices()[:n_devices])
+            sps = steps_per_second(
+                env_sharded.step_late_game,
+                env_sharded.reset_to_late_game(seeds),
+                env_sharded.shard(actions),
+            )
+            print(f"{n_devices:>7} {sps:>10.1f} {sps / baseline:>7.2f}x")
+        n_devices *= 2
+
+
+if __name__ == '__main__':
+    main()
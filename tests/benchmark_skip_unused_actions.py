@@ -0,0 +1,122 @@
+"""
+Benchmark `JuxEnvBatch.step_late_game()` with and without `skip_unused_actions`, on states and actions sampled
+from replays.
+
+Two action mixes are measured:
+    replay: actions as in the replays.
+    common: the same, but units whose next action would be transfer, pickup or self-destruct get an empty action
+        queue, and factories do not build robots. All skippable handlers are unused.
+
+Usage:
+    python tests/benchmark_skip_unused_actions.py [--batch-size 64] [--repeat 20]
+"""
+import argparse
+import time
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+import jux.tree_util
+import jux.utils
+from jux.actions import FactoryAction, JuxAction, UnitActionType
+from jux.env import JuxEnvBatch
+from jux.state import State
+
+RARE_UNIT_ACTIONS = [UnitActionType.TRANSFER, UnitActionType.PICKUP, UnitActionType.SELF_DESTRUCT]
+
+
+def load_samples(episodes):
+    """All `(state, action)` pairs of the late game in the replays."""
+    samples = []
+    for episode in episodes:
+        lux_env, lux_actions = jux.utils.load_replay(episode)
+        for lux_act in lux_actions:
+            if lux_env.state.real_env_steps >= 0:
+                lux_act = jux.utils.live_actions(lux_env.state, lux_act)
+                state = State.from_lux(lux_env.state)
+                samples.append((state, JuxAction.from_lux(state, lux_act)))
+            _, _, dones, _, _ = lux_env.step(lux_act)
+            if dones['player_0'] or dones['player_1']:
+                break
+    return samples
+
+
+def next_unit_action_type(states: State, actions: JuxAction):
+    """The type of the action each unit executes next. int[B, 2, U]"""
+    queue = states.units.action_queue
+    queued = jnp.take_along_axis(queue.data.action_type, queue.front[..., None].astype(jnp.int32), axis=-1)[..., 0]
+    queued = jnp.where(queue.count > 0, queued, UnitActionType.DO_NOTHING)
+    updated = jnp.where(actions.unit_action_queue_count > 0, actions.unit_action_queue.action_type[..., 0],
+                        UnitActionType.DO_NOTHING)
+    action_type = jnp.where(actions.unit_action_queue_update, updated, queued)
+    return jnp.where(states.unit_mask, action_type, UnitActionType.DO_NOTHING)
+
+
+def drop_rare_actions(states: State, actions: JuxAction) -> JuxAction:
+    rare = jnp.isin(next_unit_action_type(states, actions), jnp.array(RARE_UNIT_ACTIONS))
+    is_build = (actions.factory_action == FactoryAction.BUILD_LIGHT) | (actions.factory_action
+                                                                        == FactoryAction.BUILD_HEAVY)
+    return actions._replace(
+        factory_action=jnp.where(is_build, FactoryAction.DO_NOTHING, actions.factory_action).astype(
+            actions.factory_action.dtype),
+        unit_action_queue_count=jnp.where(rare, 0, actions.unit_action_queue_count).astype(
+            actions.unit_action_queue_count.dtype),
+        unit_action_queue_update=actions.unit_action_queue_update | rare,
+    )
+
+
+def action_frequencies(states: State, actions: JuxAction):
+    """The fraction of envs in which at least one unit or factory takes each skippable action."""
+    action_type = next_unit_action_type(states, actions)
+    freq = {
+        t.name.lower(): float((action_type == t).any(axis=(1, 2)).mean())
+        for t in RARE_UNIT_ACTIONS
+    }
+    is_build = (actions.factory_action == FactoryAction.BUILD_LIGHT) | (actions.factory_action
+                                                                        == FactoryAction.BUILD_HEAVY)
+    freq['factory_build'] = float((is_build & states.factory_mask).any(axis=(1, 2)).mean())
+    return freq
+
+
+def timeit(fn, *args, repeat: int) -> float:
+    jax.block_until_ready(fn(*args))  # compile
+    start = time.perf_counter()
+    for _ in range(repeat):
+        jax.block_until_ready(fn(*args))
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--episodes', nargs='+', default=['tests/replay2.0_0.json.gz', 'tests/replay2.0_1.json.gz'])
+    args = parser.parse_args()
+
+    samples = load_samples(args.episodes)
+    rng = np.random.default_rng(0)
+    idx = rng.choice(len(samples), size=args.batch_size)
+    states, actions = jux.tree_util.batch_into_leaf([samples[i] for i in idx])
+    mixes = {
+        'replay': actions,
+        'common': drop_rare_actions(states, actions),
+    }
+
+    step = JuxEnvBatch().step_late_game
+    skip_step = JuxEnvBatch(skip_unused_actions=True).step_late_game
+
+    print(f"backend: {jax.default_backend()}, batch size: {args.batch_size}, {len(samples)} replay samples")
+    for name, mix in mixes.items():
+        freq = action_frequencies(states, mix)
+        print(f"{name}: fraction of envs using " + ", ".join(f"{k} {v:.2f}" for k, v in freq.items()))
+
+    print(f"{'mix':>8} {'off (ms)':>9} {'on (ms)':>9} {'speedup':>8}")
+    for name, mix in mixes.items():
+        t_off = timeit(step, states, mix, repeat=args.repeat)
+        t_on = timeit(skip_step, states, mix, repeat=args.repeat)
+        print(f"{name:>8} {t_off * 1e3:>9.3f} {t_on * 1e3:>9.3f} {t_off / t_on:>7.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+from jux.map_generator.flood import _flood_fill, _flood_fill_with_n_rounds, flood_fill
+
+
+def flood_fill_bfs(mask: np.ndarray) -> np.ndarray:
+    """Reference: the color of each cell is the cell of its component that is the smallest in column-major order."""
+    H, W = mask.shape
+    color = np.full((H, W, 2), -1)
+    for j in range(W):
+        for i in range(H):
+            if color[i, j, 0] >= 0:
+                continue
+            color[i, j] = (i, j)
+            if mask[i, j]:
+                continue
+            stack = [(i, j)]
+            while stack:
+                x, y = stack.pop()
+                for dx, dy in [(-1, 0), (0, 1), (1, 0), (0, -1)]:
+                    nx, ny = x + dx, y + dy
+                    if 0 <= nx < H and 0 <= ny < W and not mask[nx, ny] and color[nx, ny, 0] < 0:
+                        color[nx, ny] = (i, j)
+                        stack.append((nx, ny))
+    return color
+
+
+def snake_mask(size: int) -> np.ndarray:
+    mask = np.zeros((size, size), dtype=np.bool_)
+    mask[1::2] = True
+    mask[1::4, -1] = False
+    mask[3::4, 0] = False
+    return mask
+
+
+class TestFloodFill:
+
+    def test_flood_fill(self):
+        rng = np.random.default_rng(0)
+        for H, W, p in [(10, 10, 0.3), (48, 48, 0.4), (13, 7, 0.5), (32, 32, 0.0), (32, 32, 1.0)]:
+            mask = rng.random((H, W)) < p
+            assert (flood_fill(jnp.asarray(mask)) == flood_fill_bfs(mask)).all()
+
+        mask = snake_mask(48)
+        assert (flood_fill(jnp.asarray(mask)) == flood_fill_bfs(mask)).all()
+
+    def test_n_rounds(self):
+        # a single component whose path length is about half of the cells
+        size = 64
+        mask = snake_mask(size)
+        ij = np.mgrid[:size, :size].transpose(1, 2, 0)
+        neighbor_ij = np.clip(ij[:, :, None] + np.array([[0, 0], [-1, 0], [0, 1], [1, 0], [0, -1]]), 0, size - 1)
+        neighbor_ij = np.where(mask[neighbor_ij[..., 0], neighbor_ij[..., 1]][..., None] | mask[:, :, None, None],
+                               ij[:, :, None], neighbor_ij).astype(np.int16)
+
+        color, n_rounds = jax.jit(_flood_fill_with_n_rounds)(jnp.asarray(neighbor_ij))
+        assert (color == flood_fill_bfs(mask)).all()
+        assert (color == _flood_fill(jnp.asarray(neighbor_ij))).all()
+        assert n_rounds <= 2 * np.log2(size * size)
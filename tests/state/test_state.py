@@ -10,9 +10,13 @@ from rich import print
 
 import jux.actions
 import jux.utils
+from jux.actions import FactoryAction
 from jux.config import EnvConfig, JuxBufferConfig
-from jux.state import JuxAction, State
+from jux.map.position import Direction, Position, direct2delta_xy
+from jux.state import Features, JuxAction, State
 from jux.team import FactionTypes
+from jux.unit import UnitType
+from jux.utils import imax
 
 jnp.set_printoptions(linewidth=500, threshold=10000)
 
@@ -21,6 +25,62 @@ from jux.tree_util import map_to_aval
 state___eq___jitted = jax.jit(chex.assert_max_traces(n=1)(State.__eq__))
 
 
+def handle_movement_actions_by_map(self: State, actions, movement_info, already_dead):
+    """The collision resolution before sorting units by cell, with maps of the board size, as reference."""
+    valid, power_cost = movement_info['valid'], movement_info['power_cost']
+    is_moving = valid & (actions.direction != Direction.CENTER)
+    new_pos = self.units.pos.pos + direct2delta_xy[actions.direction] * is_moving[..., None]
+    units = self.units._replace(pos=Position(new_pos), power=self.units.power - power_cost * is_moving)
+
+    unit_mask = self.unit_mask
+    light = (units.unit_type == UnitType.LIGHT) & unit_mask
+    heavy = (units.unit_type == UnitType.HEAVY) & unit_mask
+    moving = is_moving & unit_mask
+    still = (~is_moving) & unit_mask
+    x, y = units.pos.x, units.pos.y
+    is_living = ~already_dead & unit_mask
+
+    cnt = jnp.zeros_like(self.board.units_map, dtype=jnp.int8)
+    still_light_cnt = cnt.at[x, y].add(light & still & is_living, mode='drop')
+    moving_light_cnt = cnt.at[x, y].add(light & moving & is_living, mode='drop')
+    still_heavy_cnt = cnt.at[x, y].add(heavy & still & is_living, mode='drop')
+    moving_heavy_cnt = cnt.at[x, y].add(heavy & moving & is_living, mode='drop')
+
+    def second_max(group):
+        max_power = jnp.full_like(self.board.units_map, fill_value=-1, dtype=units.power.dtype)
+        group_max_power = max_power.at[x, y].max(jnp.where(group, units.power, -1), mode='drop')
+        max_power_in_unit_pos = group_max_power[x, y]
+        group_second_max = max_power.at[x, y].max(
+            jnp.where(group & (units.power != max_power_in_unit_pos), units.power, -1),
+            mode='drop',
+        )
+        group_max_cnt = cnt.at[x, y].add(group & (units.power == max_power_in_unit_pos), mode='drop')
+        return jnp.where(group_max_cnt > 1, group_max_power, group_second_max)[x, y]
+
+    moving_light_second_max = second_max(light & moving & is_living)
+    moving_heavy_second_max = second_max(heavy & moving & is_living)
+    still_light_cnt = still_light_cnt[x, y]
+    moving_light_cnt = moving_light_cnt[x, y]
+    still_heavy_cnt = still_heavy_cnt[x, y]
+    moving_heavy_cnt = moving_heavy_cnt[x, y]
+
+    new_dead = ((light & (still_heavy_cnt + moving_heavy_cnt > 0))
+                | (light & still & (still_light_cnt > 1))
+                | (light & still & (moving_light_cnt > 0))
+                | (light & moving & (moving_light_cnt > 1) & (units.power <= moving_light_second_max))
+                | (heavy & still & (still_heavy_cnt > 1))
+                | (heavy & still & (moving_heavy_cnt > 0))
+                | (heavy & moving & (moving_heavy_cnt > 1) & (units.power <= moving_heavy_second_max)))
+    power_loss = (light & moving) * jnp.ceil(moving_light_second_max * self.env_cfg.POWER_LOSS_FACTOR).astype(units.power.dtype) \
+        + (heavy & moving) * jnp.ceil(moving_heavy_second_max * self.env_cfg.POWER_LOSS_FACTOR).astype(units.power.dtype)
+    units = units._replace(power=units.power - jnp.maximum(power_loss, 0))
+    pos_without_dead = jnp.where((already_dead | new_dead)[..., None], imax(units.pos.pos.dtype), units.pos.pos)
+    return self._replace(
+        units=units,
+        board=self.board.update_units_map(units._replace(pos=Position(pos_without_dead))),
+    ), new_dead
+
+
 class TestState(chex.TestCase):
 
     def test_from_to_lux(self):
@@ -249,6 +309,280 @@ class TestState(chex.TestCase):
 
         assert jnp.array_equal(jux_rewards, lux_rewards)
 
+    def test_to_features(self):
+        env, actions = jux.utils.load_replay('tests/replay2.0_0.json.gz')
+        while env.state.real_env_steps < 100:
+            # the replay contains actions of units that are already destroyed
+            env.step(jux.utils.live_actions(env.state, next(actions)))
+        lux_state = env.state
+        state = State.from_lux(lux_state, JuxBufferConfig(MAX_N_UNITS=100))
+
+        to_features = jax.jit(State.to_features)
+        features = to_features(state, 0)
+        map_size = lux_state.env_cfg.map_size
+        chex.assert_shape(features.spatial, (map_size, map_size, len(Features.SPATIAL_CHANNELS)))
+        chex.assert_shape(features.scalars, (len(Features.SCALAR_FEATURES), ))
+        spatial = dict(zip(Features.SPATIAL_CHANNELS, np.moveaxis(np.asarray(features.spatial), -1, 0)))
+        scalars = dict(zip(Features.SCALAR_FEATURES, np.asarray(features.scalars)))
+
+        board = lux_state.board
+        assert np.allclose(spatial['rubble'] * state.env_cfg.MAX_RUBBLE, board.rubble)
+        assert (spatial['ice'] == board.ice).all()
+        my_strains = lux_state.teams['player_0'].factory_strains
+        assert (spatial['my_lichen'] == (np.isin(board.lichen_strains, my_strains) & (board.lichen > 0))).all()
+        assert spatial['my_lichen'].sum() + spatial['opp_lichen'].sum() > 0
+        assert scalars['my_lichen_score'] == board.lichen[np.isin(board.lichen_strains, my_strains)].sum()
+
+        for player, prefix in [('player_0', 'my'), ('player_1', 'opp')]:
+            units = lux_state.units[player].values()
+            n_heavies = sum(u.unit_type.name == 'HEAVY' for u in units)
+            assert spatial[f'{prefix}_heavy'].sum() == scalars[f'{prefix}_n_heavies'] == n_heavies
+            assert spatial[f'{prefix}_light'].sum() == scalars[f'{prefix}_n_lights'] == len(units) - n_heavies
+            assert spatial[f'{prefix}_factory'].sum() == 9 * len(lux_state.factories[player])
+            for unit in units:
+                x, y = unit.pos.pos
+                assert spatial[f'{prefix}_{unit.unit_type.name.lower()}'][x, y] == 1
+                assert np.isclose(spatial['unit_power'][x, y] * unit.unit_cfg.BATTERY_CAPACITY, unit.power)
+            for factory in lux_state.factories[player].values():
+                x, y = factory.pos.pos
+                assert spatial['factory_water'][x, y] == factory.cargo.water
+                assert spatial['factory_power'][x, y] == factory.power
+
+        # features are relative to the player
+        features_1 = to_features(state, 1)
+        spatial_1 = dict(zip(Features.SPATIAL_CHANNELS, np.moveaxis(np.asarray(features_1.spatial), -1, 0)))
+        for name in ['lichen', 'light', 'heavy', 'factory']:
+            assert (spatial_1[f'my_{name}'] == spatial[f'opp_{name}']).all()
+            assert (spatial_1[f'opp_{name}'] == spatial[f'my_{name}']).all()
+
+        # batched states
+        states = jux.tree_util.batch_into_leaf([state, state])
+        batched = to_features(states, jnp.array([0, 1]))
+        assert (batched.spatial[0] == features.spatial).all()
+        assert (batched.scalars[1] == features_1.scalars).all()
+
+    def test_action_masks(self):
+        env, actions = jux.utils.load_replay('tests/replay2.0_0.json.gz')
+        while env.state.real_env_steps < 100:
+            # the replay contains actions of units that are already destroyed
+            env.step(jux.utils.live_actions(env.state, next(actions)))
+        lux_state = env.state
+        state = State.from_lux(lux_state, JuxBufferConfig(MAX_N_UNITS=100))
+        env_cfg = state.env_cfg
+
+        action_masks = jax.jit(State.action_masks)
+        masks = action_masks(state)
+        chex.assert_shape([masks.move, masks.transfer, masks.pickup], (2, 100, 5))
+        chex.assert_shape([masks.dig, masks.self_destruct, masks.recharge], (2, 100))
+        chex.assert_shape(masks.factory, (2, state.MAX_N_FACTORIES, 3))
+
+        # non-existent units and factories have no valid action
+        unit_mask = np.asarray(state.unit_mask)
+        for mask in [masks.move, masks.transfer, masks.pickup, masks.dig, masks.self_destruct, masks.recharge]:
+            assert not np.asarray(mask)[~unit_mask].any()
+        assert not np.asarray(masks.factory)[~np.asarray(state.factory_mask)].any()
+        assert (masks.move[..., Direction.CENTER] == unit_mask).all()
+
+        for player in ['player_0', 'player_1']:
+            team_id = lux_state.teams[player].team_id
+            for unit in lux_state.units[player].values():
+                idx = int(state.unit_id2idx(int(unit.unit_id[len('unit_'):]))[1])
+                x, y = unit.pos.pos
+                on_factory = lux_state.board.factory_occupancy_map[x, y] != -1
+                assert masks.dig[team_id, idx] == (not on_factory and unit.power >= unit.unit_cfg.DIG_COST)
+                assert masks.self_destruct[team_id, idx] == (unit.power >= unit.unit_cfg.SELF_DESTRUCT_COST)
+                assert masks.pickup[team_id, idx].any() <= on_factory
+            for factory in lux_state.factories[player].values():
+                idx = int(state.factory_id2idx[int(factory.unit_id[len('factory_'):]), 1])
+                for unit_type in [UnitType.LIGHT, UnitType.HEAVY]:
+                    unit_cfg = env_cfg.ROBOTS[unit_type]
+                    assert masks.factory[team_id, idx, unit_type] == (factory.power >= unit_cfg.POWER_COST
+                                                                      and factory.cargo.metal >= unit_cfg.METAL_COST)
+                assert masks.factory[team_id, idx, FactoryAction.WATER] == \
+                    (factory.cargo.water >= factory.water_cost(lux_state.env_cfg))
+
+        # batched states
+        batched = action_masks(jux.tree_util.batch_into_leaf([state, state]))
+        for mask, batched_mask in zip(masks, batched):
+            assert (batched_mask[1] == mask).all()
+
+    def test_unit_id2idx(self):
+        env, actions = jux.utils.load_replay('tests/replay2.0_0.json.gz')
+        while env.env_steps < 30:
+            env.step(next(actions))
+        state = State.from_lux(env.state, JuxBufferConfig(MAX_N_UNITS=100))
+        state.check_id2idx()
+
+        unit_id2idx = jax.jit(State.unit_id2idx)
+        for player, units in env.state.units.items():
+            team_id = env.state.teams[player].team_id
+            for unit_id in units:
+                unit_id = int(unit_id[len('unit_'):])
+                team, idx = unit_id2idx(state, unit_id)
+                assert team == team_id
+                assert state.units.unit_id[team, idx] == unit_id
+
+        # non-existent units, including ids of factories and empty cells in units_map
+        missing = jnp.array([int(state.factories.unit_id[0, 0]), imax(state.units.unit_id.dtype), 10000])
+        assert (unit_id2idx(state, missing) == imax(state.units.unit_id.dtype)).all()
+
+        # batched states
+        states = jux.tree_util.batch_into_leaf([state, state])
+        unit_ids = jnp.stack([state.units.unit_id[0], state.units.unit_id[1]])  # int[B, U]
+        id2idx = unit_id2idx(states, unit_ids)
+        chex.assert_shape(id2idx, (2, state.MAX_N_UNITS, 2))
+        n_units = state.n_units
+        assert (id2idx[1, :n_units[1], 0] == 1).all()
+        assert (id2idx[1, :n_units[1], 1] == jnp.arange(n_units[1])).all()
+        assert (id2idx[0, n_units[0]:] == imax(state.units.unit_id.dtype)).all()
+
+    def test_destroy_unit(self):
+        env, actions = jux.utils.load_replay('tests/replay2.0_0.json.gz')
+        while env.env_steps < 30:
+            env.step(next(actions))
+        state = State.from_lux(env.state, JuxBufferConfig(MAX_N_UNITS=100))
+        destroy_unit = jax.jit(lambda state, dead: State.destroy_unit(state, dead)[0])
+
+        # nothing is dead
+        assert destroy_unit(state, jnp.zeros_like(state.unit_mask)) == state
+
+        # live units keep their order
+        dead = state.unit_mask & (state.unit_idx % 2 == 0)
+        new_state = destroy_unit(state, dead)
+        new_state.check_id2idx()
+        for team in range(2):
+            alive = np.asarray(state.unit_mask[team] & ~dead[team])
+            n_units = int(new_state.n_units[team])
+            assert n_units == alive.sum()
+            assert (new_state.units.unit_id[team, :n_units] == state.units.unit_id[team][alive]).all()
+            assert (new_state.units.unit_id[team, n_units:] == imax(new_state.units.unit_id.dtype)).all()
+            chex.assert_trees_all_equal(
+                jax.tree_map(lambda x: x[team, :n_units], new_state.units),
+                jax.tree_map(lambda x: x[team][alive], state.units),
+            )
+
+    def test_handle_movement_actions(self):
+        env, actions = jux.utils.load_replay('tests/replay2.0_0.json.gz')
+        while env.env_steps < 30:
+            env.step(next(actions))
+        state = State.from_lux(env.state, JuxBufferConfig(MAX_N_UNITS=100))
+        handle = jax.jit(State._handle_movement_actions)
+        handle_by_map = jax.jit(handle_movement_actions_by_map)
+
+        rng = np.random.default_rng(0)
+        U = state.MAX_N_UNITS
+        for _ in range(20):
+            # crowd units into a few cells, with ties in power, so that all death cases happen
+            n_units = rng.integers(0, U, size=2)
+            units = state.units._replace(
+                unit_id=jnp.arange(2 * U, dtype=state.units.unit_id.dtype).reshape(2, U),
+                unit_type=jnp.asarray(rng.integers(0, 2, size=(2, U)), dtype=state.units.unit_type.dtype),
+                pos=Position(jnp.asarray(rng.integers(1, 4, size=(2, U, 2)), dtype=state.units.pos.pos.dtype)),
+                power=jnp.asarray(rng.integers(0, 5, size=(2, U)) * 10, dtype=state.units.power.dtype),
+            )
+            s = state._replace(units=units, n_units=jnp.asarray(n_units, dtype=state.n_units.dtype))
+            unit_action = jax.tree_map(lambda x: x[..., 0], JuxAction.empty(s.env_cfg, JuxBufferConfig(MAX_N_UNITS=100)).unit_action_queue)
+            unit_action = unit_action._replace(direction=jnp.asarray(rng.integers(0, 5, size=(2, U)), dtype=jnp.int8))
+            movement_info = dict(
+                valid=jnp.asarray(rng.random((2, U)) < 0.7) & s.unit_mask,
+                power_cost=jnp.asarray(rng.integers(0, 3, size=(2, U)), dtype=s.units.power.dtype),
+            )
+            already_dead = jnp.asarray(rng.random((2, U)) < 0.1) & s.unit_mask
+
+            new_state, dead = handle(s, unit_action, movement_info, already_dead)
+            expected_state, expected_dead = handle_by_map(s, unit_action, movement_info, already_dead)
+            assert (dead == expected_dead).all()
+            assert (new_state.units.power == expected_state.units.power).all()
+            assert new_state == expected_state
+
+    def test_resize_units(self):
+        env, actions = jux.utils.load_replay('tests/replay2.0_0.json.gz')
+        while env.env_steps < 30:
+            env.step(next(actions))
+        state = State.from_lux(env.state, JuxBufferConfig(MAX_N_UNITS=100))
+        n_units = int(state.n_units.max())
+
+        bigger = state.resize_units(150)
+        chex.assert_shape(bigger.units.unit_id, (2, 150))
+        chex.assert_shape(bigger.units.action_queue.data.action_type, (2, 150, state.UNIT_ACTION_QUEUE_SIZE))
+        assert (bigger.units.unit_id[:, 100:] == state.units.unit_id[0, -1]).all()
+        assert bigger.resize_units(100) == state
+
+        smaller = jax.jit(State.resize_units, static_argnums=(1, ))(state, n_units)
+        chex.assert_shape(smaller.units.unit_id, (2, n_units))
+        smaller.check_id2idx()
+        assert smaller.resize_units(100) == state
+
+        # batched states
+        batched = jux.tree_util.batch_into_leaf([state, state]).resize_units(n_units)
+        chex.assert_trees_all_equal(jax.tree_map(lambda x: x[1], batched), smaller)
+
+    def test_compact_dtypes(self):
+        env, actions = jux.utils.load_replay('tests/replay2.0_0.json.gz')
+        while env.state.real_env_steps < 0:
+            env.step(next(actions))
+        buf_cfg = JuxBufferConfig(MAX_N_UNITS=100)
+        state = State.from_lux(env.state, buf_cfg)
+        compact_state = State.from_lux(env.state, buf_cfg._replace(COMPACT_DTYPES=True))
+        assert not state.has_compact_dtypes
+        assert compact_state.has_compact_dtypes
+        assert compact_state.board.lichen.dtype == jnp.int8
+        assert compact_state.units.power.dtype == jnp.int16
+        assert compact_state.units.cargo.stock.dtype == jnp.int16
+        assert compact_state.factories.power.dtype == state.factories.power.dtype
+        chex.assert_trees_all_equal(compact_state.default_dtypes(), state)
+
+        # steps keep the layout, and give the same states
+        step_late_game = jax.jit(State._step_late_game)
+        for _ in range(40):
+            lux_act = jux.utils.live_actions(env.state, next(actions))
+            jux_act = JuxAction.from_lux(state, lux_act)
+            state = step_late_game(state, jux_act)
+            compact_state = step_late_game(compact_state, jux_act)
+            env.step(lux_act)
+        assert compact_state.has_compact_dtypes
+        assert compact_state.board.lichen.any()
+        chex.assert_trees_all_equal(compact_state.default_dtypes(), state)
+        assert (compact_state.team_lichen_score() == state.team_lichen_score()).all()
+        chex.assert_trees_all_equal(compact_state.to_features(0), state.to_features(0))
+        assert State.from_lux(compact_state.to_lux(), buf_cfg) == state
+
+        # out of range values are not narrowed
+        with pytest.raises(OverflowError):
+            state._replace(board=state.board._replace(lichen=state.board.lichen.at[0, 0].set(1000))).compact_dtypes()
+
+    def test_pack_action_queues(self):
+        env, actions = jux.utils.load_replay('tests/replay2.0_0.json.gz')
+        while env.state.real_env_steps < 0:
+            env.step(next(actions))
+        buf_cfg = JuxBufferConfig(MAX_N_UNITS=100)
+        state = State.from_lux(env.state, buf_cfg)
+        packed_state = State.from_lux(env.state, buf_cfg._replace(PACKED_ACTION_QUEUE=True))
+        assert packed_state.units.action_queue.is_packed
+        chex.assert_trees_all_equal(packed_state.unpack_action_queues(), state)
+
+        # steps keep the layout, and give the same states, with actions packed or not
+        step_late_game = jax.jit(State._step_late_game)
+        for i in range(60):
+            lux_act = jux.utils.live_actions(env.state, next(actions))
+            jux_act = JuxAction.from_lux(state, lux_act)
+            state = step_late_game(state, jux_act)
+            if i % 2:
+                jux_act = jux_act._replace(unit_action_queue=jux_act.unit_action_queue.pack())
+            packed_state = step_late_game(packed_state, jux_act)
+            env.step(lux_act)
+        assert packed_state.units.action_queue.is_packed
+        # queue slots beyond the count are not compared, where `JuxAction.from_lux()` leaves garbage
+        assert packed_state == state
+        assert State.from_lux(packed_state.to_lux(), buf_cfg) == state
+
+        # buffers are padded with packed empty units
+        bigger = packed_state.resize_units(150)
+        assert bigger.units.action_queue.is_packed
+        assert bigger == state.resize_units(150)
+        assert (bigger.units.action_queue.data.lo[:, 100:] == 0).all()
+        assert (bigger.units.action_queue.data.hi[:, 100:] == 0).all()
+
 
 class TestEarlyStageState(chex.TestCase):
 
@@ -1,17 +1,20 @@
 from typing import List
 
 import chex
+import jax
+import jax.numpy as jnp
 import numpy as np
 import pytest
 from luxai_s2 import actions as lux_actions
 from luxai_s2.actions import Action as LuxAction
 
 import jux.utils
-from jux.actions import ActionQueue, FactoryAction, JuxAction, UnitAction
+from jux.actions import ActionQueue, FactoryAction, JuxAction, PackedUnitAction, UnitAction
 from jux.config import EnvConfig, JuxBufferConfig
 from jux.map.position import Direction
 from jux.state import State
 from jux.unit_cargo import ResourceType
+from tests.test_unit import random_units
 
 
 class TestActions:
@@ -37,6 +40,24 @@ class TestActions:
         for act in actions:
             assert act == UnitAction.from_lux(act.to_lux())
 
+    def test_pack_unit_actions(self):
+        rng = np.random.default_rng(0)
+        shape = (2, 100, 20)
+        actions = UnitAction(
+            action_type=rng.integers(-1, 6, size=shape).astype(np.int8),
+            direction=rng.integers(0, 5, size=shape).astype(np.int8),
+            resource_type=rng.integers(0, 5, size=shape).astype(np.int8),
+            amount=rng.integers(0, 2**15, size=shape).astype(np.int16),
+            repeat=rng.integers(0, 2**15, size=shape).astype(np.int16),
+            n=rng.integers(0, 2**15, size=shape).astype(np.int16),
+        )
+        packed = jax.jit(UnitAction.pack)(actions)
+        assert isinstance(packed, PackedUnitAction)
+        chex.assert_shape(packed, shape)
+        chex.assert_trees_all_equal(jax.jit(PackedUnitAction.unpack)(packed), actions)
+        assert UnitAction.do_nothing().pack() == PackedUnitAction()
+        assert (packed.is_valid(3000) == actions.is_valid(3000)).all()
+
 
 def lux_queue_eq(a: List[LuxAction], b: List[LuxAction]) -> bool:
     return len(a) == len(b) and all([np.array_equal(i.state_dict(), j.state_dict()) for i, j in zip(a, b)])
@@ -70,6 +91,48 @@ class TestActionQueue(chex.TestCase):
         assert jux_queue == ActionQueue.from_lux(lux_queue, env_cfg.UNIT_ACTION_QUEUE_SIZE)
         assert lux_queue_eq(jux_queue.to_lux(), lux_queue)
 
+    @chex.variants(with_jit=True, without_jit=True)
+    def test_packed_push_pop(self):
+        env_cfg = EnvConfig()
+        lux_queue = [
+            lux_actions.MoveAction(1, 1, False),
+            lux_actions.DigAction(True),
+            lux_actions.SelfDestructAction(False),
+        ]
+        queue = ActionQueue.from_lux(lux_queue, env_cfg.UNIT_ACTION_QUEUE_SIZE)
+        packed = queue.pack()
+        assert packed.is_packed and not queue.is_packed
+        assert packed == queue
+
+        push_back = self.variant(ActionQueue.push_back)
+        push_front = self.variant(ActionQueue.push_front)
+        pop = self.variant(ActionQueue.pop)
+        action, packed = pop(packed)
+        assert action == UnitAction.from_lux(lux_queue[0])
+        packed = push_back(packed, action)
+        packed = push_front(packed, UnitAction.recharge(10))
+        assert packed.is_packed
+        assert lux_queue_eq(packed.to_lux(), [lux_actions.RechargeAction(10)] + lux_queue[1:] + lux_queue[:1])
+        assert packed.unpack() == packed
+
+    def test_batched_push_pop(self):
+        env_cfg = EnvConfig()
+        queues = random_units(env_cfg, (2, 50)).action_queue
+        action = UnitAction.dig(repeat=1, n=2)
+
+        # batched queues give the same result as queues one by one
+        for method in (ActionQueue.pop, lambda q: q.push_back(action), lambda q: q.push_front(action)):
+            chex.assert_trees_all_equal(jax.jit(method)(queues), jax.vmap(jax.vmap(method))(queues))
+
+        full = queues.count == queues.capacity
+        assert full.any()
+        pushed = queues.push_back(action)
+        assert (pushed.count == jnp.where(full, queues.count, queues.count + 1)).all()
+        popped_action, popped = queues.pop()
+        empty = queues.count == 0
+        assert (popped.count == jnp.where(empty, 0, queues.count - 1)).all()
+        assert (popped_action.action_type[empty] == UnitAction().action_type).all()
+
 
 class TestJuxAction():
 
@@ -100,3 +163,59 @@ class TestJuxAction():
             torch_act.unit_action_queue_update,
         )
         chex.assert_trees_all_equal(jux_from_torch, jux_act)
+
+    def test_from_spatial(self):
+        env, actions = jux.utils.load_replay("tests/replay2.0_0.json.gz")
+        while env.env_steps < 30:
+            act = next(actions)
+            env.step(act)
+        lux_act = next(actions)
+
+        buf_cfg = JuxBufferConfig(MAX_N_UNITS=200)
+        jux_state = State.from_lux(env.state, buf_cfg)
+        jux_act = JuxAction.from_lux(jux_state, lux_act)
+
+        # lay out the lux actions per map cell
+        map_size = env.state.env_cfg.map_size
+        queue_size = jux_state.env_cfg.UNIT_ACTION_QUEUE_SIZE
+        unit_action = [np.zeros((2, map_size, map_size, queue_size), dtype=np.int16) for _ in UnitAction._fields]
+        unit_action[0][:] = UnitAction.do_nothing().action_type
+        count = np.zeros((2, map_size, map_size), dtype=np.int8)
+        update = np.zeros((2, map_size, map_size), dtype=np.bool_)
+        factory_action = np.full((2, map_size, map_size), FactoryAction.DO_NOTHING, dtype=np.int8)
+        for player, player_act in lux_act.items():
+            p = int(player.split('_')[-1])
+            for unit_id, act in player_act.items():
+                if unit_id.startswith('factory_'):
+                    x, y = env.state.factories[player][unit_id].pos.pos
+                    factory_action[p, x, y] = act
+                else:
+                    x, y = env.state.units[player][unit_id].pos.pos
+                    act = np.array(act)
+                    for i in range(len(UnitAction._fields)):
+                        unit_action[i][p, x, y, :len(act)] = act[:, i]
+                    count[p, x, y] = len(act)
+                    update[p, x, y] = True
+        unit_action = UnitAction(*unit_action)
+
+        from_spatial = jax.jit(JuxAction.from_spatial)
+        decoded = from_spatial(jux_state, unit_action, factory_action, count, update)
+        assert decoded.to_lux(jux_state) == lux_act
+        chex.assert_trees_all_equal(decoded.factory_action, jux_act.factory_action)
+        chex.assert_trees_all_equal(decoded.unit_action_queue_count, jux_act.unit_action_queue_count)
+        chex.assert_trees_all_equal(decoded.unit_action_queue_update, jux_act.unit_action_queue_update)
+
+        # single action per unit, and batched states
+        single_action = jax.tree_map(lambda x: x[..., 0], unit_action)
+        batch = jax.tree_map(lambda x: x[None].repeat(3, axis=0), (jux_state, single_action, factory_action))
+        decoded = from_spatial(*batch)
+        chex.assert_shape(decoded.unit_action_queue.action_type, (3, 2, buf_cfg.MAX_N_UNITS, queue_size))
+        unit_mask = np.asarray(jux_state.unit_mask)
+        assert (decoded.unit_action_queue_update[0] == unit_mask).all()
+        assert (decoded.unit_action_queue_count[0] == unit_mask).all()
+        assert (decoded.unit_action_queue.action_type[0, ..., 1:] == UnitAction.do_nothing().action_type).all()
+        has_act = np.asarray(jux_act.unit_action_queue_update)
+        chex.assert_trees_all_equal(
+            jax.tree_map(lambda x: x[0, ..., 0][has_act], decoded.unit_action_queue),
+            jax.tree_map(lambda x: x[..., 0][has_act], jux_act.unit_action_queue),
+        )
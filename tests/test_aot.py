@@ -0,0 +1,83 @@
+import os
+import stat
+
+import jax
+import jax.numpy as jnp
+import pytest
+
+import jux.aot
+import jux.tree_util
+from jux.actions import JuxAction
+from jux.config import JuxBufferConfig
+from jux.env import JuxEnvBatch
+
+
+def test_cache_key():
+    env_batch = JuxEnvBatch(buf_cfg=JuxBufferConfig(MAX_N_UNITS=50))
+    key = jux.aot.cache_key(env_batch, 2, 'step_late_game')
+    assert key == jux.aot.cache_key(JuxEnvBatch(buf_cfg=JuxBufferConfig(MAX_N_UNITS=50)), 2, 'step_late_game')
+    assert key != jux.aot.cache_key(env_batch, 4, 'step_late_game')
+    assert key != jux.aot.cache_key(env_batch, 2, 'step_bid')
+    assert key != jux.aot.cache_key(JuxEnvBatch(buf_cfg=JuxBufferConfig(MAX_N_UNITS=100)), 2, 'step_late_game')
+    assert key != jux.aot.cache_key(JuxEnvBatch(buf_cfg=JuxBufferConfig(MAX_N_UNITS=50), donate_state=True), 2,
+                                    'step_late_game')
+
+
+def test_precompile(tmp_path):
+    env_batch = JuxEnvBatch(buf_cfg=JuxBufferConfig(MAX_N_UNITS=50))
+    compiled = env_batch.precompile(batch_size=2, cache_dir=str(tmp_path))
+
+    seeds = jnp.arange(2, dtype=jnp.int32)
+    actions = JuxAction.empty(env_batch.env_cfg, env_batch.buf_cfg)
+    actions = jux.tree_util.batch_into_leaf([actions, actions])
+
+    states = compiled.reset_to_late_game(seeds)
+    states, (_, rewards, dones, _) = compiled.step_late_game(states, actions)
+    expected, (_, expected_rewards, expected_dones, _) = env_batch.step_late_game(
+        env_batch.reset_to_late_game(seeds),
+        actions,
+    )
+    assert jax.vmap(lambda a, b: a == b)(states, expected).all()
+    assert (rewards == expected_rewards).all()
+    assert (dones == expected_dones).all()
+
+    if not os.listdir(tmp_path):
+        pytest.skip(f"executable serialization is not supported on {jax.default_backend()}")
+
+    # a second call loads executables from the cache
+    cached = env_batch.precompile(batch_size=2, cache_dir=str(tmp_path))
+    states, (_, rewards, _, _) = cached.step_late_game(cached.reset_to_late_game(seeds), actions)
+    assert jax.vmap(lambda a, b: a == b)(states, expected).all()
+    assert (rewards == expected_rewards).all()
+
+
+def test_precompile_cache(tmp_path, monkeypatch):
+    # Not every backend can serialize executables, so serialization is mocked to run the cache on any backend.
+    executables = {}
+
+    def serialize(compiled):
+        payload = f"executable-{len(executables)}".encode()
+        executables[payload] = compiled
+        return payload, None, None
+
+    monkeypatch.setattr(jux.aot.serialize_executable, 'serialize', serialize)
+    monkeypatch.setattr(jux.aot.serialize_executable, 'deserialize_and_load', lambda payload, *_: executables[payload])
+
+    buf_cfg = JuxBufferConfig(MAX_N_UNITS=50)
+    compiled = JuxEnvBatch(buf_cfg=buf_cfg).precompile(batch_size=2, cache_dir=str(tmp_path))
+    files = sorted(os.listdir(tmp_path))
+    assert len(files) == len(compiled)
+    assert all(stat.S_IMODE(os.stat(tmp_path / f).st_mode) == 0o600 for f in files)
+
+    # a new process loads all executables from the cache, and compiles nothing
+    def _lower(env_batch, name, args):
+        raise AssertionError(f"{name} is compiled instead of loaded from the cache")
+
+    monkeypatch.setattr(jux.aot, '_lower', _lower)
+    cached = JuxEnvBatch(buf_cfg=buf_cfg).precompile(batch_size=2, cache_dir=str(tmp_path))
+    assert cached == compiled
+
+    # files writable by other users are not loaded
+    os.chmod(tmp_path / next(f for f in files if f.startswith('step_late_game-')), 0o666)
+    with pytest.warns(UserWarning, match='writable by others'), pytest.raises(AssertionError, match='step_late_game'):
+        JuxEnvBatch(buf_cfg=buf_cfg).precompile(batch_size=2, cache_dir=str(tmp_path))
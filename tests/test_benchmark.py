@@ -0,0 +1,40 @@
+import json
+
+import jax
+import jax.numpy as jnp
+
+import jux.benchmark
+from jux.actions import UnitActionType
+from jux.config import JuxBufferConfig
+from jux.env import JuxEnvBatch
+
+
+def test_random_policy():
+    env_batch = JuxEnvBatch(buf_cfg=JuxBufferConfig(MAX_N_UNITS=50))
+    states = env_batch.reset_to_late_game(jnp.arange(2))
+    key = jax.random.PRNGKey(0)
+    for key in jax.random.split(key, 20):
+        actions = jux.benchmark.random_policy(jux.benchmark.REPLAY_ACTION_DISTRIBUTION, states, key)
+        queue = actions.unit_action_queue
+        update = actions.unit_action_queue_update
+        assert (update <= states.unit_mask).all()
+        assert (actions.unit_action_queue_count <= update).all()
+        has_action = actions.unit_action_queue_count > 0
+        assert (queue.is_valid(states.env_cfg.max_transfer_amount)[..., 0] | ~has_action).all()
+        assert (queue.action_type[..., 1:] == UnitActionType.DO_NOTHING).all()
+        states, _ = env_batch.step_late_game(states, actions)
+    assert (states.n_units > 0).any()
+
+
+def test_run(capsys):
+    rows = []
+    report = jux.benchmark.run([2], [20], [32], warmup=3, repeat=2, callback=rows.append)
+    assert capsys.readouterr().out == ''
+    assert rows == report['results']
+    report = json.loads(json.dumps(report))
+    assert report['lux_steps_per_second'] is None
+    result, = report['results']
+    assert (result['batch_size'], result['max_n_units'], result['map_size']) == (2, 20, 32)
+    assert result['compile_time'] > 0 and result['steps_per_second'] > 0
+    assert result['steps_per_second'] == result['batch_size'] / result['step_time']
+    assert report['environment']['backend'] == jax.default_backend()
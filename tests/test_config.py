@@ -1,3 +1,6 @@
+import jax
+import jax.numpy as jnp
+
 import jux.config
 from jux.config import EnvConfig, LuxEnvConfig, LuxUnitConfig, UnitConfig
 
@@ -28,3 +31,14 @@ class TestEnvConfig:
     def test_default(self):
         assert LuxEnvConfig() == EnvConfig().to_lux()
         assert EnvConfig() == EnvConfig.from_lux(LuxEnvConfig())
+
+    def test_static_pytree(self):
+        env_cfg = EnvConfig(max_episode_length=10)
+        assert jax.tree_util.tree_leaves(env_cfg) == []
+        assert jax.tree_util.tree_leaves(env_cfg.ROBOTS) == []
+
+        # config stays static under vmap and jit
+        batched = jax.vmap(lambda x: (env_cfg, x))(jnp.arange(3))[0]
+        assert batched == env_cfg
+        assert jax.jit(lambda cfg: jnp.int32(cfg.max_episode_length))(env_cfg) == 10
+        assert batched.to_lux() == env_cfg.to_lux()
@@ -0,0 +1,65 @@
+import json
+
+import jax
+import numpy as np
+
+import jux.dataset
+import jux.utils
+from jux.config import JuxBufferConfig
+from jux.state import JuxAction, State
+
+REPLAYS = ['tests/replay2.0_0.json.gz', 'tests/replay2.0_1.json.gz']
+
+
+def test_build_dataset(tmp_path):
+    buf_cfg = JuxBufferConfig(MAX_N_UNITS=100)
+    local_index = jux.dataset.build_dataset(
+        REPLAYS + ['tests/missing.json'],
+        str(tmp_path / 'local'),
+        buf_cfg,
+        features=True,
+        shard_size=40,
+        n_workers=0,
+        max_steps=30,
+    )
+    assert local_index == json.loads((tmp_path / 'local' / jux.dataset.INDEX_FILE).read_text())
+    assert [shard['replays'] for shard in local_index['shards']] == [REPLAYS[:1], REPLAYS[1:]]
+    assert list(local_index['failed']) == ['tests/missing.json']
+
+    shard = jux.dataset.load_shard(str(tmp_path / 'local' / local_index['shards'][0]['path']))
+    assert isinstance(shard.rewards, np.memmap)
+    assert (shard.step == np.arange(30)).all() and (shard.episode == 0).all()
+    assert shard.actions.unit_action_queue.action_type.shape == (30, 2, 100, 20)
+    assert shard.features.spatial.shape[:2] == (30, 2)
+
+    # transitions agree with luxai_s2
+    lux_env, lux_actions = jux.utils.load_replay(REPLAYS[0])
+    while lux_env.state.real_env_steps < 0:
+        lux_env.step(next(lux_actions))
+    for t in range(5):
+        state = State.from_lux(lux_env.state, buf_cfg)
+        lux_act = jux.utils.live_actions(state, next(lux_actions))
+        expected = JuxAction.from_lux(state, lux_act)
+        actions = jax.tree_map(lambda x: x[t], shard.actions)
+        assert (actions.factory_action == expected.factory_action).all()
+        assert (actions.unit_action_queue_count == expected.unit_action_queue_count).all()
+        assert (actions.unit_action_queue_update == expected.unit_action_queue_update).all()
+        in_queue = np.arange(20) < expected.unit_action_queue_count[..., None]
+        for leaf, expected_leaf in zip(actions.unit_action_queue, expected.unit_action_queue):
+            assert (leaf == expected_leaf)[in_queue].all()
+        assert np.allclose(shard.features.spatial[t], np.stack([state.to_features(p).spatial for p in range(2)]))
+        _, rewards, dones, _, _ = lux_env.step(lux_act)
+        assert (shard.rewards[t] == [rewards['player_0'], rewards['player_1']]).all()
+        assert (shard.dones[t] == [dones['player_0'], dones['player_1']]).all()
+
+    # a process pool gives the same transitions
+    index = jux.dataset.build_dataset(REPLAYS, str(tmp_path / 'pool'), buf_cfg, n_workers=2, max_steps=30)
+    pooled = jux.dataset.load_shard(str(tmp_path / 'pool' / index['shards'][0]['path']), mmap_mode=None)
+    assert pooled.features is None
+    local = [
+        jux.dataset.load_shard(str(tmp_path / 'local' / s['path']), mmap_mode=None) for s in local_index['shards']
+    ]
+    assert (pooled.episode == np.repeat([0, 1], 30)).all()
+    for leaf, *local_leaves in zip(jax.tree_util.tree_leaves(pooled.actions),
+                                   *(jax.tree_util.tree_leaves(shard.actions) for shard in local)):
+        assert (leaf == np.concatenate(local_leaves)).all()
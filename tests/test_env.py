@@ -1,3 +1,8 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
 import chex
 import jax
 import jax.numpy as jnp
@@ -11,7 +16,7 @@ import jux.tree_util
 import jux.utils
 from jux.actions import JuxAction
 from jux.config import JuxBufferConfig
-from jux.env import JuxEnv, JuxEnvBatch
+from jux.env import JuxEnv, JuxEnvBatch, JuxEnvBucketed, JuxEnvSharded
 from jux.state import State
 
 state___eq___jitted = jax.jit(chex.assert_max_traces(n=1)(State.__eq__))
@@ -132,6 +137,38 @@ class TestJuxEnv:
 
                 assert jux_infos == lux_infos
 
+    def test_reset_to_late_game(self):
+        chex.clear_trace_counter()
+        env = JuxEnv(buf_cfg=JuxBufferConfig(MAX_N_UNITS=100))
+        state = env.reset_to_late_game(0)
+        assert state.real_env_steps == 0
+        assert (state.teams.factories_to_place == 0).all()
+        assert (state.n_factories == state.board.factories_per_team).all()
+
+        # deterministic given the seed
+        assert state___eq___jitted(state, env.reset_to_late_game(0))
+
+    def test_step_late_game_lose_all_factories(self):
+        env = JuxEnv(buf_cfg=JuxBufferConfig(MAX_N_UNITS=100))
+        state = env.reset_to_late_game(0)
+
+        # player_0 loses all factories, but still has lichen on the board
+        strain = state.teams.factory_strains[0, 0]
+        state = state._replace(
+            n_factories=state.n_factories.at[0].set(0),
+            board=state.board._replace(
+                lichen=state.board.lichen.at[0, 0].set(100),
+                lichen_strains=state.board.lichen_strains.at[0, 0].set(strain),
+            ),
+        )
+        state, (_, rewards, dones, _) = env.step_late_game(state, JuxAction.empty(env.env_cfg, env.buf_cfg))
+
+        # as in luxai_s2, the reward is a flat -1000 instead of lichen minus 1000
+        assert state.team_lichen_score()[0] > 0
+        assert rewards[0] == -1000
+        assert rewards[1] == state.team_lichen_score()[1]
+        assert dones.all()
+
 
 class TestJuxEnvBatch:
 
@@ -248,3 +285,257 @@ class TestJuxEnvBatch:
 
             states, _ = env_batch.step_late_game(states, jux.tree_util.batch_into_leaf(jux_act_batch))
             assert state___eq___vmap_jitted(states, jux.tree_util.batch_into_leaf(state_list)).all()
+
+    def test_skip_unused_actions(self):
+        chex.clear_trace_counter()
+        lux_env_list = []
+        lux_actions_list = []
+        for episode in ['tests/replay2.0_0.json.gz', 'tests/replay2.0_1.json.gz']:
+            env, act = jux.utils.load_replay(episode)
+            while env.state.real_env_steps < 0:
+                env.step(next(act))
+            lux_env_list.append(env)
+            lux_actions_list.append(act)
+        state_list = [State.from_lux(env.state) for env in lux_env_list]
+
+        def next_lux_action(lux_env, lux_actions):
+            # replays contain actions of dead units, which are dropped
+            lux_act = jux.utils.live_actions(lux_env.state, next(lux_actions))
+            lux_env.step(lux_act)
+            return lux_act
+
+        env_batch = JuxEnvBatch()
+        skip_env_batch = JuxEnvBatch(skip_unused_actions=True)
+        assert skip_env_batch != env_batch
+        # the unbatched env of a JuxEnvBatch does not reduce the skip decision over a batch
+        skip_jux_env = skip_env_batch.jux_env
+        states = jux.tree_util.batch_into_leaf(state_list)
+        skip_states = states
+
+        for _ in range(50):
+            jux_act_list = [
+                JuxAction.from_lux(state, next_lux_action(lux_env, lux_actions))
+                for lux_env, lux_actions, state in zip(lux_env_list, lux_actions_list, state_list)
+            ]
+            state_list = [skip_jux_env.step_late_game(s, a)[0] for s, a in zip(state_list, jux_act_list)]
+            jux_act_batch = jux.tree_util.batch_into_leaf(jux_act_list)
+            states, _ = env_batch.step_late_game(states, jux_act_batch)
+            skip_states, _ = skip_env_batch.step_late_game(skip_states, jux_act_batch)
+            assert state___eq___vmap_jitted(skip_states, states).all()
+            assert state___eq___vmap_jitted(jux.tree_util.batch_into_leaf(state_list), states).all()
+
+    def test_step_late_game_auto_reset(self):
+        chex.clear_trace_counter()
+        env_batch = JuxEnvBatch(buf_cfg=JuxBufferConfig(MAX_N_UNITS=100))
+        states = env_batch.reset_to_late_game(jnp.arange(2))
+        assert (states.real_env_steps == 0).all()
+
+        # move env 0 to the last step of the episode
+        env_steps = states.env_steps.at[0].add(env_batch.env_cfg.max_episode_length - 1)
+        states = states._replace(env_steps=env_steps)
+        actions = JuxAction.empty(env_batch.env_cfg, env_batch.buf_cfg)
+        actions = jux.tree_util.batch_into_leaf([actions, actions])
+
+        new_states, (observations, rewards, dones, infos) = env_batch.step_late_game_auto_reset(states, actions)
+        assert (dones == jnp.array([[True, True], [False, False]])).all()
+        assert (observations['player_0'].real_env_steps == jnp.array([env_batch.env_cfg.max_episode_length, 1])).all()
+        assert (new_states.real_env_steps == jnp.array([0, 1])).all()
+        assert (new_states.seed[0] != states.seed[0])
+        assert (new_states.teams.factories_to_place == 0).all()
+
+        # env 1 is stepped as usual
+        expected, _ = env_batch.step_late_game(states, actions)
+        expected = jax.tree_util.tree_map(lambda x: x[1], expected)
+        assert state___eq___jitted(jax.tree_util.tree_map(lambda x: x[1], new_states), expected)
+
+    def test_rollout(self):
+        chex.clear_trace_counter()
+        env_batch = JuxEnvBatch(buf_cfg=JuxBufferConfig(MAX_N_UNITS=100))
+        states = env_batch.reset_to_late_game(jnp.arange(2))
+        empty_action = JuxAction.empty(env_batch.env_cfg, env_batch.buf_cfg)
+
+        def policy_fn(params, states):
+            factory_action = jnp.full_like(empty_action.factory_action, params)
+            return jux.tree_util.batch_into_leaf([empty_action._replace(factory_action=factory_action)] * 2)
+
+        def feature_fn(states):
+            return states.board.lichen.sum(axis=(-1, -2))
+
+        # build heavy robots for 3 steps
+        final_states, traj = env_batch.rollout(states, policy_fn, 1, 3, feature_fn=feature_fn)
+        chex.assert_shape(traj.rewards, (3, 2, 2))
+        chex.assert_shape(traj.dones, (3, 2, 2))
+        chex.assert_shape(traj.features, (3, 2))
+        chex.assert_shape(traj.actions.factory_action, (3, 2, 2, env_batch.buf_cfg.MAX_N_FACTORIES))
+
+        expected = states
+        for t in range(3):
+            actions = policy_fn(1, expected)
+            expected, (_, rewards, dones, _) = env_batch.step_late_game(expected, actions)
+            assert (traj.rewards[t] == rewards).all()
+            assert (traj.dones[t] == dones).all()
+        assert state___eq___vmap_jitted(final_states, expected).all()
+        assert (final_states.n_units > 0).all()
+
+    def test_donate_state(self):
+        chex.clear_trace_counter()
+        env_batch = JuxEnvBatch(buf_cfg=JuxBufferConfig(MAX_N_UNITS=100), donate_state=True)
+        assert env_batch != JuxEnvBatch(buf_cfg=JuxBufferConfig(MAX_N_UNITS=100))
+        states = env_batch.reset_to_late_game(jnp.arange(2))
+        actions = JuxAction.empty(env_batch.env_cfg, env_batch.buf_cfg)
+        actions = jux.tree_util.batch_into_leaf([actions, actions])
+
+        leaves = jax.tree_util.tree_leaves(states)
+        state_bytes = sum(leaf.nbytes for leaf in leaves)
+        input_buffers = {leaf.unsafe_buffer_pointer() for leaf in leaves}
+        new_states, _ = env_batch.step_late_game(states, actions)
+
+        # the old state is invalidated
+        assert all(leaf.is_deleted() for leaf in jax.tree_util.tree_leaves(states.units))
+        with pytest.raises(RuntimeError):
+            states.units.power + 1
+
+        # most of the new state is written in place of the old one
+        reused_bytes = sum(
+            leaf.nbytes for leaf in jax.tree_util.tree_leaves(new_states)
+            if leaf.unsafe_buffer_pointer() in input_buffers)
+        assert reused_bytes >= state_bytes // 2
+        assert (new_states.real_env_steps == 1).all()
+
+    def test_step_mixed_phases(self):
+        chex.clear_trace_counter()
+        env_batch = JuxEnvBatch(buf_cfg=JuxBufferConfig(MAX_N_UNITS=100))
+        jux_env = env_batch.jux_env
+
+        # env 0 is bidding, env 1 is placing factories, env 2 is in late game
+        bid_state = jux_env.reset(0)
+        placement_state, _ = jux_env.step_bid(jux_env.reset(1), jnp.array([0, 0]), jnp.array([0, 0]))
+        late_state = jux_env.reset_to_late_game(2)
+        states = jux.tree_util.batch_into_leaf([bid_state, placement_state, late_state])
+
+        bid_action = (jnp.array([1, 0]), jnp.array([0, 1]))
+        spawn = jnp.array(jnp.nonzero(placement_state.board.valid_spawns_mask, size=1))[:, 0]
+        placement_action = (jnp.array([spawn, spawn]), jnp.array([100, 100]), jnp.array([100, 100]))
+        late_action = JuxAction.empty(env_batch.env_cfg, env_batch.buf_cfg)
+        late_action = late_action._replace(factory_action=jnp.ones_like(late_action.factory_action))
+
+        batch = lambda x: jux.tree_util.batch_into_leaf([x] * 3)
+        new_states, (_, rewards, dones, _) = env_batch.step(
+            states,
+            batch(bid_action),
+            batch(placement_action),
+            batch(late_action),
+        )
+
+        expected = [
+            jux_env.step_bid(bid_state, *bid_action),
+            jux_env.step_factory_placement(placement_state, *placement_action),
+            jux_env.step_late_game(late_state, late_action),
+        ]
+        expected_states = jux.tree_util.batch_into_leaf([state for state, _ in expected])
+        assert state___eq___vmap_jitted(new_states, expected_states).all()
+        assert (rewards == jnp.stack([r for _, (_, r, _, _) in expected])).all()
+        assert (dones == jnp.stack([d for _, (_, _, d, _) in expected])).all()
+        assert (new_states.n_units == jnp.array([[0, 0], [0, 0], late_state.n_factories])).all()
+
+
+class TestJuxEnvSharded:
+    N_DEVICES = 4
+
+    def test_step_late_game(self):
+        # XLA creates host devices when the backend is initialized, so they must be requested in a new process.
+        env = dict(
+            os.environ,
+            JAX_PLATFORMS='cpu',
+            XLA_FLAGS=f"{os.environ.get('XLA_FLAGS', '')} --xla_force_host_platform_device_count={self.N_DEVICES}",
+        )
+        code = 'from tests.test_env import TestJuxEnvSharded; TestJuxEnvSharded.check_step_late_game()'
+        subprocess.run(
+            [sys.executable, '-c', code],
+            cwd=Path(__file__).parents[1],
+            env=env,
+            check=True,
+        )
+
+    @classmethod
+    def check_step_late_game(cls):
+        chex.clear_trace_counter()
+        buf_cfg = JuxBufferConfig(MAX_N_UNITS=100)
+        env_sharded = JuxEnvSharded(buf_cfg=buf_cfg)
+        env_batch = JuxEnvBatch(buf_cfg=buf_cfg)
+        assert env_sharded.n_devices == cls.N_DEVICES
+        batch_size = 2 * env_sharded.n_devices
+        seeds = jnp.arange(batch_size)
+
+        # factories_per_team of the first env is gathered from the first device to all devices
+        states = env_sharded.reset(seeds)
+        chex.assert_shape(states.env_steps, (env_sharded.n_devices, 2))
+        assert len(states.env_steps.sharding.device_set) == env_sharded.n_devices
+        expected = env_batch.reset(seeds)
+        assert state___eq___vmap_jitted(env_sharded.unshard(states), expected).all()
+
+        states = env_sharded.reset_to_late_game(seeds)
+        actions = JuxAction.empty(env_batch.env_cfg, env_batch.buf_cfg)
+        actions = actions._replace(factory_action=jnp.ones_like(actions.factory_action))
+        actions = jux.tree_util.batch_into_leaf([actions] * batch_size)
+        states, (_, rewards, dones, _) = env_sharded.step_late_game(states, env_sharded.shard(actions))
+        rewards, dones = env_sharded.gather((rewards, dones))
+        assert isinstance(rewards, np.ndarray)
+        chex.assert_shape([rewards, dones], (batch_size, 2))
+
+        expected = env_batch.reset_to_late_game(seeds)
+        expected, (_, expected_rewards, expected_dones, _) = env_batch.step_late_game(expected, actions)
+        assert state___eq___vmap_jitted(env_sharded.unshard(states), expected).all()
+        assert (rewards == expected_rewards).all()
+        assert (dones == expected_dones).all()
+
+
+class TestJuxEnvBucketed:
+
+    def test_step_late_game(self):
+        chex.clear_trace_counter()
+        buf_cfg = JuxBufferConfig(MAX_N_UNITS=64)
+        env_bucketed = JuxEnvBucketed(buf_cfg=buf_cfg, unit_buckets=(16, 32))
+        env_batch = JuxEnvBatch(buf_cfg=buf_cfg)
+        assert env_bucketed.unit_buckets == (16, 32, 64)
+        seeds = jnp.arange(2)
+
+        states = env_bucketed.reset_to_late_game(seeds)
+        expected = env_batch.reset_to_late_game(seeds)
+        assert states.MAX_N_UNITS == 16
+
+        def build_and_move(states, buf_cfg):
+            # all factories build light robots, and robots move away from factories
+            actions = JuxAction.empty(env_bucketed.env_cfg, buf_cfg)
+            direction = (jnp.arange(buf_cfg.MAX_N_UNITS) % 4 + 1).astype(jnp.int8)
+            unit_action_queue = actions.unit_action_queue._replace(
+                action_type=jnp.zeros_like(actions.unit_action_queue.action_type),
+                direction=jnp.broadcast_to(direction[:, None], actions.unit_action_queue.direction.shape),
+                n=jnp.ones_like(actions.unit_action_queue.n),
+            )
+            actions = actions._replace(
+                factory_action=jnp.zeros_like(actions.factory_action),
+                unit_action_queue=unit_action_queue,
+                unit_action_queue_count=jnp.ones_like(actions.unit_action_queue_count),
+            )
+            actions = jux.tree_util.batch_into_leaf([actions] * len(seeds))
+            return actions._replace(unit_action_queue_update=states.unit_mask)
+
+        buckets = {states.MAX_N_UNITS}
+        for _ in range(8):
+            actions = build_and_move(states, env_bucketed.batch_env(states).buf_cfg)
+            states, (_, rewards, dones, _) = env_bucketed.step_late_game(states, actions)
+            expected, (_, expected_rewards, expected_dones, _) = \
+                env_batch.step_late_game(expected, build_and_move(expected, buf_cfg))
+
+            buckets.add(states.MAX_N_UNITS)
+            assert (int(states.n_units.max()) + buf_cfg.MAX_N_FACTORIES <= states.MAX_N_UNITS) or \
+                (states.MAX_N_UNITS == buf_cfg.MAX_N_UNITS)
+            assert state___eq___vmap_jitted(states.resize_units(buf_cfg.MAX_N_UNITS), expected).all()
+            assert (rewards == expected_rewards).all()
+            assert (dones == expected_dones).all()
+        assert buckets == {16, 32, 64}
+
+        # when units are gone, states move back to the smallest bucket with twice the margin
+        states = env_bucketed.migrate(states._replace(n_units=jnp.zeros_like(states.n_units)))
+        assert states.MAX_N_UNITS == 32
@@ -1,4 +1,6 @@
 import chex
+import jax
+import numpy as np
 from jax import Array
 from jax import numpy as jnp
 from luxai_s2.team import FactionTypes as LuxFactionTypes
@@ -6,7 +8,9 @@ from luxai_s2.team import Team as LuxTeam
 
 from jux.factory import Factory, LuxFactory, LuxTeam
 from jux.map.position import Position
+from jux.tree_util import batch_into_leaf
 from jux.unit import ResourceType, Unit, UnitCargo
+from jux.utils import INT32_MAX
 
 
 class TestFactory(chex.TestCase):
@@ -54,6 +58,36 @@ class TestFactory(chex.TestCase):
         assert transfer_amount == 10
         assert factory.cargo.ice == 90
 
+    def test_batched_ledger(self):
+        rng = np.random.default_rng(0)
+        n = 300
+        factories = batch_into_leaf([self.create_factory()] * n)
+        factories = factories._replace(
+            power=jnp.asarray(rng.integers(0, 1000, size=n), jnp.int32),
+            cargo=UnitCargo(jnp.asarray(rng.integers(0, 1000, size=(n, 4)), UnitCargo.dtype())),
+        )
+        resource = jnp.asarray(rng.integers(0, 5, size=n), jnp.int8)
+        amount = jnp.asarray(rng.integers(-10, 1000, size=n), jnp.int32)
+
+        ledger = factories.ledger
+        chex.assert_shape(ledger, (n, 5))
+        assert (ledger[:, :4] == factories.cargo.stock).all()
+        assert (ledger[:, ResourceType.power] == factories.power).all()
+        assert (factories.ledger_capacity() == jnp.array([INT32_MAX // 2] * 4 + [INT32_MAX])).all()
+        chex.assert_trees_all_equal(factories.replace_ledger(ledger), factories)
+
+        # negative amounts add or subtract nothing
+        column = jnp.arange(5) == resource[:, None]  # bool[n, 5]
+        added = jnp.where(column, jnp.maximum(amount, 0)[:, None], 0)
+        new_factories, transfer_amount = jax.jit(Factory.add_resource)(factories, resource, amount)
+        assert (new_factories.ledger == ledger + added).all()
+        assert (transfer_amount == added.sum(-1)).all()
+
+        subtracted = jnp.where(column, jnp.clip(amount[:, None], 0, ledger), 0)
+        new_factories, transfer_amount = jax.jit(Factory.sub_resource)(factories, resource, amount)
+        assert (new_factories.ledger == ledger - subtracted).all()
+        assert (transfer_amount == subtracted.sum(-1)).all()
+
     def test_from_to_lux(self):
         factory: Factory = self.create_factory()
         lux_factory: LuxFactory = factory.to_lux({'player_0': LuxTeam(
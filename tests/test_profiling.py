@@ -0,0 +1,51 @@
+import jax
+import jax.numpy as jnp
+from jax import core
+
+import jux.profiling
+from jux.config import JuxBufferConfig
+from jux.env import JuxEnvBatch
+
+
+def staged_fn(x):
+    with jax.named_scope('first'):
+        y = jnp.sin(x) * 2
+    z = y + 1
+    with jax.named_scope('second'):
+        w = jax.lax.cond(z.sum() > 0, lambda z: z * x, lambda z: z - x, z)
+    with jax.named_scope('first'):
+        v = w + y
+    return v, z
+
+
+def test_stage_jaxprs():
+    x = jnp.arange(6, dtype=jnp.float32).reshape(2, 3)
+    stages = jux.profiling.stage_jaxprs(jax.jit(jax.vmap(staged_fn)), x)
+    assert list(stages) == ['first', jux.profiling.OTHER_STAGE, 'second']
+
+    # 'first' reads x and w of 'second', and returns y for 'other' and 'second', and v for the caller
+    first, other, second = stages['first'].jaxpr, stages[jux.profiling.OTHER_STAGE].jaxpr, stages['second'].jaxpr
+    assert len(first.invars) == 2 and len(first.outvars) == 2
+    assert set(other.invars) <= set(first.outvars) and len(other.outvars) == 1
+    assert set(second.outvars) <= set(first.invars)
+
+    # each stage runs on its own
+    for closed_jaxpr in stages.values():
+        args = [jnp.ones(v.aval.shape, v.aval.dtype) for v in closed_jaxpr.jaxpr.invars]
+        outs = core.jaxpr_as_fun(closed_jaxpr)(*args)
+        assert [o.shape for o in outs] == [v.aval.shape for v in closed_jaxpr.jaxpr.outvars]
+
+    costs = jux.profiling.stage_costs(jax.jit(jax.vmap(staged_fn)), x)
+    assert [c.stage for c in costs] == list(stages)
+    assert all(c.bytes_accessed > 0 for c in costs)
+
+
+def test_profile_step_late_game(tmp_path):
+    env_batch = JuxEnvBatch(buf_cfg=JuxBufferConfig(MAX_N_UNITS=50))
+    costs = jux.profiling.profile_step_late_game(env_batch, batch_size=2, log_dir=str(tmp_path), repeat=1)
+    stages = [c.stage for c in costs]
+    for stage in ['validate_actions', 'update_action_queue', 'dig', 'movement', 'water', 'destroy', 'power']:
+        assert stage in stages
+    assert sum(c.bytes_accessed for c in costs) > 0
+    assert any(tmp_path.rglob('*.xplane.pb'))
+    assert 'total' in jux.profiling.format_table(costs)
@@ -0,0 +1,28 @@
+import numpy as np
+
+import jux.replay_corpus
+
+
+def test_replay_corpus(tmp_path):
+    paths = jux.replay_corpus.build_corpus(['tests/replay2.0_0.json.gz'], str(tmp_path), max_steps=30)
+    paths.append(jux.replay_corpus.record_replay('tests/replay2.0_1.json.gz', str(tmp_path / 'short.npz'), 20))
+
+    entry = jux.replay_corpus.load_entry(paths[0])
+    assert entry.n_steps == 30
+    assert entry.state.MAX_N_UNITS == entry.meta['max_n_units']
+    assert entry.actions.factory_action.shape == (30, 2, entry.state.MAX_N_FACTORIES)
+    assert entry.reference['board.rubble'].shape == (30, ) + entry.state.board.rubble.shape
+
+    # replays of different lengths and buffer sizes are stepped in one batch, across chunks
+    results = jux.replay_corpus.check_parity(paths, chunk_size=8)
+    assert [r.n_steps for r in results] == [30, 20]
+    assert all(r.ok for r in results), results
+
+    # a corrupted reference is caught at the corrupted step
+    with np.load(paths[1]) as data:
+        data = dict(data)
+    data['reference/units.power'][12] += 1
+    np.savez_compressed(paths[1], **data)
+    results = jux.replay_corpus.check_parity(paths, batch_size=1, max_n_units=50)
+    assert results[0].ok
+    assert results[1].first_mismatch == 12 and results[1].mismatched_keys == ['units.power']
@@ -1,8 +1,13 @@
+from typing import Tuple
+
 import chex
 import jax
+import numpy as np
+from jax import Array
 from jax import numpy as jnp
 from luxai_s2.team import FactionTypes as LuxFactionTypes
 
+from jux.actions import ActionQueue, UnitAction
 from jux.config import EnvConfig
 from jux.team import LuxTeam
 from jux.tree_util import batch_into_leaf
@@ -10,6 +15,105 @@ from jux.unit import LuxUnit, LuxUnitType, Unit, UnitType
 from jux.unit_cargo import ResourceType, UnitCargo
 
 
+def next_action_by_cond(self: Unit) -> UnitAction:
+    """`Unit.next_action()` of a single unit with `jax.lax.cond`, as it was before working on batched units."""
+    act = jax.tree_map(lambda x: x[..., self.action_queue.front], self.action_queue.data)
+    return jax.lax.cond(self.action_queue.is_empty(), lambda: UnitAction.do_nothing(), lambda: act)
+
+
+def repeat_action_by_scatter(self: Unit, success: bool) -> Unit:
+    """`Unit.repeat_action()` of a single unit with scatters, as it was before working on batched units."""
+    queue = self.action_queue
+    act = jax.tree_map(lambda x: x[..., queue.front], queue.data)
+    not_empty = ~queue.is_empty()
+    n_minus_one = (act.n > 1) & success & not_empty
+    pop_only = (act.n <= 1) & ~act.repeat & success & not_empty
+    pop_and_push_back = (act.n <= 1) & act.repeat & success & not_empty
+
+    data: UnitAction = jax.tree_map(
+        lambda q, a: q.at[queue.rear].set(a),
+        queue.data,
+        act._replace(n=jnp.where(pop_and_push_back, act.repeat, act.n)),
+    )
+    data = data._replace(n=data.n.at[queue.front].add(-n_minus_one.astype(data.n.dtype)))
+    return self._replace(action_queue=queue._replace(
+        data=data,
+        front=jnp.where(pop_only | pop_and_push_back, (queue.front + 1) % queue.capacity, queue.front),
+        rear=jnp.where(pop_and_push_back, (queue.rear + 1) % queue.capacity, queue.rear),
+        count=jnp.where(pop_only, queue.count - 1, queue.count),
+    ))
+
+
+def add_resource_by_cond(self: Unit, resource, amount, unit_cfgs) -> Tuple[Unit, Array]:
+    """`Unit.add_resource()` of a single unit with `jax.lax.cond`, as it was before the resource ledger."""
+    amount = jnp.maximum(amount, 0)
+
+    def add_power():
+        transfer_amount = jnp.minimum(self.get_cfg("BATTERY_CAPACITY", unit_cfgs) - self.power, amount)
+        return self._replace(power=self.power + transfer_amount), transfer_amount
+
+    def add_others():
+        cargo, transfer_amount = self.cargo.add_resource(resource, amount, self.get_cfg("CARGO_SPACE", unit_cfgs))
+        return self._replace(cargo=cargo), transfer_amount
+
+    return jax.lax.cond(resource == ResourceType.power, add_power, add_others)
+
+
+def sub_resource_by_cond(self: Unit, resource, amount) -> Tuple[Unit, Array]:
+    """`Unit.sub_resource()` of a single unit with `jax.lax.cond`, as it was before the resource ledger."""
+
+    def sub_power():
+        transfer_amount = jnp.minimum(self.power, amount)
+        return self._replace(power=self.power - transfer_amount), transfer_amount
+
+    def sub_others():
+        cargo, transfer_amount = self.cargo.sub_resource(resource, amount)
+        return self._replace(cargo=cargo), transfer_amount
+
+    return jax.lax.cond(resource == ResourceType.power, sub_power, sub_others)
+
+
+def random_units(env_cfg: EnvConfig, shape, seed: int = 0) -> Unit:
+    """Units of the given batch shape, whose action queues hold random valid actions in random positions."""
+    rng = np.random.default_rng(seed)
+    Q = env_cfg.UNIT_ACTION_QUEUE_SIZE
+    data = UnitAction(
+        action_type=rng.integers(0, 6, size=shape + (Q, )).astype(np.int8),
+        direction=rng.integers(0, 5, size=shape + (Q, )).astype(np.int8),
+        resource_type=rng.integers(0, 5, size=shape + (Q, )).astype(np.int8),
+        amount=rng.integers(0, 100, size=shape + (Q, )).astype(np.int16),
+        repeat=rng.integers(0, 3, size=shape + (Q, )).astype(np.int16),
+        n=rng.integers(0, 4, size=shape + (Q, )).astype(np.int16),
+    )
+    count = rng.integers(0, Q + 1, size=shape)
+    front = rng.integers(0, Q, size=shape)
+    queue = ActionQueue(
+        data=jax.tree_map(jnp.asarray, data),
+        front=jnp.asarray(front, jnp.int8),
+        rear=jnp.asarray((front + count) % Q, jnp.int8),
+        count=jnp.asarray(count, jnp.int8),
+    )
+    unit = Unit.empty(env_cfg)
+    units = jax.tree_map(lambda x: jnp.broadcast_to(jnp.asarray(x), shape + jnp.shape(x)), unit)
+    return units._replace(action_queue=queue)
+
+
+def random_transfers(env_cfg: EnvConfig, shape, seed: int = 0) -> Tuple[Unit, Array, Array]:
+    """Units of the given batch shape with random types, power and cargo within capacity, and random resource types
+    and amounts, some negative, to transfer."""
+    rng = np.random.default_rng(seed)
+    units = random_units(env_cfg, shape, seed)
+    units = units._replace(
+        unit_type=jnp.asarray(rng.integers(0, 2, size=shape), units.unit_type.dtype),
+        power=jnp.asarray(rng.integers(0, 3000, size=shape), units.power.dtype),
+        cargo=UnitCargo(jnp.asarray(rng.integers(0, 1000, size=shape + (4, )), UnitCargo.dtype())),
+    )
+    units = units.replace_ledger(jnp.minimum(units.ledger, units.ledger_capacity(env_cfg.ROBOTS)))
+    resource = jnp.asarray(rng.integers(0, 5, size=shape), jnp.int8)
+    amount = jnp.asarray(rng.integers(-10, 1000, size=shape), jnp.int16)
+    return units, resource, amount
+
+
 class TestUnit(chex.TestCase):
 
     @staticmethod
@@ -96,3 +200,43 @@ class TestUnit(chex.TestCase):
 
         jux_unit = Unit.from_lux(lux_unit, env_cfg)
         assert jux_unit == Unit.from_lux(jux_unit.to_lux(lux_teams, lux_env_cfg), env_cfg)
+
+    def test_next_and_repeat_action(self):
+        env_cfg = EnvConfig()
+        units = random_units(env_cfg, (2, 300))
+        success = jnp.asarray(np.random.default_rng(1).random((2, 300)) < 0.7)
+
+        expected_action = jax.vmap(jax.vmap(next_action_by_cond))(units)
+        expected_units = jax.vmap(jax.vmap(repeat_action_by_scatter))(units, success)
+        chex.assert_trees_all_equal(jax.jit(Unit.next_action)(units), expected_action)
+        chex.assert_trees_all_equal(jax.jit(Unit.repeat_action)(units, success), expected_units)
+
+        # packed queues
+        packed = units._replace(action_queue=units.action_queue.pack())
+        chex.assert_trees_all_equal(jax.jit(Unit.next_action)(packed), expected_action)
+        new_packed = jax.jit(Unit.repeat_action)(packed, success)
+        assert new_packed.action_queue.is_packed
+        chex.assert_trees_all_equal(new_packed.action_queue.unpack(), expected_units.action_queue)
+
+        # a single unit
+        unit = jax.tree_map(lambda x: x[1, 7], units)
+        chex.assert_trees_all_equal(unit.repeat_action(success[1, 7]), jax.tree_map(lambda x: x[1, 7], expected_units))
+
+    def test_batched_add_sub_resource(self):
+        env_cfg = EnvConfig()
+        units, resource, amount = random_transfers(env_cfg, (2, 300))
+
+        expected = jax.vmap(jax.vmap(add_resource_by_cond, in_axes=(0, 0, 0, None)),
+                            in_axes=(0, 0, 0, None))(units, resource, amount, env_cfg.ROBOTS)
+        actual = jax.jit(Unit.add_resource, static_argnums=(3, ))(units, resource, amount, env_cfg.ROBOTS)
+        chex.assert_trees_all_equal(actual, expected)
+
+        # negative amounts subtract nothing. Before the resource ledger, subtracting negative power added it.
+        expected = jax.vmap(jax.vmap(sub_resource_by_cond))(units, resource, jnp.maximum(amount, 0))
+        actual = jax.jit(Unit.sub_resource)(units, resource, amount)
+        chex.assert_trees_all_equal(actual, expected)
+        negative = amount < 0
+        assert negative.any() and (negative & (resource == ResourceType.power)).any()
+        new_units, transfer_amount = actual
+        assert (transfer_amount[negative] == 0).all()
+        assert (new_units.ledger[negative] == units.ledger[negative]).all()